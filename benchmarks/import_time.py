@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+"""Import time benchmark for the plann entry points.
+
+Runs `python -X importtime` on the module behind each entry point a
+few times, and compares the best (cumulative) import time with the
+baseline in import_time.json.  Fails if the import time has regressed
+more than the tolerance, if any of the modules that should be
+imported lazily are imported on startup, or if an entry point could
+not be measured (it can't be imported, or there is no baseline for
+it).  --skip-missing reports entry points that can't be imported
+(i.e. plann-ai-gui without customtkinter) as skipped rather than
+failing.
+
+Usage:
+
+    python benchmarks/import_time.py [--update] [--tolerance 1.5] [--skip-missing]
+
+--update will write the measured times as the new baseline.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+ENTRY_POINTS = {
+    'plann': 'plann.cli',
+    'plann-ai': 'plann.ai_cli',
+    'plann-ai-gui': 'plann.gui',
+}
+
+## Those are slow to import, and should only be imported when needed
+LAZY_MODULES = ['caldav', 'requests', 'icalendar', 'yaml', 'dateutil.parser', 'sortedcontainers', 'sqlite3', 'plann.mirror', 'plann.panic_planning']
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'import_time.json')
+
+def measure(module, runs=5):
+    """
+    Returns the best cumulative import time for the module in
+    microseconds, and the set of modules imported on the way.
+    Returns None if the module could not be imported at all.
+    """
+    best = None
+    imported = set()
+    for i in range(runs):
+        proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'], capture_output=True, text=True)
+        if proc.returncode:
+            return None, proc.stderr.strip().split('\n')[-1]
+        for line in proc.stderr.split('\n'):
+            if not line.startswith('import time:') or 'self [us]' in line:
+                continue
+            self_us, cumulative, name = line[12:].split('|')
+            imported.add(name.strip())
+            if name.strip() == module:
+                cumulative = int(cumulative)
+                if best is None or cumulative < best:
+                    best = cumulative
+    return best, imported
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--update', action='store_true', help="store the measurements as the new baseline")
+    parser.add_argument('--tolerance', type=float, default=1.5, help="fail if slower than baseline times this factor")
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--skip-missing', action='store_true', help="don't fail on entry points that can't be imported")
+    args = parser.parse_args()
+
+    try:
+        with open(BASELINE) as f:
+            baseline = json.load(f)
+    except FileNotFoundError:
+        baseline = {}
+
+    failures = []
+    results = {}
+    for entry_point, module in ENTRY_POINTS.items():
+        best, imported = measure(module, args.runs)
+        if best is None:
+            print(f"{entry_point:14} SKIPPED - {imported}")
+            if not args.skip_missing:
+                failures.append(f"{entry_point}: {module} could not be imported ({imported})")
+            continue
+        results[entry_point] = best
+        reference = baseline.get(entry_point)
+        line = f"{entry_point:14} {best/1000:8.1f} ms"
+        if reference:
+            line += f"  (baseline {reference/1000:.1f} ms)"
+            if best > reference*args.tolerance:
+                failures.append(f"{entry_point}: import time {best/1000:.1f} ms exceeds {args.tolerance} x baseline {reference/1000:.1f} ms")
+        elif not args.update:
+            failures.append(f"{entry_point}: no baseline in {BASELINE} (run with --update)")
+        print(line)
+        for lazy in LAZY_MODULES:
+            if lazy in imported:
+                failures.append(f"{entry_point}: {lazy} is imported on startup")
+
+    if args.update:
+        baseline.update(results)
+        with open(BASELINE, 'w') as f:
+            json.dump(baseline, f, indent=4, sort_keys=True)
+            f.write('\n')
+
+    for failure in failures:
+        print(failure, file=sys.stderr)
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
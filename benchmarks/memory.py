@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+"""Memory benchmark for selections.
+
+Makes a selection of generated tasks, as __select does it (the data
+is parsed by the sanity checks), and prints the memory held per task
+when the selection is kept as caldav objects and as compact
+plann.item.PlannItem records.  Each variant is run in a separate
+process, and the memory is measured as the growth of the resident
+set size (Linux).
+
+Usage:
+
+    python benchmarks/memory.py [--count 100000]
+"""
+
+import argparse
+import gc
+import os
+import subprocess
+import sys
+
+from caldav import Todo
+
+## Benchmark the source tree rather than any installed plann
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from plann.item import PlannItem
+
+TODO = """BEGIN:VCALENDAR
+VERSION:2.0
+PRODID:-//plann//benchmark//EN
+BEGIN:VTODO
+UID:benchmark-task-{i}
+DTSTAMP:20240101T000000Z
+DTSTART:20240101T{hour:02}0000Z
+DUE:20240102T{hour:02}0000Z
+SUMMARY:benchmark task number {i}
+DESCRIPTION:A task made up for measuring the memory usage of a selection
+ of tasks, with a description of a typical length.
+PRIORITY:{priority}
+STATUS:NEEDS-ACTION
+CATEGORIES:benchmark,work
+END:VTODO
+END:VCALENDAR
+"""
+
+class Calendar:
+    url = "http://localhost/calendar/"
+    client = None
+
+def caldav_objects_iter(count):
+    calendar = Calendar()
+    for i in range(count):
+        obj = Todo(data=TODO.format(i=i, hour=i % 24, priority=i % 10), parent=calendar)
+        obj.url = f"{calendar.url}benchmark-task-{i}.ics"
+        ## (as the sanity checks in __select)
+        obj.icalendar_component
+        yield obj
+
+def caldav_objects(count):
+    return list(caldav_objects_iter(count))
+
+def rss():
+    """
+    Resident set size of this process in bytes
+    """
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+def run(variant, count):
+    """
+    Makes the selection, and prints the memory it holds
+    """
+    gc.collect()
+    before = rss()
+    if variant == 'caldav':
+        objs = caldav_objects(count)
+    else:
+        ## The caldav objects are dropped as soon as they are compacted
+        objs = [PlannItem.from_object(x) for x in caldav_objects_iter(count)]
+    gc.collect()
+    print(rss() - before)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--count', type=int, default=100000)
+    parser.add_argument('--variant', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.variant:
+        return run(args.variant, args.count)
+
+    results = {}
+    for variant in ('caldav', 'compact'):
+        proc = subprocess.run([sys.executable, __file__, '--count', str(args.count), '--variant', variant], capture_output=True, text=True, check=True)
+        results[variant] = int(proc.stdout)
+    full, compact = results['caldav'], results['compact']
+    print(f"{args.count} tasks")
+    print(f"caldav objects  {full/args.count:8.0f} bytes/task  {full/2**20:8.1f} MiB")
+    print(f"PlannItem       {compact/args.count:8.0f} bytes/task  {compact/2**20:8.1f} MiB  ({full/compact:.1f}x less)")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+"""Template rendering benchmark.
+
+Formats a list of generated tasks with the default list template, and
+prints the number of rows per second for the compiled template
+(plann.template.Template through plann.lib._list) and for the old
+string.Formatter based implementation, which parsed the template
+string again for every row.
+
+Usage:
+
+    python benchmarks/template.py [--rows 20000] [--runs 3]
+"""
+
+import argparse
+import datetime
+import os
+import re
+import string
+import sys
+import time
+
+import icalendar
+
+## Benchmark the source tree rather than any installed plann
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from plann.lib import _list
+from plann.template import Template, no_value
+from plann.timespec import tz
+
+TEMPLATE = "{DTSTART:?{DUE:?(date missing)?}?%F %H:%M:%S %Z}: {SUMMARY:?{DESCRIPTION:?(no summary given)?}?}"
+
+class LegacyTemplate(string.Formatter):
+    """
+    plann.template.Template as it was before the templates were compiled
+    """
+    def __init__(self, template):
+        self.template = template
+
+    def format(self, *pargs, **kwargs):
+        return super().format(self.template, *pargs, **kwargs)
+
+    def get_value(self, key, args, kwds):
+        try:
+            ret = string.Formatter.get_value(self, key, args, kwds)
+        except:
+            return no_value
+        if hasattr(ret, 'dt'):
+            ret = ret.dt
+            if not tz.show_native_timezone and isinstance(ret, datetime.datetime):
+                ret = ret.astimezone()
+        return ret
+
+    def format_field(self, value, format_spec):
+        rx = re.match(r'\?([^\?]*)\?(.*)', format_spec)
+        if rx:
+            format_spec = rx.group(2)
+            if value is no_value:
+                value = rx.group(1)
+        try:
+            return string.Formatter.format_field(self, value, format_spec)
+        except:
+            return string.Formatter.format_field(self, value, "")
+
+class Calendar:
+    def __init__(self, name):
+        self.name = name
+        self.url = f"http://localhost/{name}/"
+
+class Task:
+    def __init__(self, i, calendar):
+        comp = icalendar.Todo()
+        comp.add('UID', f'task-{i}')
+        comp.add('SUMMARY', f'task number {i}')
+        if i % 3:
+            comp.add('DUE', datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc) + datetime.timedelta(hours=i))
+        self.icalendar_component = comp
+        self.parent = calendar
+
+def legacy_list(objs):
+    template = LegacyTemplate(TEMPLATE)
+    lines = []
+    for obj in objs:
+        more_info = {'calendar_url': obj.parent.url}
+        lines.append(template.format(**obj.icalendar_component, **more_info))
+    return lines
+
+def compiled_list(objs):
+    return _list(objs, template=TEMPLATE, echo=False, filter=lambda obj: True)
+
+def best_rate(func, objs, runs):
+    best = None
+    for i in range(runs):
+        started = time.perf_counter()
+        func(objs)
+        elapsed = time.perf_counter() - started
+        if best is None or elapsed < best:
+            best = elapsed
+    return len(objs)/best
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--rows', type=int, default=20000)
+    parser.add_argument('--runs', type=int, default=3)
+    args = parser.parse_args()
+
+    calendars = [Calendar(f'calendar{i}') for i in range(4)]
+    objs = [Task(i, calendars[i % len(calendars)]) for i in range(args.rows)]
+    assert legacy_list(objs) == compiled_list(objs)
+
+    legacy = best_rate(legacy_list, objs, args.runs)
+    compiled = best_rate(compiled_list, objs, args.runs)
+    print(f"legacy template    {legacy:10.0f} rows/s")
+    print(f"compiled template  {compiled:10.0f} rows/s  ({compiled/legacy:.1f}x)")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+"""Timestamp and duration parsing benchmark.
+
+Parses a list of generated ISO 8601 timestamps and durations, and
+prints the number of parses per second through dateutil.parser and
+the old regexp loop (as plann.timespec did it before the fast path),
+through plann.timespec with distinct inputs (no memoization hits) and
+through plann.timespec with repeated inputs.
+
+Usage:
+
+    python benchmarks/timespec.py [--count 20000] [--runs 3]
+"""
+
+import argparse
+import datetime
+import os
+import re
+import sys
+import time
+
+import dateutil.parser
+
+## Benchmark the source tree rather than any installed plann
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from plann import timespec
+from plann.timespec import parse_dt, parse_add_dur
+
+def legacy_dur(dur):
+    """
+    plann.timespec.parse_add_dur(None, dur) as it was before the fast path
+    """
+    time_units = {
+        's': 1, 'm': 60, 'h': 3600,
+        'd': 86400, 'w': 604800,
+        'y': 1314000
+    }
+    total = datetime.timedelta(0)
+    while dur:
+        rx = re.match(r'([+-]?\d+(?:\.\d+)?)([smhdwy])(.*)', dur)
+        i = float(rx.group(1))
+        u = rx.group(2)
+        dur = rx.group(3)
+        total += datetime.timedelta(0, i*time_units[u])
+    return total
+
+def timestamps(count):
+    start = datetime.datetime(2024, 1, 1, 8)
+    return [(start + datetime.timedelta(minutes=17*i)).isoformat(sep=' ') for i in range(count)]
+
+def durations(count):
+    return [f"{i % 7}d{i % 24}h{i % 60}m{i % 3600}s" for i in range(count)]
+
+def best_rate(func, inputs, runs, clear=False):
+    best = None
+    for i in range(runs):
+        if clear:
+            timespec._parse_iso.cache_clear()
+            timespec._dur_parts.cache_clear()
+        started = time.perf_counter()
+        for x in inputs:
+            func(x)
+        elapsed = time.perf_counter() - started
+        if best is None or elapsed < best:
+            best = elapsed
+    return len(inputs)/best
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--count', type=int, default=20000)
+    parser.add_argument('--runs', type=int, default=3)
+    args = parser.parse_args()
+
+    ts = timestamps(args.count)
+    durs = durations(args.count)
+    ## A handful of distinct values, as when sorting or filtering on a field
+    repeated_ts = ts[:50] * (args.count // 50)
+    repeated_durs = durs[:50] * (args.count // 50)
+    assert all(dateutil.parser.parse(x) == timespec._parse_str(x) for x in ts[:1000])
+    assert all(legacy_dur(x) == parse_add_dur(None, x) for x in durs[:1000])
+
+    for what, legacy, fast, inputs, repeated in (
+            ('timestamps', dateutil.parser.parse, parse_dt, ts, repeated_ts),
+            ('durations', legacy_dur, lambda x: parse_add_dur(None, x), durs, repeated_durs)):
+        old = best_rate(legacy, inputs, args.runs)
+        distinct = best_rate(fast, inputs, args.runs, clear=True)
+        memoized = best_rate(fast, repeated, args.runs)
+        print(f"{what}")
+        print(f"  legacy              {old:10.0f} parses/s")
+        print(f"  fast path           {distinct:10.0f} parses/s  ({distinct/old:.1f}x)")
+        print(f"  repeated inputs     {memoized:10.0f} parses/s  ({memoized/old:.1f}x)")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
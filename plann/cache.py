@@ -0,0 +1,134 @@
+"""On-disk caches for calendar discovery and server capabilities.
+
+Resolving the principal, the calendar URLs and the display names
+costs several round trips to the server on every invocation.  The
+results are stored in a small json file under ~/.cache/plann (or
+$XDG_CACHE_HOME/plann), so that warm runs may skip discovery
+completely.  The capability profiles found by plann.probe are stored
+in the same way.
+"""
+
+import os
+import json
+import time
+import hashlib
+import logging
+import tempfile
+import threading
+
+## How long (in seconds) a discovery result is considered valid
+DISCOVERY_TTL = 24*3600
+
+## How long (in seconds) a server capability profile is considered valid
+CAPABILITY_TTL = 7*24*3600
+
+## Connection arguments that affects which calendars are found.
+## The password is deliberately not part of the key.
+_KEY_ARGS = ('caldav_username', 'caldav_user', 'calendar_url', 'calendar_name')
+
+def cache_dir():
+    """
+    The directory used for plann cache files
+    """
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'plann')
+
+def discovery_key(url, args):
+    """
+    Cache key for a config section: the server URL and a digest of
+    the section parameters that affects discovery.  An edited config
+    section will get a new key rather than stale data.
+    """
+    section = {}
+    for k in _KEY_ARGS:
+        value = args.get(k)
+        if value:
+            if isinstance(value, (str, bytes)):
+                value = [value]
+            section[k] = [str(x) for x in value]
+    digest = hashlib.sha1(json.dumps(section, sort_keys=True).encode()).hexdigest()[:16]
+    return f"{url}#{digest}"
+
+class JsonCache:
+    """
+    A dict stored as a json file.  The file is read on initialization
+    and written by save() if anything was changed.  Entries are
+    stored with a timestamp and expires after ttl seconds.  get/put
+    may be used from several threads.
+    """
+    def __init__(self, path, ttl, refresh=False):
+        self.path = path
+        self.ttl = ttl
+        self.refresh = refresh
+        self.dirty = False
+        self._lock = threading.Lock()
+        self._entries = {}
+        try:
+            with open(self.path) as f:
+                self._entries = json.load(f)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError):
+            logging.info(f"Ignoring unreadable cache file {self.path}", exc_info=True)
+
+    def _get(self, key, field):
+        if self.refresh or not self.ttl:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+        if not entry or time.time() - entry.get('timestamp', 0) > self.ttl:
+            return None
+        return entry[field]
+
+    def _put(self, key, field, value):
+        if not self.ttl:
+            return
+        with self._lock:
+            self._entries[key] = {'timestamp': time.time(), field: value}
+            self.dirty = True
+
+    def save(self):
+        if not self.dirty:
+            return
+        with self._lock:
+            try:
+                os.makedirs(os.path.dirname(self.path), mode=0o700, exist_ok=True)
+                ## Write to a temporary file and rename, so that a concurrent
+                ## plann process will never see a half-written file
+                prefix = '.' + os.path.basename(self.path).split('.')[0]
+                fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(self.path), prefix=prefix)
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(self._entries, f)
+                os.replace(tmpname, self.path)
+                self.dirty = False
+            except OSError:
+                logging.info(f"Could not write the cache file {self.path}", exc_info=True)
+
+class DiscoveryCache(JsonCache):
+    """
+    Maps a discovery key (see discovery_key) to a list of calendars,
+    each calendar being a dict with url, name and components.
+    """
+    def __init__(self, path=None, ttl=DISCOVERY_TTL, refresh=False):
+        super().__init__(path or os.path.join(cache_dir(), 'discovery.json'), ttl, refresh)
+
+    def get(self, key):
+        return self._get(key, 'calendars')
+
+    def put(self, key, calendars):
+        self._put(key, 'calendars', calendars)
+
+class CapabilityCache(JsonCache):
+    """
+    Maps a server URL to a capability profile, a dict from capability
+    name (see plann.probe.CAPABILITIES) to True or False.  Capabilities
+    not found in the profile are unknown.
+    """
+    def __init__(self, path=None, ttl=CAPABILITY_TTL, refresh=False):
+        super().__init__(path or os.path.join(cache_dir(), 'capabilities.json'), ttl, refresh)
+
+    def get(self, url):
+        return self._get(url, 'capabilities')
+
+    def put(self, url, capabilities):
+        self._put(url, 'capabilities', capabilities)
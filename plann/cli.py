@@ -18,14 +18,15 @@ plann is a "next generation" reimplementation of calendar-cli
 ## `from plann import ...`
 
 import os
-import caldav
 import sys
 from plann.config import config_section, read_config, expand_config_section
 from plann.metadata import metadata
-from plann.commands import _select, _edit, _cats, _check_for_panic, _add_todo, _add_event, _agenda, _check_due, _dismiss_panic, _split_huge_tasks, _split_high_pri_tasks, _set_task_attribs
-from plann.lib import find_calendars, attr_txt_one, attr_txt_many, attr_time, attr_int, _list, _split_vcal, _split_vcals
+from plann.cache import DiscoveryCache, CapabilityCache, DISCOVERY_TTL
+from plann.commands import _update_mirror, _select, _edit, _cats, _check_for_panic, _add_todo, _add_event, _agenda, _check_due, _dismiss_panic, _split_huge_tasks, _split_high_pri_tasks, _set_task_attribs, _probe_server, _text_search
+from plann.lib import DEFAULT_JOBS, CalendarList, connection_stats, reload_stats, attr_txt_one, attr_txt_many, attr_time, attr_int, _list, _list_needs_objects, _loaded_objects, _split_vcal, _split_vcals, _read_vcals, _save_raw, _add_ical_lines, _register_uids, _reset_uid_maps
 from plann.lib import add_time_tracking as add_time_tracking_
-from plann.timespec import tz, parse_dt, _now
+from plann.timespec import tz, parse_dt, _now, frozen_now
+from plann.recurrence import Occurrence
 from plann.interactive import _abort
 __version__ = metadata["version"]
 
@@ -62,6 +63,13 @@ list_type = list
 @click.option('--calendar-url', help="Calendar id, path or URL", metavar='cal', multiple=True)
 @click.option('--calendar-name', help="Calendar name", metavar='cal', multiple=True)
 @click.option('--raise-errors/--print-errors', help="Raise errors found on calendar discovery")
+@click.option('--refresh-discovery', is_flag=True, help="Ignore the cached calendar discovery results and server capabilities, and ask the server(s) again")
+@click.option('--discovery-cache-ttl', type=int, default=DISCOVERY_TTL, help="Seconds before cached calendar discovery results expire (0 disables the cache)", show_default=True)
+@click.option('--jobs', type=int, default=DEFAULT_JOBS, help="Max number of concurrent requests towards the caldav server(s)", show_default=True)
+@click.option('--mirror/--no-mirror', help="Keep a local mirror of the calendars (in ~/.cache/plann), and search it rather than the server(s)")
+@click.option('--auto-probe/--no-auto-probe', default=False, help="Check (read-only) what CalDAV features a server supports the first time it's searched.  The check lists the objects of a calendar.  See also the probe-server command", show_default=True)
+@click.option('--client-expand/--server-expand', default=False, help="Fetch only the master objects of recurring events and tasks, and expand the recurrences within the searched time range client side rather than letting the server send all the instances")
+@click.option('--report-connections', is_flag=True, help="Report the number of connections opened to the caldav server(s) and reloads avoided on exit")
 @click.pass_context
 def cli(ctx, **kwargs):
     """
@@ -75,18 +83,43 @@ def cli(ctx, **kwargs):
     ctx.ensure_object(dict)
     ## TODO: add all relevant connection parameters for the DAVClient as options
     ## TODO: logic to read the config file and edit kwargs from config file
-    ## TODO: delayed communication with caldav server (i.e. if --help is given to subcommand)
     ## TODO: catch errors, present nice error messages
-    conns = []
-    ctx.obj['calendars'] = find_calendars(kwargs, kwargs['raise_errors'])
+    conns = [kwargs]
     for flag in ('show_native_timezone', 'store_timezone', 'implicit_timezone'):
         setattr(tz, flag, kwargs[flag])
+    ## One "now" for the whole command
+    ctx.with_resource(frozen_now())
+    ## (in case several commands are run in one process)
+    _reset_uid_maps()
     if not kwargs['skip_config']:
         config = read_config(kwargs['config_file'])
         if config:
             for meta_section in kwargs['config_section']:
                 for section in expand_config_section(config, meta_section):
-                    ctx.obj['calendars'].extend(find_calendars(config_section(config, section), raise_errors=kwargs['raise_errors']))
+                    conns.append(config_section(config, section))
+    ## The calendars are discovered on first access (so i.e. --help given
+    ## to a subcommand won't cause any communication with the server).
+    ## The sections are discovered concurrently, and the results are
+    ## cached on disk so that later runs may skip discovery
+    cache = DiscoveryCache(ttl=kwargs['discovery_cache_ttl'], refresh=kwargs['refresh_discovery'])
+    ctx.obj['jobs'] = kwargs['jobs']
+    ctx.obj['mirror'] = None
+    if kwargs['mirror']:
+        ## (sqlite3 is only imported when the mirror is used)
+        from plann.mirror import Mirror
+        ctx.obj['mirror'] = Mirror()
+    ctx.obj['capabilities'] = CapabilityCache(refresh=kwargs['refresh_discovery'])
+    ctx.obj['auto_probe'] = kwargs['auto_probe']
+    ctx.obj['client_expand'] = kwargs['client_expand']
+    ctx.obj['calendars'] = CalendarList(conns, raise_errors=kwargs['raise_errors'], jobs=kwargs['jobs'], cache=cache)
+    if kwargs['report_connections']:
+        ctx.call_on_close(_report_connections)
+
+def _report_connections():
+    stats = connection_stats()
+    click.echo(f"{stats['connections']} connection(s) opened through {stats['clients']} client(s), {stats['principals']} principal lookup(s)", err=True)
+    if reload_stats['reloads']:
+        click.echo(f"{reload_stats['not_modified']} of {reload_stats['reloads']} reload(s) avoided, the object was not modified", err=True)
 
 @cli.command()
 @click.pass_context
@@ -98,11 +131,27 @@ def list_calendars(ctx):
         _abort("No calendars found!")
     else:
         output = "Accessible calendars found:\n"
-        calendar_info = [(x.get_display_name(), x.url) for x in ctx.obj['calendars']]
+        calendar_info = [(x.name or x.get_display_name(), x.url) for x in ctx.obj['calendars']]
         max_display_name = max([len(x[0]) for x in calendar_info])
         format_str= "%%-%ds %%s" % max_display_name
         click.echo_via_pager(output + "\n".join([format_str % x for x in calendar_info]) + "\n")
 
+@cli.command()
+@click.option('--read-only', is_flag=True, help="Skip the checks that need test objects to be stored in the calendar")
+@click.pass_context
+def probe_server(ctx, read_only):
+    """
+    Checks what CalDAV features the server(s) support
+
+    Unless --read-only is given, two tasks and an event are stored in
+    the first calendar of each server, and deleted afterwards.  The
+    results are cached, and filters a server does not support are
+    done by plann rather than by the server.
+    """
+    if not ctx.obj['calendars']:
+        _abort("No calendars found!")
+    _probe_server(ctx, write=not read_only)
+
 def _set_attr_options_(func, verb, desc=""):
     """
     decorator that will add options --set-category, --set-description etc
@@ -130,7 +179,26 @@ def _set_attr_options_(func, verb, desc=""):
 def _set_attr_options(verb="", desc=""):
     return lambda func: _set_attr_options_(func, verb, desc)
 
-@cli.group()
+class _SelectGroup(click.Group):
+    """
+    Keeps the arguments given to the subcommand, so the select
+    callback may look at the options of it (see _subcommand_params)
+    """
+    def resolve_command(self, ctx, args):
+        cmd_name, cmd, args = super().resolve_command(ctx, args)
+        ctx.meta['plann.subcommand_args'] = list_type(args)
+        return cmd_name, cmd, args
+
+def _subcommand_params(ctx):
+    """
+    The parameters the subcommand will be invoked with (without
+    running any callbacks)
+    """
+    cmd = ctx.command.get_command(ctx, ctx.invoked_subcommand)
+    args = list_type(ctx.meta.get('plann.subcommand_args', []))
+    return cmd.make_context(ctx.invoked_subcommand, args, parent=ctx, resilient_parsing=True).params
+
+@cli.group(cls=_SelectGroup)
 @click.option('--interactive/--no-interactive-select', help="line based interactive filtering")
 @click.option('--mass-interactive/--no-mass-interactive-select', help="editor based interactive filtering")
 @click.option('--all/--none', default=None, help='Select all (or none) of the objects.  Overrides all other selection options.')
@@ -149,15 +217,16 @@ def _set_attr_options(verb="", desc=""):
 @click.option('--to', 'end', help='alias for end')
 @click.option('--until', 'end', help='alias for end')
 @click.option('--timespan', help='do a time search for this interval')
-@click.option('--sort-key', help='use this attributes for sorting.  Templating can be used.  Prepend with - for reverse sort.  Special: "get_duration()" yields the duration or the distance between dtend and dtstart, or an empty timedelta', default=['{DTSTART:?{DUE:?(0000)?}?%F %H:%M:%S}{PRIORITY:?0?}'],  multiple=True)
+@click.option('--sort-key', help='use this attributes for sorting.  Templating can be used.  Prepend with - for reverse sort.  An empty sort key turns off sorting.  Special: "get_duration()" yields the duration or the distance between dtend and dtstart, or an empty timedelta', default=['{DTSTART:?{DUE:?(0000)?}?%F %H:%M:%S}{PRIORITY:?0?}'],  multiple=True)
 @click.option('--skip-parents/--include-parents', help="Skip parents if it's children is selected.  Useful for finding tasks that can be started if parent depends on child", default=False)
 @click.option('--skip-children/--include-children', help="Skip children if it's parent is selected.  Useful for getting an overview of the big picture if children are subtasks", default=False)
 @click.option('--limit', help='Number of objects to show', type=int)
 @click.option('--offset', help='Skip the first objects', type=int)
 @click.option('--freebusyhack', help='removes almost everything from the ical and replaces the summary with the provided string.  (this option is to be replaced with something better in a future release)')
 @click.option('--pinned-tasks/--no-pinned-tasks', default=None, help='select all/no pinned tasks')
+@click.option('--live', is_flag=True, help='query the caldav server(s) even if the global --mirror option is given')
 @click.pass_context
-def select(*largs, **kwargs):
+def select(ctx, **kwargs):
     """Search command, allows listing, editing, etc
 
     This command is intended to be used every time one is to
@@ -171,7 +240,19 @@ def select(*largs, **kwargs):
     allowing the common use-cases to be done in easier ways (like
     agenda and fix-tasks-interactive)
     """
-    return _select(*largs, **kwargs)
+    ## list and print-ical can take the objects as they are fetched
+    stream = ctx.invoked_subcommand in ('list', 'print-ical') and not kwargs['interactive'] and not kwargs['mass_interactive']
+    ## print-ical gives the data as it came from the server, so
+    ## there is no need to parse it (unless it's to be modified)
+    raw = stream and ctx.invoked_subcommand == 'print-ical' and not kwargs['freebusyhack']
+    ## list and list-categories don't modify anything, so compact
+    ## read-only items will do (see plann.item) - unless list needs
+    ## more than the items hold
+    compact = ctx.invoked_subcommand in ('list', 'list-categories') and not kwargs['interactive'] and not kwargs['mass_interactive']
+    if compact and ctx.invoked_subcommand == 'list':
+        params = _subcommand_params(ctx)
+        compact = not _list_needs_objects(params['template'], params['ics'], params['repair_relations'])
+    return _select(ctx, stream=stream, raw=raw, compact=compact, **kwargs)
 
 @select.command()
 @click.pass_context
@@ -185,6 +266,7 @@ def add_time_tracking(startnow):
         start_time = _now()
     else:
         start_time = None
+    import caldav
     if not startnow and not all (x for x in objs if isinstance(x, caldav.calendarobjectresource.Event)):
         _abort("original timespan is only allowed for events - and you've selected tasks or journals")
     if len(objs)>1 and startnow:
@@ -212,12 +294,13 @@ list_type = list
 @click.option('--template', default="{DTSTART:?{DUE:?(date missing)?}?%F %H:%M:%S %Z}: {SUMMARY:?{DESCRIPTION:?(no summary given)?}?}")
 @click.option('--top-down/--flat-list', help="Check relations and list the relations in a hierarchical way")
 @click.option('--bottom-up/--flat-list', help="List parents (dependencies) in a hierarchical way (cannot be combined with top-down)")
+@click.option('--repair-relations/--no-repair-relations', default=False, help="With --top-down or --bottom-up, add missing reverse relations to the related objects (and save them)")
 @click.pass_context
-def list(ctx, ics, template, top_down=False, bottom_up=False):
+def list(ctx, ics, template, top_down=False, bottom_up=False, repair_relations=False):
     """
     Print out a list of tasks/events/journals
     """
-    return _list(ctx.obj['objs'], ics, template, top_down=top_down, bottom_up=bottom_up)
+    return _list(ctx.obj['objs'], ics, template, top_down=top_down, bottom_up=bottom_up, repair_relations=repair_relations)
 
 
 @select.command()
@@ -236,8 +319,14 @@ def print_ical(ctx):
     """
     Dumps everything selected as an ICS feed
     """
-    for obj in ctx.obj['objs']:
-        click.echo(obj.data)
+    ## (objects from select --all are not loaded yet, they are
+    ## fetched in bulk)
+    for obj in _loaded_objects(ctx.obj['objs']):
+        if isinstance(obj, Occurrence):
+            ## (client side expanded recurrences have no data of their own)
+            click.echo(obj.icalendar_instance.to_ical().decode())
+        else:
+            click.echo(obj.data)
 
 @select.command()
 @click.option('--multi-delete/--no-multi-delete', default=None, help="Delete multiple things without confirmation prompt")
@@ -253,6 +342,7 @@ def delete(ctx, multi_delete, **kwargs):
         _abort(f"Not going to delete {len(objs)} items")
     for obj in objs:
         obj.delete()
+        _update_mirror(ctx, obj, deleted=True)
 
 ## TODO: reconsider the naming of the attributes and functions - --mass-interactive should probably be --interactive-editor - and the interactive reprioritization function needs to be renamed
 @select.command()
@@ -330,6 +420,32 @@ def check_for_panic(ctx, **kwargs):
 def sum_hours(ctx, **kwargs):
     raise NotImplementedError()
 
+@cli.group()
+@click.argument('terms')
+@click.option('--todo/--no-todo', default=None, help='search only todos (or no todos)')
+@click.option('--event/--no-event', default=None, help='search only events (or no events)')
+@click.option('--include-completed/--exclude-completed', default=True, help='include completed and cancelled tasks')
+@click.option('--limit', help='Number of objects to find', type=int)
+@click.pass_context
+def search(ctx, terms, **kwargs):
+    """Full text search, with the same subcommands as select
+
+    Finds objects with all the words in TERMS in the summary,
+    description, location or comment, the best matches first.  A word
+    also matches longer words starting with it.  The search is done
+    through an index in the local mirror of the calendars (see the
+    global --mirror option).
+
+    Example:
+
+      plann search "invoice acme" complete
+    """
+    return _text_search(ctx, terms, **kwargs)
+
+## The objects found by search can be used with all the select subcommands
+for name, command in select.commands.items():
+    search.add_command(command, name)
+
 ## TODO: all combinations of --first-calendar, --no-first-calendar, --multi-add, --no-multi-add should be tested
 @cli.group()
 @click.option('-l', '--add-ical-line', multiple=True, help="extra ical data to be injected")
@@ -340,7 +456,8 @@ def add(ctx, **kwargs):
     """
     Save new objects on calendar(s)
     """
-    if len(ctx.obj['calendars'])>1 and kwargs['multi_add'] is False:
+    ## (with --first-calendar, only the first calendar will be discovered)
+    if kwargs['multi_add'] is False and len(ctx.obj['calendars'])>1:
         _abort("Giving up: Multiple calendars given, but --no-multi-add is given")
     ## TODO: crazy-long if-conditions can be refactored - see delete on how it's done there
     if (kwargs['first_calendar'] or
@@ -365,7 +482,22 @@ def add(ctx, **kwargs):
 @click.pass_context
 @click.option('-d', '--ical-data', '--ical', help="ical object to be added")
 @click.option('-f', '--ical-file', type=click.File('rb'), help="file containing ical data")
-def ical(ctx, ical_data, ical_file):
+@click.option('--raw/--no-raw', default=False, help="Save each VCALENDAR (as given by print-ical) as it is, without parsing it")
+def ical(ctx, ical_data, ical_file, raw=False):
+    if raw:
+        ## The VCALENDARs are read and saved one by one
+        if ical_data:
+            lines = ical_data.splitlines(keepends=True)
+        elif ical_file:
+            lines = (x.decode() for x in ical_file)
+        else:
+            lines = sys.stdin
+        for ical in _read_vcals(lines):
+            if ctx.obj['ical_fragment']:
+                ical = _add_ical_lines(ical, ctx.obj['ical_fragment'])
+            for c in ctx.obj['calendars']:
+                _save_raw(c, ical)
+        return
     ical = ""
     if (ical_file):
         ical = ical + ical_file.read().decode()
@@ -385,7 +517,7 @@ def ical(ctx, ical_data, ical_file):
     for ical in icals:
         for c in ctx.obj['calendars']:
             ## TODO: this may not be an event - should make a Calendar.save_object method
-            c.save_event(ical)
+            _register_uids([c.save_event(ical)])
 
     
 @add.command()
@@ -1,16 +1,21 @@
 import os
-import caldav
 #import isodate
 import datetime
 import logging
 import re
 import sys
+import heapq
+import itertools
 ## TODO: can we remove the click-dependency?
 import click
-from plann.template import Template
-from plann.panic_planning import timeline_suggestion
 from plann.timespec import _now, _ensure_ts, parse_dt, parse_add_dur, parse_timespec, tz
-from plann.lib import _summary, _procrastinate, _relships_by_type, _summary, _relationship_text, _adjust_relations, parentlike, childlike, _remove_reverse_relations, _process_set_arg, attr_txt_one, attr_txt_many, attr_time, attr_int, _set_something, _list, _add_category
+from plann.lib import DEFAULT_JOBS, _fan_out, _fan_out_iter, _objects_by_uids, _may_hold, _register_uids, _refetch_objects, _reload, _sort_key, _search, RelationIndex, _summary, _procrastinate, _summary, _relationship_text, _adjust_relations, parentlike, childlike, _remove_reverse_relations, _process_set_arg, attr_txt_one, attr_txt_many, attr_time, attr_int, _set_something, _list, _add_category
+from plann.filters import compile_filter
+from plann.recurrence import expand, Occurrence
+from plann.item import PlannItem, FIELDS as ITEM_FIELDS
+from plann.template import Template
+from plann.scan import component_name
+from plann.probe import CAPABILITIES, known_capability, server_profile, probe_calendar, set_profile
 from plann.interactive import command_edit, _interactive_ical_edit, _interactive_relation_edit, _set_relations_from_text_list, interactive_split_task, _editor, _command_line_edit, interactive_split_task, _mass_interactive_edit, _mass_reprioritize, _get_obj_from_line, _abort, _strip_line
 
 def _select(ctx, interactive=False, mass_interactive=False, **kwargs):
@@ -27,9 +32,10 @@ def _select(ctx, interactive=False, mass_interactive=False, **kwargs):
                 objs, echo=False,
                 template="{UID}: {SUMMARY:?{DESCRIPTION:?(no summary given)?}?} (STATUS={STATUS:-})"))
             edited = _editor("## delete things that should not be selected:\n" + select_list)
+            objs_by_uid = _refetch_objects(objs)
             for objectline in edited.split("\n"):
                 foo = objectline.split(': ')
-                obj = _get_obj_from_line(objectline, objs[0].parent)
+                obj = _get_obj_from_line(objectline, objs[0].parent, objs_by_uid)
                 if obj:
                     ctx.obj['objs'].append(obj)
 
@@ -38,15 +44,65 @@ def _select(ctx, interactive=False, mass_interactive=False, **kwargs):
                 if click.confirm(f"select {_summary(obj)}?"):
                     ctx.obj['objs'].append(obj)
 
-def __select(ctx, extend_objects=False, all=None, uid=[], abort_on_missing_uid=None, sort_key=[], skip_parents=None, skip_children=None, limit=None, offset=None, freebusyhack=None, pinned_tasks=None, **kwargs_):
+def __select(ctx, extend_objects=False, all=None, uid=[], abort_on_missing_uid=None, sort_key=[], skip_parents=None, skip_children=None, limit=None, offset=None, freebusyhack=None, pinned_tasks=None, live=None, stream=False, raw=False, compact=False, **kwargs_):
     """
     select/search/filter tasks/events, for listing/editing/deleting, etc
+
+    With stream, ctx.obj['objs'] may be an iterator fetching from the
+    calendars as it's consumed, so listing can start before all the
+    calendars have responded.  That's only done when nothing needs the
+    full selection (sorting, limits, relations).  With raw (and
+    stream), the streamed objects are not parsed.  With compact, the
+    objects found by searching are given as compact read-only
+    PlannItems (see plann.item).
     """
+    import caldav
     if extend_objects:
         objs = ctx.obj.get('objs', [])
     else:
         objs = []
     ctx.obj['objs'] = objs
+    jobs = ctx.obj.get('jobs', DEFAULT_JOBS)
+    calendars = ctx.obj['calendars']
+    ## With a local mirror, the searches are done locally after
+    ## syncing the mirror (unless a live query is asked for)
+    mirror = None if live else ctx.obj.get('mirror')
+    ## Filters the server is known not to support are done client side
+    ## (see plann.probe)
+    capabilities = ctx.obj.get('capabilities')
+    auto_probe = ctx.obj.get('auto_probe', False)
+
+    def fan_out(func):
+        ## The calendars are queried concurrently.  Failing calendars
+        ## are reported and skipped, unless all of them fails.
+        results, errors = _fan_out(calendars, func, jobs)
+        ctx.obj['select_errors'] = errors
+        if errors and len(errors) == len(results):
+            raise errors[0][1]
+        return [x for x in results if x is not None]
+
+    def fan_out_iter(func):
+        ## Like fan_out, but yields the results one calendar at a time
+        errors = ctx.obj['select_errors'] = []
+        found = False
+        for result in _fan_out_iter(calendars, func, jobs, errors):
+            found = True
+            yield result
+        if errors and not found:
+            raise errors[0][1]
+
+    def streamed(results, func=None, fixup=True):
+        for result in results:
+            for obj in (func(result) if func else result):
+                if not raw:
+                    _register_uids([obj])
+                if fixup and not raw and not isinstance(obj, PlannItem):
+                    _fixup(obj, freebusyhack)
+                yield obj
+
+    stream = stream and not extend_objects
+    ## --sort-key '' turns off the sorting
+    sort_key = [x for x in sort_key if x]
 
     ## TODO: move all search/filter/select logic to caldav library?
     
@@ -54,8 +110,12 @@ def __select(ctx, extend_objects=False, all=None, uid=[], abort_on_missing_uid=N
     if all is False: ## means --none.
         return
     if all:
-        for c in ctx.obj['calendars']:
-            objs.extend(c.objects())
+        if stream:
+            ctx.obj['objs'] = streamed(fan_out_iter(lambda c: mirror.objects(c) if mirror else c.objects()), fixup=False)
+            return
+        for result in fan_out(lambda c: mirror.objects(c) if mirror else list(c.objects())):
+            objs.extend(result)
+        _register_uids(objs)
         return
 
     kwargs = {}
@@ -65,19 +125,29 @@ def __select(ctx, extend_objects=False, all=None, uid=[], abort_on_missing_uid=N
 
     ## uid(s)
     missing_uids = []
+    comp_filter=None
+    if kwargs_.get('event'):
+        comp_filter='VEVENT'
+    if kwargs_.get('todo'):
+        comp_filter='VTODO'
+    if uid:
+        ## One bulk lookup per calendar, skipping calendars where the
+        ## uid is known not to be
+        calendars = list(calendars)
+        to_ask = {str(c.url): [x for x in uid if _may_hold(c, x)] for c in calendars}
+        lookup = mirror.objects_by_uids if mirror else _objects_by_uids
+        found = fan_out(lambda c: lookup(c, to_ask[str(c.url)], comp_filter=comp_filter))
+        ## The uid map may be stale, uids not found are looked for in
+        ## the calendars skipped
+        skipped = {str(c.url): [x for x in uid if not x in to_ask[str(c.url)] and not any(x in f for f in found)] for c in calendars}
+        if any(skipped.values()):
+            found += fan_out(lambda c: lookup(c, skipped[str(c.url)], comp_filter=comp_filter))
     for uid_ in uid:
-        comp_filter=None
-        if kwargs_['event']:
-            comp_filter='VEVENT'
-        if kwargs_['todo']:
-            comp_filter='VTODO'
         cnt = 0
-        for c in ctx.obj['calendars']:
-            try:
-                objs.append(c.object_by_uid(uid_, comp_filter=comp_filter))
+        for found_ in found:
+            if uid_ in found_:
+                objs.append(found_[uid_])
                 cnt += 1
-            except caldav.error.NotFoundError:
-                pass
         if not cnt:
             missing_uids.append(uid_)
     if abort_on_missing_uid and missing_uids:
@@ -101,97 +171,167 @@ def __select(ctx, extend_objects=False, all=None, uid=[], abort_on_missing_uid=N
     elif kwargs_.get('timespan'):
         kwargs['start'], kwargs['end'] = parse_timespec(kwargs['timespan'])
 
+    ## An attribute given several times matches objects having any of
+    ## the values.  That can't be expressed in a calendar-query, so it's
+    ## filtered client side
+    client_filters = {}
     for attr in attr_txt_many:
         if len(kwargs_.get(attr, []))>1:
-            raise NotImplementedError(f"is it really needed to search for more than one {attr}?")
+            client_filters[attr] = kwargs.pop(attr)
         elif kwargs_.get(attr):
             kwargs[attr] = kwargs[attr][0]
+    predicate = compile_filter(**client_filters) if client_filters else None
 
     ## TODO: special handling of parent and child! (and test for that!)
 
-    if 'start' in kwargs and 'end' in kwargs:
+    ## Recurring objects are expanded within the time range, either by
+    ## the server, or (with --client-expand) client side from the
+    ## master objects (see plann.recurrence)
+    client_expand = 'start' in kwargs and 'end' in kwargs and ctx.obj.get('client_expand')
+    if 'start' in kwargs and 'end' in kwargs and not client_expand:
         kwargs['expand'] = True
-    for c in ctx.obj['calendars']:
-        objs.extend(c.search(**kwargs))
+    ## Without sorting or filtering after the search, the local mirror
+    ## may stop after the first offset+limit objects of each calendar
+    mirror_limit = None
+    if limit is not None and not sort_key and predicate is None and not skip_parents and not skip_children and pinned_tasks is None:
+        mirror_limit = limit + (offset or 0)
+    def search(c):
+        profile = server_profile(c, capabilities, probe=auto_probe) if capabilities is not None else {}
+        if mirror:
+            return mirror.search(c, skip_parents=skip_parents, skip_children=skip_children, limit=mirror_limit, **kwargs)
+        return _search(c, profile, **kwargs)
+    ## The sort keys may need properties the compact items don't hold
+    compact = compact and _item_keys(sort_key)
+    def compacted(obj):
+        ## (expanded recurrences are lightweight already, and the
+        ## instances expanded by the server can't be fetched again
+        ## one by one, they all have the uid of the master)
+        if isinstance(obj, Occurrence) or 'RECURRENCE-ID' in obj.icalendar_component:
+            return obj
+        _fixup(obj, freebusyhack)
+        return PlannItem.from_object(obj)
+    def refine(result):
+        if client_expand:
+            result = expand(result, kwargs['start'], kwargs['end'])
+        if predicate:
+            result = filter(predicate, result)
+        return map(compacted, result) if compact else result
+    if stream and not sort_key and limit is None and offset is None and not skip_parents and not skip_children and pinned_tasks is None:
+        ctx.obj['objs'] = streamed(fan_out_iter(search), refine)
+        return
+    ## With a sort key and a limit (and nothing needing the full
+    ## selection), the heap picking out the first offset+limit objects
+    ## is fed as the calendars respond, so the full selection is never
+    ## held
+    top_k = sort_key and limit is not None and not skip_parents and not skip_children and pinned_tasks is None
+    if top_k:
+        objs[:] = heapq.nsmallest(limit + (offset or 0), itertools.chain(list(objs), streamed(fan_out_iter(search), refine, fixup=False)), key=_sort_key(sort_key))
+    else:
+        for result in fan_out(search):
+            objs.extend(refine(result))
+        _register_uids(objs)
+
+    ## The relations of the whole selection are parsed in one go
+    if skip_children or skip_parents or pinned_tasks is not None:
+        relations = RelationIndex(objs)
 
     if skip_children or skip_parents:
-        i = 0
-        while i < len(objs):
-            obj = objs[i]
-            if skip_children and obj.get_relatives(parentlike, fetch_objects=False):
-                objs.pop(i)
-                continue
-            if skip_parents and obj.get_relatives(childlike, fetch_objects=False):
-                objs.pop(i)
-                continue
-            i += 1
+        objs[:] = [x for x in objs if not (skip_children and relations.has(x, parentlike)) and not (skip_parents and relations.has(x, childlike))]
 
     if pinned_tasks is not None:
+        ## Parents not in the selection are fetched in one batch
+        ## (a search without a component filter may give Event objects
+        ## for everything, hence the component names are checked)
+        events = [x for x in ctx.obj['objs'] if x.icalendar_component.name == 'VEVENT' and x.icalendar_component.get('STATUS', '') != 'CANCELLED']
+        parents = relations.fetch(events, {'PARENT'}, jobs)
+        pending = {uid for uid in parents if parents[uid].icalendar_component.name == 'VTODO' and parents[uid].icalendar_component.get('STATUS', 'NEEDS-ACTION') == 'NEEDS-ACTION'}
+        event_uids = {str(x.icalendar_component['UID']) for x in events}
         ret_objs = []
         for obj in ctx.obj['objs']:
-            if isinstance(obj, caldav.Event):
+            if obj.icalendar_component.name == 'VEVENT':
                 if obj.icalendar_component.get('STATUS', '') != 'CANCELLED':
-                    parents = _relships_by_type(obj, 'PARENT').get('PARENT',[])
-                    if any(x for x in parents if isinstance(x, caldav.Todo) and x.icalendar_component.get('STATUS', 'NEEDS-ACTION') == 'NEEDS-ACTION') == pinned_tasks:
+                    pinned = relations.related(obj, {'PARENT'}) & pending
+                    if bool(pinned) == pinned_tasks:
                         if kwargs_.get('todo'):
                             ## TODO: special handling for recurring tasks
-                            ret_objs.extend([x for x in parents if isinstance(x, caldav.Todo)  and x.icalendar_component.get('STATUS', 'NEEDS-ACTION') == 'NEEDS-ACTION'])
+                            ret_objs.extend(parents[x] for x in pinned)
                         else:
                             ret_objs.append(obj)
-            if isinstance(obj, caldav.Todo) and not pinned_tasks:
-                children = _relships_by_type(obj, 'CHILD').get('CHILD',[])
-                if not any(x.icalendar_comp.get('STATUS', '')!='CANCELLED' for x in parents if isinstance(x, event.Event)):
+            if obj.icalendar_component.name == 'VTODO' and not pinned_tasks:
+                ## tasks without any (non-cancelled) event in the selection as a child
+                if not relations.related(obj, {'CHILD'}) & event_uids:
                     ret_objs.append(obj)
         ctx.obj['objs'] = ret_objs
 
-    ## OPTIMIZE TODO: sorting the list multiple times rather than once is a bit of brute force, if there are several sort keys and long list of objects, we should sort once and consider all sort keys while sorting
     ## TODO: Consider that an object may be expanded and contain lots of event instances.  We will then need to expand the caldav.Event object into multiple objects, each containing one recurrance instance.  This should probably be done on the caldav side of things.
-    for skey in reversed(sort_key):
-        ## If the key starts with -, sorting should be reversed
-        if skey[0] == '-':
-            reverse = True
-            skey=skey[1:]
-        else:
-            reverse = False
-        ## if the key contains {}, it should be considered to be a template
-        if '{' in skey:
-            fkey = lambda obj: Template(skey).format(**obj.icalendar_component)
-        elif skey == 'get_duration()':
-            fkey = lambda obj: obj.get_duration()
-        else:
-            fkey = lambda obj: obj.icalendar_component.get(skey)
-        ctx.obj['objs'].sort(key=fkey, reverse=reverse)
+    ## All the sort keys are compiled into one key function.  With a
+    ## limit, only the first offset+limit objects are picked out (through
+    ## a heap), otherwise the list is sorted once
+    if top_k:
+        pass
+    elif sort_key and limit is not None:
+        ctx.obj['objs'] = heapq.nsmallest(limit + (offset or 0), ctx.obj['objs'], key=_sort_key(sort_key))
+    elif sort_key:
+        ctx.obj['objs'].sort(key=_sort_key(sort_key))
 
-    ## OPTIMIZE TODO: this is also suboptimal, if ctx.obj is a very long list
     if offset is not None:
         ctx.obj['objs'] = ctx.obj['objs'][offset:]
     if limit is not None:
         ctx.obj['objs'] = ctx.obj['objs'][0:limit]
 
-    ## some sanity checks
     for obj in ctx.obj['objs']:
-        comp = obj.icalendar_component
-        dtstart = comp.get('dtstart')
-        dtend = comp.get('dtend') or comp.get('due')
-        if dtstart and dtend and isinstance(dtstart.dt, datetime.datetime) != isinstance(dtend.dt, datetime.datetime):
-            logging.error(f"task with uuid {comp['uid']} has non-matching types on dtstart and dtend/due, setting both to timestamps")
-            comp['dtstart'].dt = datetime.datetime(dtstart.dt.year, dtstart.dt.month, dtstart.dt.day)
-            comp['dtend'].dt = datetime.datetime(dtend.dt.year, dtend.dt.month, dtend.dt.day) 
-        elif dtstart and dtend and dtstart.dt > dtend.dt:
-            logging.error(f"task with uuid {comp['uid']} as dtstart after dtend/due")
+        if not isinstance(obj, PlannItem):
+            _fixup(obj, freebusyhack)
+
+def _item_keys(sort_keys):
+    """
+    True if the sort keys can be used with compact items
+    """
+    for sort_key in sort_keys:
+        sort_key = sort_key.lstrip('-')
+        if '{' in sort_key:
+            if not Template(sort_key).fields() <= ITEM_FIELDS:
+                return False
+        elif sort_key != 'get_duration()' and not sort_key.upper() in ITEM_FIELDS:
+            return False
+    return True
+
+def _fixup(obj, freebusyhack=None):
+    """
+    Some sanity checks on a selected object, and the --freebusyhack
+    """
+    comp = obj.icalendar_component
+    dtstart = comp.get('dtstart')
+    dtend = comp.get('dtend') or comp.get('due')
+    if dtstart and dtend and isinstance(dtstart.dt, datetime.datetime) != isinstance(dtend.dt, datetime.datetime):
+        logging.error(f"task with uuid {comp['uid']} has non-matching types on dtstart and dtend/due, setting both to timestamps")
+        comp['dtstart'].dt = datetime.datetime(dtstart.dt.year, dtstart.dt.month, dtstart.dt.day)
+        comp['dtend'].dt = datetime.datetime(dtend.dt.year, dtend.dt.month, dtend.dt.day) 
+    elif dtstart and dtend and dtstart.dt > dtend.dt:
+        logging.error(f"task with uuid {comp['uid']} as dtstart after dtend/due")
 
     ## I need a way to copy time information from one calendar to another
     ## (typically between private and work calendars) without carrying over
     ## (too much potentially) private/confidential information.
     if freebusyhack:
-        for obj in ctx.obj['objs']:
-            comp = obj.icalendar_component
-            attribs = list(comp.keys())
-            for attr in attribs:
-                if not attr in ('DUE', 'DTEND', 'DTSTART', 'DTSTAMP', 'UID', 'RRULE', 'SEQUENCE', 'EXDATE', 'STATUS', 'CLASS'):
-                    del comp[attr]
-                if attr == 'SUMMARY':
-                    comp[attr] = freebusyhack
+        attribs = list(comp.keys())
+        for attr in attribs:
+            if not attr in ('DUE', 'DTEND', 'DTSTART', 'DTSTAMP', 'UID', 'RRULE', 'SEQUENCE', 'EXDATE', 'STATUS', 'CLASS'):
+                del comp[attr]
+            if attr == 'SUMMARY':
+                comp[attr] = freebusyhack
+
+def _update_mirror(ctx, obj, deleted=False):
+    """
+    Keeps the local mirror (if any) up to date after a write
+    """
+    mirror = ctx.obj.get('mirror')
+    if not mirror:
+        return
+    if deleted:
+        mirror.remove(obj)
+    else:
+        mirror.store(obj)
 
 def _cats(ctx):
     categories = set()
@@ -202,14 +342,7 @@ def _cats(ctx):
     return categories
 
 def _interactive_edit(obj):
-    if 'BEGIN:VEVENT' in obj.data:
-        objtype = 'event'
-    elif 'BEGIN:VTODO' in obj.data:
-        objtype = 'todo'
-    elif 'BEGIN:VJOURNAL' in obj.data:
-        objtype = 'journal'
-    else:
-        assert False
+    objtype = {'VEVENT': 'event', 'VTODO': 'todo', 'VJOURNAL': 'journal'}[component_name(obj)]
     if objtype != 'todo':
         raise NotImplementedError("interactive editing only implemented for tasks")
     comp = obj.icalendar_component
@@ -232,6 +365,8 @@ def _edit(ctx, add_category=None, cancel=None, interactive_ical=False, interacti
     ## TODO: consolidate with command_edit
     if 'recurrence_mode' in kwargs:
         complete_recurrence_mode = kwargs.pop('recurrence_mode')
+    if any(isinstance(x, Occurrence) for x in ctx.obj['objs']):
+        _abort("Recurrences expanded client side can't be edited, use --server-expand")
     _process_set_args(ctx, kwargs, keep_category=True)
     if interactive_ical:
         _interactive_ical_edit(ctx.obj['objs'])
@@ -280,6 +415,7 @@ def _edit(ctx, add_category=None, cancel=None, interactive_ical=False, interacti
 
         ## OPTIMIZE TODO: only save objects that actually have been edited
         obj.save()
+        _update_mirror(ctx, obj)
 
 def _check_for_panic(ctx, hours_per_day, output=True, print_timeline=True, fix_timeline=False, interactive_fix_timeline=False, timeline_start=None, timeline_end=None, include_all_events=False):
     if not timeline_start:
@@ -291,9 +427,11 @@ def _check_for_panic(ctx, hours_per_day, output=True, print_timeline=True, fix_t
     timeline_end = parse_dt(timeline_end, datetime.datetime)
     if include_all_events:
         ## Remove events from the list to prevent duplicates ...
-        ctx.obj['objs'] = [x for x in ctx.obj['objs'] if not 'BEGIN:VEVENT' in x.data]
+        ctx.obj['objs'] = [x for x in ctx.obj['objs'] if component_name(x) != 'VEVENT']
         ## ... and then add all events
         _select(ctx, event=True, start=timeline_start, end=timeline_end, extend_objects=True)
+    import caldav
+    from plann.panic_planning import timeline_suggestion
     possible_timeline = timeline_suggestion(ctx, hours_per_day=hours_per_day, timeline_end=timeline_end)
     def summary(obj):
         if obj is None:
@@ -395,6 +533,8 @@ def _add_todo(ctx, **kwargs):
         if duration:
             todo.set_duration(duration)
             todo.save()
+        _register_uids([todo])
+        _update_mirror(ctx, todo)
         click.echo(f"uid={todo.id}")
     return todo
 
@@ -403,8 +543,52 @@ def _add_event(ctx, timespec, **kwargs):
     for cal in ctx.obj['calendars']:
         (dtstart, dtend) = parse_timespec(timespec, for_storage=True)
         event = cal.save_event(dtstart=dtstart, dtend=dtend, **ctx.obj['set_args'], no_overwrite=True)
+        _register_uids([event])
+        _update_mirror(ctx, event)
         click.echo(f"uid={event.id}")
 
+def _filtered(ctx, capability):
+    """
+    True if the last selection is known to be properly filtered on
+    the capability: it was done through the local mirror, or all the
+    servers are known to support it
+    """
+    if ctx.obj.get('mirror'):
+        return True
+    return all(known_capability(c, capability) for c in ctx.obj['calendars'])
+
+def _probe_server(ctx, write=True):
+    """
+    Probes each server once, through the first of its calendars.
+    Returns a dict from calendar to capability profile.
+    """
+    ret = {}
+    servers = set()
+    for calendar in ctx.obj['calendars']:
+        if str(calendar.client.url) in servers:
+            continue
+        servers.add(str(calendar.client.url))
+        profile = probe_calendar(calendar, write=write)
+        set_profile(calendar, profile, ctx.obj.get('capabilities'))
+        ret[calendar] = profile
+        click.echo(f"{calendar.client.url} (probed through {calendar.url}):")
+        for capability in CAPABILITIES:
+            supported = {True: 'supported', False: 'not supported', None: 'unknown'}[profile.get(capability)]
+            click.echo(f"  {capability}: {supported}")
+    return ret
+
+def _text_search(ctx, terms, todo=None, event=None, include_completed=True, limit=None):
+    """
+    Full text search through the index in the local mirror (which is
+    used also without the global --mirror option).  The objects found
+    are put in ctx.obj['objs'], the best matches first.
+    """
+    from plann.mirror import Mirror
+    if not ctx.obj.get('mirror'):
+        ctx.obj['mirror'] = Mirror()
+    ctx.obj['objs'] = ctx.obj['mirror'].text_search(ctx.obj['calendars'], terms, todo=todo, event=event, include_completed=include_completed, limit=limit)
+    _register_uids(ctx.obj['objs'])
+
 def _agenda(ctx):
     start = datetime.datetime.now()
     _select(ctx=ctx, start=start, event=True, end='+7d', limit=16, sort_key=['{DTSTART:%F %H:%M:%S}', 'get_duration()'])
@@ -417,15 +601,17 @@ def _check_due(ctx, limit=16, lookahead='24h'):
     end_ = parse_add_dur(datetime.datetime.now(), lookahead)
     _select(ctx=ctx, todo=True, end=end_, limit=limit, sort_key=['{PRIORITY:?0?} {DTSTART:?{DUE:?(0000)?}?%F %H:%M:%S}'])
     objs = ctx.obj['objs']
+    trusted = _filtered(ctx, 'time-range-todo')
     for obj in objs:
         ## client side filtering in case the server returns too much
         ## TODO: should be moved to the caldav library
         ## TODO: consider the limit ... we may risk that nothing comes up due to the limit above
-        comp = obj.icalendar_component
-        dtstart = comp.get('dtstart') or comp.get('due')
-        dtstart = _ensure_ts(dtstart)
-        if dtstart.strftime("%F%H%M") > end_.strftime("%F%H%M"):
-            continue
+        if not trusted:
+            comp = obj.icalendar_component
+            dtstart = comp.get('dtstart') or comp.get('due')
+            dtstart = _ensure_ts(dtstart)
+            if dtstart.strftime("%F%H%M") > end_.strftime("%F%H%M"):
+                continue
         _interactive_edit(obj)
 
 def _dismiss_panic(ctx, hours_per_day, lookahead='60d'):
@@ -528,14 +714,18 @@ def _set_task_attribs(ctx):
             cond['no_dtstart'] = True
         _select(ctx=ctx, todo=True, limit=LIMIT, sort_key=['{DTSTART:?{DUE:?(0000)?}?%F %H:%M:%S}', '{PRIORITY:?0?}'], **cond)
         ## Doing some client-side filtering due to calendar servers that don't support the RFC properly
+        ## (unless the servers are known to support it)
         ## TODO: "Incompatibility workarounds" should be moved to the caldav library
-        objs_ = [x for x in ctx.obj['objs'] if not x.icalendar_component.get(something_)]
+        if _filtered(ctx, 'is-not-defined'):
+            objs_ = list(ctx.obj['objs'])
+        else:
+            objs_ = list(filter(compile_filter(**{f"no_{something_}": True}), ctx.obj['objs']))
 
         ## add all non-duplicated objects from objs to objs_
         uids_ = {x.icalendar_component['UID'] for x in objs_}
         for obj in objs or []:
             if not obj.icalendar_component['UID'] in uids_:
-                obj.load()
+                _reload(obj)
                 objs_.append(obj)
         objs = objs_
 
@@ -1,6 +1,5 @@
 import logging
 import json
-import yaml
 from fnmatch import fnmatch
 
 def interactive_config(args, config, remaining_argv):
@@ -157,6 +156,8 @@ def read_config(fn, interactive_error=False):
             with open(fn, 'rb') as config_file:
                 return json.load(config_file)
         except json.decoder.JSONDecodeError:
+            ## yaml is slow to import, and only needed for yaml config files
+            import yaml
             try:
                 with open(fn, 'rb') as config_file:
                     return yaml.load(config_file, yaml.Loader)
@@ -0,0 +1,188 @@
+"""Client side filtering of calendar objects.
+
+The checks follows the semantics of a CalDAV calendar-query (RFC 4791),
+so that the same results are given as from a server search.  They are
+used when searching the local mirror, and for filters that a server is
+known not to support (see plann.probe).
+
+compile_filter compiles select-style filter options into one predicate,
+for filtering a list of objects in one pass.  It also supports things
+a calendar-query can't do, like matching any of several values and
+negated matches.
+"""
+
+import datetime
+from plann.timespec import _ensure_ts
+
+## Used as start or end for time range checks when the search is
+## open-ended
+_far_past = datetime.datetime(1900, 1, 1, tzinfo=datetime.timezone.utc)
+_far_future = datetime.datetime(2200, 1, 1, tzinfo=datetime.timezone.utc)
+
+def _pending(comp):
+    """
+    Pending tasks, as found by caldav.Calendar.search(todo=True)
+    """
+    status = comp.get('STATUS', 'NEEDS-ACTION')
+    return status not in ('COMPLETED', 'CANCELLED') and (status == 'NEEDS-ACTION' or not 'COMPLETED' in comp)
+
+def _match_attr(comp, attr, value):
+    """
+    Case insensitive substring match on an attribute, like a
+    text-match in a calendar-query.  no_<attr>=True matches objects
+    without the attribute, no_<attr>=False objects having it.
+    """
+    if attr.startswith('no_'):
+        return (_prop_text(comp, attr[3:]) is None) == bool(value)
+    text = _prop_text(comp, attr)
+    return text is not None and str(value).lower() in text.lower()
+
+def _prop_text(comp, attr):
+    texts = _prop_texts(comp, attr)
+    return None if texts is None else ",".join(texts)
+
+def _prop_texts(comp, attr):
+    """
+    The values of an attribute as a list of strings (one for each
+    category), or None if the attribute is not set
+    """
+    attr = attr.rstrip('_').upper()
+    if attr == 'CATEGORY':
+        attr = 'CATEGORIES'
+    if attr in ('PARENT', 'CHILD'):
+        values = [x for x in _as_list(comp.get('RELATED-TO')) if x.params.get('RELTYPE', 'PARENT') == attr]
+    else:
+        values = _as_list(comp.get(attr))
+    if not values:
+        return None
+    texts = []
+    for value in values:
+        if hasattr(value, 'cats'):
+            texts.extend(str(x) for x in value.cats)
+        elif isinstance(value, str) or not hasattr(value, 'to_ical'):
+            texts.append(str(value))
+        else:
+            texts.append(value.to_ical().decode())
+    return texts
+
+def _as_list(value):
+    if value is None:
+        return []
+    if isinstance(value, list):
+        return value
+    return [value]
+
+def _in_range(obj, comp, start, end, recurring):
+    """
+    Time range check, following RFC 4791 section 9.9
+    """
+    start = _ensure_ts(start) if start else _far_past
+    end = _ensure_ts(end) if end else _far_future
+    if recurring:
+        import recurring_ical_events
+        return bool(recurring_ical_events.of(obj.icalendar_instance, components=[comp.name]).between(start, end))
+
+    def ts(prop):
+        return _ensure_ts(comp[prop]) if prop in comp else None
+    dtstart = ts('DTSTART')
+    if comp.name == 'VEVENT':
+        if 'DTEND' in comp:
+            dtend = ts('DTEND')
+        elif 'DURATION' in comp:
+            dtend = dtstart + comp['DURATION'].dt
+        elif dtstart and not isinstance(comp['DTSTART'].dt, datetime.datetime):
+            dtend = dtstart + datetime.timedelta(days=1)
+        else:
+            return dtstart is not None and start <= dtstart < end
+        return start < dtend and end > dtstart
+    if comp.name == 'VTODO':
+        due = ts('DUE')
+        if dtstart and 'DURATION' in comp:
+            due = dtstart + comp['DURATION'].dt
+        completed = ts('COMPLETED')
+        created = ts('CREATED')
+        if dtstart and due:
+            return (start < due or start <= dtstart) and (end > dtstart or end >= due)
+        if dtstart:
+            return start <= dtstart < end
+        if due:
+            return start < due <= end
+        if completed and created:
+            return (start <= created or start <= completed) and (end >= created or end >= completed)
+        if completed:
+            return start <= completed <= end
+        if created:
+            return end > created
+        return True
+    if comp.name == 'VJOURNAL':
+        if not dtstart:
+            return False
+        if not isinstance(comp['DTSTART'].dt, datetime.datetime):
+            return start < dtstart + datetime.timedelta(days=1) and end > dtstart
+        return start <= dtstart < end
+    return True
+
+def _values(value):
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return [str(x) for x in value]
+    return [str(value)]
+
+def compile_filter(todo=None, event=None, journal=None, include_completed=True, start=None, end=None, **attrs):
+    """
+    Compiles filter options into one predicate, a function taking a
+    calendar object and returning True if it matches all of them.
+
+    * todo, event, journal: same meaning as in caldav.Calendar.search
+      (todo=True and include_completed=False gives pending tasks only)
+    * start, end: time range, as in a calendar-query
+    * <attr>=value or a list of values: case insensitive substring
+      match on any of the values.  Categories are matched as a set,
+      each category separately.
+    * not_<attr>=value(s): none of the values should match
+    * no_<attr>=True: the attribute should not be set, False: it should
+    """
+    checks = []
+    comp_names = {'VTODO': todo, 'VEVENT': event, 'VJOURNAL': journal}
+    wanted = {x for x in comp_names if comp_names[x]}
+    unwanted = {x for x in comp_names if comp_names[x] is False}
+    if wanted:
+        checks.append(lambda obj, comp: comp.name in wanted)
+    if unwanted:
+        checks.append(lambda obj, comp: comp.name not in unwanted)
+    if todo and not include_completed:
+        checks.append(lambda obj, comp: comp.name != 'VTODO' or _pending(comp))
+    if start or end:
+        checks.append(lambda obj, comp: _in_range(obj, comp, start, end, any(x in comp for x in ('RRULE', 'RDATE', 'EXRULE', 'EXDATE'))))
+    for attr in attrs:
+        value = attrs[attr]
+        if value is None or value == ():
+            continue
+        if attr.startswith('no_'):
+            checks.append(lambda obj, comp, attr=attr[3:], value=bool(value): (_prop_texts(comp, attr) is None) == value)
+            continue
+        negate = attr.startswith('not_')
+        if negate:
+            attr = attr[4:]
+        checks.append(_text_check(attr, _values(value), negate))
+
+    def predicate(obj):
+        comp = obj.icalendar_component
+        return all(check(obj, comp) for check in checks)
+    return predicate
+
+def _text_check(attr, values, negate):
+    name = attr.rstrip('_').upper()
+    values = [x.lower() for x in values]
+    if name in ('CATEGORY', 'CATEGORIES'):
+        values = set(values)
+        def match(texts):
+            cats = {x.lower() for x in texts}
+            return bool(cats & values) or any(x in cat for x in values for cat in cats)
+    else:
+        def match(texts):
+            text = ",".join(texts).lower()
+            return any(x in text for x in values)
+    def check(obj, comp):
+        texts = _prop_texts(comp, attr)
+        return (texts is not None and match(texts)) != negate
+    return check
@@ -20,9 +20,9 @@ import os
 import tempfile
 import subprocess
 from plann.template import Template
-from plann.lib import _list, _adjust_relations, _summary, _procrastinate, _process_set_arg, _set_something, _icalendar_component, _relationship_text, _split_vcal, _now, add_time_tracking
+from plann.lib import _list, _object_by_uid, _refetch_objects, _reload, _adjust_relations, _summary, _procrastinate, _process_set_arg, _set_something, _icalendar_component, _relationship_text, _split_vcal, _now, add_time_tracking
 from plann.timespec import _ensure_ts, parse_add_dur
-from icalendar.prop import vRecur
+from plann.scan import component_name
 
 def command_edit(obj, command, interactive=True):
     if command == 'ignore':
@@ -56,6 +56,7 @@ def command_edit(obj, command, interactive=True):
         obj.icalendar_component['STATUS'] = 'CANCELLED'
     elif command.lower().startswith('set rrule='):
         ## TODO: does this work from the cli?  (...) edit --set-rrule=FREQ=YEARLY as well as add (...) --set-rrule=FREQ=YEARLY ?  Write test code and check!
+        from icalendar.prop import vRecur
         rrule = vRecur.from_ical(command[10:])
         _set_something(obj, 'RRULE', rrule)
     elif command.startswith('set '):
@@ -106,9 +107,9 @@ def _interactive_relation_edit(objs):
         objs, top_down=True, echo=False,
         template="{UID}: {SUMMARY:?{DESCRIPTION:?(no summary given)?}?} (STATUS={STATUS:-})"))
     edited = _editor(indented_family)
-    _set_relations_from_text_list(objs[0].parent, edited.split("\n"))
+    _set_relations_from_text_list(objs[0].parent, edited.split("\n"), objs_by_uid=_refetch_objects(objs))
 
-def _set_relations_from_text_list(calendar, some_list, parent=None, indent=0):
+def _set_relations_from_text_list(calendar, some_list, parent=None, indent=0, objs_by_uid=None):
     """
     Takes a list of indented strings identifying some relationships,
     ensures parent and child is
@@ -117,6 +118,8 @@ def _set_relations_from_text_list(calendar, some_list, parent=None, indent=0):
     * Currently it does not support RFC 9253 and enforces RELTYPE to be PARENT or CHILD
     * Currently it also lacks support for multiple parents
     * Relation type SIBLING is ignored
+
+    objs_by_uid may contain objects already fetched from the server
     """
     ## Logic:
     ## * If a parent is not set and indent is 0, make sure the item has either no parents or multiple parents
@@ -142,7 +145,9 @@ def _set_relations_from_text_list(calendar, some_list, parent=None, indent=0):
         uid = line.lstrip().split(':')[0]
         if not uid:
             raise NotImplementedError("No uid - what now?")
-        return calendar.object_by_uid(uid)
+        if objs_by_uid and uid in objs_by_uid:
+            return objs_by_uid[uid]
+        return _object_by_uid(uid, calendar)
     
     i=0
     children = []
@@ -172,7 +177,7 @@ def _set_relations_from_text_list(calendar, some_list, parent=None, indent=0):
                 if new_indent < line_indent and new_indent != indent:
                     raise NotImplementedError("unexpected indentation 2")
                 j+=1
-            _set_relations_from_text_list(calendar, some_list[i:j], parent=get_obj(some_list[i-1]), indent=line_indent)
+            _set_relations_from_text_list(calendar, some_list[i:j], parent=get_obj(some_list[i-1]), indent=line_indent, objs_by_uid=objs_by_uid)
             i=j
             continue
 
@@ -185,7 +190,7 @@ def _set_relations_from_text_list(calendar, some_list, parent=None, indent=0):
         ## TODO: look through all the conditions above.  should we ever be here?
         raise NotImplementedError("We should not be here - please raise an issue at https://github.com/tobixen/plann or reach out to bugs@plann.no")
     for c in children:
-        c.load()
+        _reload(c)
     _adjust_relations(parent, children)
 
 def _abort(message):
@@ -193,14 +198,7 @@ def _abort(message):
     raise click.Abort(message)
 
 def _interactive_edit(obj):
-    if 'BEGIN:VEVENT' in obj.data:
-        objtype = 'event'
-    elif 'BEGIN:VTODO' in obj.data:
-        objtype = 'todo'
-    elif 'BEGIN:VJOURNAL' in obj.data:
-        objtype = 'journal'
-    else:
-        assert False
+    objtype = {'VEVENT': 'event', 'VTODO': 'todo', 'VJOURNAL': 'journal'}[component_name(obj)]
     if objtype != 'todo':
         raise NotImplementedError("interactive editing only implemented for tasks")
     comp = obj.icalendar_component
@@ -228,15 +226,17 @@ def _mass_reprioritize(objs):
     if not objs:
         click.echo("Nothing to reprioritize!")
         return
-    objs.sort(key=lambda x: (x.icalendar_component.get('PRIORITY',0), _now()-_ensure_ts(x.get_due())))
+    now = _now()
+    objs.sort(key=lambda x: (x.icalendar_component.get('PRIORITY',0), now-_ensure_ts(x.get_due())))
     current_pri = -1
     template = Template(" {UID}: due={DUE} Pri={PRIORITY:?0?} {SUMMARY:?{DESCRIPTION:?(no summary given)?}?} (STATUS={STATUS:-})")
     for obj in objs:
         while obj.icalendar_component.get('PRIORITY', 0)>current_pri:
             current_pri += 1
             text += f"\n=== PRIORITY {current_pri}\n"
-        text += template.format(**obj.icalendar_component) + "\n"
+        text += template.render(obj.icalendar_component) + "\n"
     edited = _editor(text)
+    objs_by_uid = _refetch_objects(objs)
     current_pri = 0
     for line in edited.split('\n'):
         line = line.strip()
@@ -247,8 +247,7 @@ def _mass_reprioritize(objs):
         if line.startswith('=== PRIORITY '):
             current_pri=int(line[13:])
             continue
-        ## TODO: need to make some efforts to fix multi-calendar support.  Keep a uid -> obj dict.  Fix in the other mass editing functions.
-        _command_line_edit(f"set priority={current_pri} " + line, interactive=True, calendar=objs[0].parent)
+        _command_line_edit(f"set priority={current_pri} " + line, interactive=True, calendar=objs[0].parent, objs_by_uid=objs_by_uid)
 
 def _mass_interactive_edit(objs, default='ignore'):
     """send things through the editor, and expect commands back"""
@@ -275,10 +274,9 @@ def _mass_interactive_edit(objs, default='ignore'):
         ## TODO: this is bad design
         template=default + " {UID}: due={DUE} Pri={PRIORITY:?0?} {SUMMARY:?{DESCRIPTION:?(no summary given)?}?} (STATUS={STATUS:-})", filter=lambda obj: obj.icalendar_component.get('STATUS', 'NEEDS-ACTION')=='NEEDS-ACTION'))
     edited = _editor(text)
+    objs_by_uid = _refetch_objects(objs)
     for line in edited.split('\n'):
-        ## TODO: BUG: does not work if the source data comes from multiple calendars!
-        ## (possible fix: make a dict from uid to calendar(s))
-        _command_line_edit(line, interactive=True, calendar=objs[0].parent)
+        _command_line_edit(line, interactive=True, calendar=objs[0].parent, objs_by_uid=objs_by_uid)
     
 def interactive_split_task(obj, partially_complete=False, too_big=True):
     comp = obj.icalendar_component
@@ -307,7 +305,7 @@ def interactive_split_task(obj, partially_complete=False, too_big=True):
                 break
             cnt += 1
             todo = obj.parent.save_todo(summary=summary, parent=[comp['uid']])
-            obj.load()
+            _reload(obj)
             if partially_complete:
                 todo.complete()
                 break
@@ -347,10 +345,10 @@ def _strip_line(line):
     line = line.strip()
     return line
 
-def _get_obj_from_line(line, calendar):
-    ## TODO: the calendar we get here may be invalid.
-    ## We need to map uids to objects when fetching events
-    ## this should be done globally to reduce code duplication
+def _get_obj_from_line(line, calendar, objs_by_uid=None):
+    ## The calendar we get here may be invalid if the objects comes
+    ## from several calendars.  objs_by_uid and the uid map in
+    ## plann.lib takes care of that.
     uid_re = re.compile("^(.+?)(: .*)?$")
     line = _strip_line(line)
     if not line:
@@ -358,10 +356,12 @@ def _get_obj_from_line(line, calendar):
     found = uid_re.match(line)
     assert found
     uid = found.group(1)
-    obj = calendar.object_by_uid(uid)
+    if objs_by_uid and uid in objs_by_uid:
+        return objs_by_uid[uid]
+    obj = _object_by_uid(uid, calendar)
     return obj
 
-def _command_line_edit(line, calendar, interactive=True):
+def _command_line_edit(line, calendar, interactive=True, objs_by_uid=None):
     regexp = re.compile("((?:set [^ ]*=[^ ]*)|(?:postpone (?:[0-9]+[smhdwy]|20[0-9][0-9]-[0-9][0-9]-[0-9][0-9]))|[^ ]*) (.*)$")
     line = _strip_line(line)
     if not line:
@@ -369,7 +369,7 @@ def _command_line_edit(line, calendar, interactive=True):
     splitted = regexp.match(line)
     assert splitted
     command = splitted.group(1)
-    obj = _get_obj_from_line(splitted.group(2), calendar)
+    obj = _get_obj_from_line(splitted.group(2), calendar, objs_by_uid)
     assert obj
     command_edit(obj, command, interactive)
 
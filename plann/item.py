@@ -0,0 +1,177 @@
+"""Compact read-only records for selected objects.
+
+A caldav object carries the raw calendar data and (once parsed) the
+full icalendar tree.  For listing, sorting and category scans only a
+handful of properties are needed.  A PlannItem holds those properties
+and a handle to the object on the server, so big selections take a
+lot less memory.
+
+A PlannItem can be used as its own icalendar component (read-only).
+The values are simplified (plain strings, and objects holding only
+the .dt of dates and durations), to save memory.
+Properties not held by the item, and any other attribute, are looked
+up on the full caldav object if it's loaded (through .object), else
+AttributeError or KeyError is raised - loading it behind the scenes
+would mean one request per item.  plann.lib._full_objects fetches the
+full objects in bulk.
+"""
+
+import datetime
+import sys
+
+## The properties held by a PlannItem, with the slot holding each
+_SLOTS = {
+    'UID': 'uid',
+    'SUMMARY': 'summary',
+    'DTSTART': 'dtstart',
+    'DUE': 'due',
+    'DTEND': 'dtend',
+    'DURATION': 'duration',
+    'PRIORITY': 'priority',
+    'STATUS': 'status',
+    'CATEGORIES': 'categories',
+    'RELATED-TO': 'related_to',
+    'RECURRENCE-ID': 'recurrence_id',
+}
+
+FIELDS = frozenset(_SLOTS)
+
+class _Time:
+    """
+    A date, timestamp or duration, with the .dt attribute plann uses
+    from the icalendar properties
+    """
+    __slots__ = ('dt',)
+
+    def __init__(self, dt):
+        self.dt = dt
+
+    def to_ical(self):
+        from icalendar import vDDDTypes
+        return vDDDTypes(self.dt).to_ical()
+
+class _Categories:
+    __slots__ = ('cats',)
+
+    def __init__(self, cats):
+        self.cats = cats
+
+    def to_ical(self):
+        return ",".join(self.cats).encode()
+
+def _compact(prop, value):
+    """
+    The icalendar property values are converted to something smaller
+    that will work the same way in plann (templates, sorting, filters)
+    """
+    if value is None:
+        return None
+    if prop in ('UID', 'SUMMARY'):
+        return str(value)
+    if prop == 'STATUS':
+        return sys.intern(str(value))
+    if prop == 'PRIORITY':
+        return int(value)
+    if prop == 'CATEGORIES':
+        return _Categories(tuple(sys.intern(str(x)) for categories in _as_list(value) for x in categories.cats))
+    if prop == 'RELATED-TO':
+        ## (the RELTYPE parameter is needed)
+        return value
+    return _Time(value.dt)
+
+def _as_list(value):
+    return value if isinstance(value, list) else [value]
+
+class PlannItem:
+    """
+    The properties in FIELDS of a calendar object, plus the calendar
+    (parent) and url of it
+    """
+    __slots__ = ('name', 'parent', 'url', '_object') + tuple(_SLOTS.values())
+
+    def __init__(self, component, parent=None, url=None):
+        self.name = component.name
+        self.parent = parent
+        self.url = None if url is None else str(url)
+        self._object = None
+        for prop, slot in _SLOTS.items():
+            setattr(self, slot, _compact(prop, component.get(prop)))
+
+    @classmethod
+    def from_object(cls, obj):
+        return cls(obj.icalendar_component, obj.parent, obj.url)
+
+    def __repr__(self):
+        return f"PlannItem({self.name}, {self.uid})"
+
+    @property
+    def object(self):
+        """
+        The full caldav object, loaded when first needed
+        """
+        if self._object is None:
+            import caldav
+            objclass = {'VEVENT': caldav.Event, 'VTODO': caldav.Todo, 'VJOURNAL': caldav.Journal}.get(self.name, caldav.CalendarObjectResource)
+            self._object = objclass(client=self.parent.client, url=self.url, parent=self.parent).load()
+        return self._object
+
+    def __getattr__(self, attr):
+        ## (only called for attributes not found on the item)
+        if attr.startswith('_') or self._object is None:
+            raise AttributeError(f"{attr} is not held by the compact item {self.uid}, the full object is not loaded")
+        return getattr(self._object, attr)
+
+    @property
+    def icalendar_component(self):
+        return self
+
+    def get(self, key, default=None):
+        slot = _SLOTS.get(key.upper())
+        if slot is None:
+            if self._object is None:
+                raise KeyError(f"{key} is not held by the compact item {self.uid}, the full object is not loaded")
+            return self._object.icalendar_component.get(key, default)
+        value = getattr(self, slot)
+        return default if value is None else value
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def keys(self):
+        return [x for x in _SLOTS if getattr(self, _SLOTS[x]) is not None]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    ## Like the caldav methods, without loading the object
+
+    def get_due(self):
+        end = self.due or self.dtend
+        if end is not None:
+            return end.dt
+        if self.dtstart is not None and self.duration is not None:
+            return self.dtstart.dt + self.duration.dt
+        return None
+
+    get_dtend = get_due
+
+    def get_duration(self):
+        if self.duration is not None:
+            return self.duration.dt
+        end = self.due if self.name == 'VTODO' else self.dtend
+        if self.dtstart is None:
+            return datetime.timedelta(0)
+        if end is None:
+            ## (caldav gives one day for anything without an end)
+            return datetime.timedelta(days=1)
+        start, end = self.dtstart.dt, end.dt
+        if isinstance(end, datetime.datetime) != isinstance(start, datetime.datetime):
+            start = datetime.datetime(start.year, start.month, start.day)
+            end = datetime.datetime(end.year, end.month, end.day)
+        return end - start
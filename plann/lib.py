@@ -9,25 +9,73 @@ TODO: Sort all this mess.  Split out things that are interactive?
 """
 
 import datetime
-import caldav
 import logging
 import subprocess
+import threading
 from collections import defaultdict
+from collections.abc import Sequence
+from concurrent.futures import ThreadPoolExecutor
 from plann.template import Template
+from plann.item import PlannItem, FIELDS as ITEM_FIELDS
+from plann.scan import scan, scan_object
+from plann.cache import discovery_key
+from plann.probe import known_capability
+from plann.filters import compile_filter, _as_list
 from plann.timespec import tz, _now, _ensure_ts, parse_dt, parse_add_dur, parse_timespec
-import icalendar
 import click ## TODO - this should be removed, eventually
 
+## caldav, icalendar and their dependencies are slow to import, and
+## are imported only when needed to keep the startup of plann fast.
+
 ## TODO: maybe find those attributes through the icalendar library? icalendar.cal.singletons, icalendar.cal.multiple, etc
 attr_txt_one = ['location', 'description', 'geo', 'organizer', 'summary', 'class', 'rrule', 'status']
 attr_txt_many = ['category', 'comment', 'contact', 'resources', 'parent', 'child'] ## category is an odd-ball, it should be categories - but we need a lot more test code before we can change that.
 attr_time = ['dtstamp', 'dtstart', 'due', 'dtend', 'duration']
 attr_int = ['priority']
 
+## Default upper bound on the number of concurrent requests towards the
+## caldav server(s) (config sections being discovered, calendars being
+## searched)
+DEFAULT_JOBS = 8
+
+## Per-process registry of DAV clients and principals.  Config sections
+## pointing to the same server with the same credentials will share one
+## keep-alive HTTP session and one principal object.
+_clients = {}
+_clients_lock = threading.Lock()
+
+## Per-run map from UID to the calendars known to hold an object with
+## that UID (as a dict from calendar URL to calendar).  It's filled in
+## by searches, uid lookups and saves, later lookups of the same UID
+## will ask the calendars known to hold it first.  It's cleared for
+## each command (see _reset_uid_maps).
+_uid_calendars = defaultdict(dict)
+
+## Per-run map from UID to the URL, etag, data (as fetched) and
+## calendar of the last fetched object with that UID, for objects
+## where the etag is known.  Such objects can be revalidated through a
+## conditional GET rather than being fetched again.  Cleared for each
+## command too.
+_known_objects = {}
+
+## Per-run map from calendar URL to the calendar name, so that the
+## display name is fetched at most once per calendar when listing
+## with {calendar_name} in the template.
+_calendar_names = {}
+
+## The maps above (and the counters below) may be updated from the
+## threads of _fan_out
+_uid_maps_lock = threading.Lock()
+
+## Counters for reloads done through _reload, and how many of them the
+## server answered with "304 Not Modified"
+reload_stats = {'reloads': 0, 'not_modified': 0}
+
 def _split_vcal(ical):
     """
     This method will take an ical string containing one VCALENDAR with multiple calendar resource objects and split it into one VCALENDAR per calendar resource object.
     """
+    import icalendar
     ical_cal = icalendar.Calendar.from_ical(ical)
     split_by_uid = {}
     
@@ -56,15 +104,76 @@ def _split_vcals(ical):
     This method will take a string with multiple VCALENDAR entries and
     split it into a list
     """
-    ical = ical.strip()
-    icals = []
-    while ical.startswith("BEGIN:VCALENDAR\n"):
-        pos = ical.find("\nEND:VCALENDAR") + 14
-        icals.append(ical[:pos])
-        ical = ical[pos:].lstrip()
-    return icals
+    return list(_read_vcals(ical.splitlines(keepends=True)))
 
-def find_calendars(args, raise_errors):
+def _read_vcals(lines):
+    """
+    Generator taking ical data line by line (i.e. a file), and yielding
+    one string per VCALENDAR as soon as it's complete
+    """
+    vcal = None
+    for line in lines:
+        if vcal is None:
+            if line.startswith('BEGIN:VCALENDAR'):
+                vcal = [line]
+            continue
+        vcal.append(line)
+        if line.startswith('END:VCALENDAR'):
+            yield "".join(vcal).rstrip()
+            vcal = None
+
+def _save_raw(calendar, ical):
+    """
+    Saves ical data holding one calendar object to the calendar as it
+    is, without parsing it (calendar.save_event parses the data, and
+    may modify it).  The URL is made from the UID (found through
+    plann.scan) the same way as the caldav library does it.  Data
+    without UID is given to save_event.
+    """
+    from urllib.parse import quote
+    import caldav
+    uid = scan(ical, ['UID'])[1].get('UID')
+    if not uid:
+        return calendar.save_event(ical)
+    url = calendar.url.join(quote(uid.replace("/", "%2F")) + ".ics")
+    response = calendar.client.put(url, ical, {"Content-Type": 'text/calendar; charset="utf-8"'})
+    ## (like in caldav, a redirect is accepted)
+    if response.status not in (201, 204, 302):
+        raise caldav.error.PutError(f"{url}: {response.status} {response.reason}")
+    with _uid_maps_lock:
+        _uid_calendars[uid][str(calendar.url)] = calendar
+
+def _add_ical_lines(ical, lines):
+    """
+    Adds the lines (a string, possibly several lines) at the end of
+    each calendar component in the ical data, without parsing it.
+    VTIMEZONEs, subcomponents (like VALARM) and the VCALENDAR itself
+    are left as they are.  The line endings of the data are kept.
+    """
+    newline = '\r\n' if '\r\n' in ical else '\n'
+    lines = ''.join(x + newline for x in lines.splitlines() if x)
+    ret = []
+    depth = 0
+    name = None
+    for line in ical.splitlines(keepends=True):
+        prop = line.strip().upper()
+        if prop.startswith('BEGIN:'):
+            depth += 1
+            if depth == 2:
+                name = prop[len('BEGIN:'):]
+        elif prop.startswith('END:'):
+            if depth == 2 and name != 'VTIMEZONE':
+                ret.append(lines)
+            depth -= 1
+        ret.append(line)
+    return ''.join(ret)
+
+def find_calendars(args, raise_errors, cache=None):
+    """
+    Finds the calendars given by one set of connection arguments
+    (typically from one config section).  If a DiscoveryCache is
+    given, a fresh cache entry is used instead of asking the server.
+    """
     def list_(obj):
         """
         For backward compatibility, a string rather than a list can be given as
@@ -76,12 +185,15 @@ def find_calendars(args, raise_errors):
             obj = [ obj ]
         return obj
 
+    failed = False
     def _try(meth, kwargs, errmsg):
+        nonlocal failed
         try:
             ret = meth(**kwargs)
             assert(ret)
             return ret
         except:
+            failed = True
             logging.error("Problems fetching calendar information: %s - skipping" % errmsg)
             if raise_errors:
                 raise
@@ -108,26 +220,51 @@ def find_calendars(args, raise_errors):
     if 'caldav_url' in conn_params:
         conn_params['url'] = conn_params.pop('caldav_url')
     if conn_params:
-        client = caldav.DAVClient(**conn_params)
-        principal = _try(client.principal, {}, conn_params['url'])
+        client = _get_client(conn_params)
+        cache_key = cache and discovery_key(conn_params['url'], args)
+        cached = cache and cache.get(cache_key)
+        if cached:
+            calendars = [_cached_calendar(client, x) for x in cached]
+            if extra_params:
+                for cal in calendars:
+                    cal.extra_params = extra_params
+            return calendars
+        principal = _try(_get_principal, {'client': client}, conn_params['url'])
         if not principal:
             return []
         calendars = []
         tries = 0
-        for calendar_url in list_(args.get('calendar_url')):
+        calendar_urls = list_(args.get('calendar_url'))
+        ## With several calendar urls configured, one Depth:1 PROPFIND on the
+        ## calendar home is cheaper than one PROPFIND per calendar
+        home_calendars = {}
+        if len(calendar_urls) > 1:
+            try:
+                home_calendars = _calendar_home_listing(principal)
+            except Exception:
+                logging.info("Could not list the calendar home at %s - validating calendars one by one" % conn_params['url'], exc_info=True)
+        for calendar_url in calendar_urls:
             if '/' in calendar_url:
                 calendar = principal.calendar(cal_url=calendar_url)
             else:
                 calendar = principal.calendar(cal_id=calendar_url)
             tries += 1
-            if _try(calendar.get_display_name, {}, calendar.url):
+            listed = home_calendars.get(_url_key(calendar.url))
+            if listed is not None:
+                calendar.name = listed['name']
                 calendars.append(calendar)
+            else:
+                calendar.name = _try(calendar.get_display_name, {}, calendar.url)
+                if calendar.name:
+                    calendars.append(calendar)
         for calendar_name in list_(args.get('calendar_name')):
             tries += 1
             calendar = _try(principal.calendar, {'name': calendar_name}, '%s : calendar "%s"' % (conn_params['url'], calendar_name))
             calendars.append(calendar)
         if not calendars and tries == 0:
             calendars = _try(principal.calendars, {}, "conn_params['url'] - all calendars")
+        if cache and calendars and not failed:
+            cache.put(cache_key, _calendar_cache_entries(principal, calendars, home_calendars))
 
     if extra_params:
         for cal in calendars:
@@ -135,6 +272,485 @@ def find_calendars(args, raise_errors):
 
     return calendars or []
 
+def find_all_calendars(args_list, raise_errors, jobs=DEFAULT_JOBS, cache=None):
+    """
+    Runs find_calendars over a list of connection argument dicts
+    (typically one per config section), up to `jobs` of them
+    concurrently.  The calendars are returned in the same order as
+    the argument list, as if find_calendars had been run sequentially.
+    """
+    args_list = list(args_list)
+    if len(args_list) < 2 or jobs < 2:
+        results = [find_calendars(args, raise_errors, cache) for args in args_list]
+    else:
+        with ThreadPoolExecutor(max_workers=min(jobs, len(args_list))) as pool:
+            results = list(pool.map(lambda args: find_calendars(args, raise_errors, cache), args_list))
+    if cache:
+        cache.save()
+    calendars = []
+    for result in results:
+        calendars.extend(result)
+    return calendars
+
+class CalendarList(Sequence):
+    """
+    A lazy, read-only list of calendars.  No server communication is
+    done until the calendars are accessed.  Looking up calendars by
+    index or checking if there are any calendars at all will only
+    discover as many config sections as needed; iterating or taking
+    the length will discover all remaining sections concurrently.
+    """
+    def __init__(self, args_list, raise_errors, jobs=DEFAULT_JOBS, cache=None):
+        self._pending = list(args_list)
+        self._calendars = []
+        self.raise_errors = raise_errors
+        self.jobs = jobs
+        self.cache = cache
+
+    def _resolve_next(self):
+        args = self._pending.pop(0)
+        self._calendars.extend(find_all_calendars([args], self.raise_errors, self.jobs, self.cache))
+
+    def _resolve_all(self):
+        if self._pending:
+            pending = self._pending
+            self._pending = []
+            self._calendars.extend(find_all_calendars(pending, self.raise_errors, self.jobs, self.cache))
+
+    def __getitem__(self, i):
+        if isinstance(i, int) and i >= 0:
+            while len(self._calendars) <= i and self._pending:
+                self._resolve_next()
+        else:
+            self._resolve_all()
+        return self._calendars[i]
+
+    def __bool__(self):
+        while not self._calendars and self._pending:
+            self._resolve_next()
+        return bool(self._calendars)
+
+    def __len__(self):
+        self._resolve_all()
+        return len(self._calendars)
+
+    def __iter__(self):
+        self._resolve_all()
+        return iter(self._calendars)
+
+def _client_key(conn_params):
+    return tuple(sorted((k, repr(v)) for k, v in conn_params.items()))
+
+def _get_client(conn_params):
+    """
+    Returns a DAVClient for the connection parameters, reusing the
+    client from the registry if one has been made before
+    """
+    import caldav
+    key = _client_key(conn_params)
+    with _clients_lock:
+        if key not in _clients:
+            _clients[key] = {'client': caldav.DAVClient(**conn_params), 'principal': None, 'lock': threading.Lock()}
+        return _clients[key]['client']
+
+def _get_principal(client):
+    """
+    Returns the principal for a client from the registry.  The
+    principal is only looked up once per client, even if several
+    config sections are discovered concurrently.
+    """
+    with _clients_lock:
+        entry = next((x for x in _clients.values() if x['client'] is client), None)
+    if entry is None:
+        return client.principal()
+    with entry['lock']:
+        if entry['principal'] is None:
+            entry['principal'] = client.principal()
+        return entry['principal']
+
+def connection_stats():
+    """
+    Number of DAV clients, principal lookups and HTTP connections
+    actually opened in this process
+    """
+    with _clients_lock:
+        entries = list(_clients.values())
+    connections = 0
+    for entry in entries:
+        for adapter in entry['client'].session.adapters.values():
+            poolmanager = getattr(adapter, 'poolmanager', None)
+            if poolmanager is None:
+                continue
+            ## There is no public API for listing the connection pools,
+            ## but both urllib3 and urllib3-future keep them in a dict
+            ## called _container
+            for pool in list(getattr(poolmanager.pools, '_container', {}).values()):
+                connections += getattr(pool, 'num_connections', 0)
+    return {
+        'clients': len(entries),
+        'principals': len([x for x in entries if x['principal'] is not None]),
+        'connections': connections
+    }
+
+def _fan_out_pairs(calendars, func, jobs=DEFAULT_JOBS):
+    """
+    Generator running func(calendar) for every calendar, up to `jobs`
+    of them concurrently.  Yields (result, None) or (None, (calendar,
+    exception)) for each calendar, in the same order as the calendars,
+    as soon as they are ready.
+    """
+    def _run(calendar):
+        try:
+            return (func(calendar), None)
+        except Exception as e:
+            logging.error(f"Problems fetching from calendar {calendar.url}: {e}")
+            return (None, (calendar, e))
+    calendars = list(calendars)
+    if len(calendars) < 2 or jobs < 2:
+        yield from (_run(c) for c in calendars)
+        return
+    pool = ThreadPoolExecutor(max_workers=min(jobs, len(calendars)))
+    try:
+        yield from pool.map(_run, calendars)
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+def _fan_out(calendars, func, jobs=DEFAULT_JOBS):
+    """
+    Runs func(calendar) for every calendar, up to `jobs` of them
+    concurrently.  Returns a list of results in the same order as
+    the calendars, and a list of (calendar, exception) for the
+    calendars where func raised an exception (the result will be
+    None for those).
+    """
+    results = list(_fan_out_pairs(calendars, func, jobs))
+    return [x[0] for x in results], [x[1] for x in results if x[1]]
+
+def _fan_out_iter(calendars, func, jobs=DEFAULT_JOBS, errors=None):
+    """
+    Like _fan_out, but a generator yielding the results in the same
+    order as the calendars as soon as they are ready.  The failing
+    calendars are appended to errors (if given), and skipped.
+    """
+    for result, error in _fan_out_pairs(calendars, func, jobs):
+        if error:
+            if errors is not None:
+                errors.append(error)
+            continue
+        yield result
+
+def _search(calendar, profile=None, **kwargs):
+    """
+    calendar.search, except that filters the server is known not to
+    support (according to the capability profile, see plann.probe)
+    are done client side
+    """
+    if not profile:
+        return calendar.search(**kwargs)
+    server_kwargs = dict(kwargs)
+    client_filters = {}
+    for attr in kwargs:
+        if attr.startswith('no_'):
+            capability = 'is-not-defined'
+        elif attr in attr_txt_one + attr_txt_many + ['categories']:
+            capability = 'text-match'
+        else:
+            continue
+        if profile.get(capability) is False:
+            client_filters[attr] = server_kwargs.pop(attr)
+    expand = False
+    if kwargs.get('todo') and ('start' in kwargs or 'end' in kwargs) and profile.get('time-range-todo') is False:
+        client_filters['start'] = server_kwargs.pop('start', None)
+        client_filters['end'] = server_kwargs.pop('end', None)
+        expand = server_kwargs.pop('expand', False)
+    elif server_kwargs.get('expand') and profile.get('expand') is False:
+        server_kwargs['expand'] = 'client'
+    if not client_filters:
+        return calendar.search(**server_kwargs)
+    predicate = compile_filter(**client_filters)
+    ret = []
+    for obj in filter(predicate, calendar.search(**server_kwargs)):
+        if expand and any(x in obj.icalendar_component for x in ('RRULE', 'RDATE', 'EXRULE', 'EXDATE')):
+            obj.expand_rrule(client_filters['start'], client_filters['end'], include_completed=kwargs.get('include_completed', False))
+            ret.extend(obj.split_expanded())
+        else:
+            ret.append(obj)
+    return ret
+
+def _register_uids(objs):
+    """
+    Records the calendars of the objects in the uid map
+    """
+    found = []
+    for obj in objs:
+        calendar = getattr(obj, 'parent', None)
+        ## (the uid of an object that isn't loaded is not known
+        ## without fetching it)
+        if calendar is None or _unloaded(obj):
+            continue
+        uid = _icalendar_component(obj).get('UID')
+        if uid:
+            found.append((str(uid), calendar))
+    with _uid_maps_lock:
+        for uid, calendar in found:
+            _uid_calendars[uid][str(calendar.url)] = calendar
+
+def _unloaded(obj):
+    """
+    True for a caldav object without data (like the ones from
+    calendar.objects())
+    """
+    import caldav
+    return isinstance(obj, caldav.CalendarObjectResource) and not (obj._data or obj._icalendar_instance or obj._vobject_instance)
+
+def _reset_uid_maps():
+    """
+    Forgets the calendars and objects found so far (done for each
+    command, see plann.cli)
+    """
+    with _uid_maps_lock:
+        _uid_calendars.clear()
+        _known_objects.clear()
+
+def _may_hold(calendar, uid):
+    """
+    False if the uid is known to be in some other calendar(s)
+    """
+    known = _uid_calendars.get(uid)
+    return not known or str(calendar.url) in known
+
+def _objects_by_uids(calendar, uids, comp_filter=None):
+    """
+    Looks up several uids in one calendar, returns a dict from uid
+    to object.
+
+    Most clients (including plann and the caldav library) stores the
+    object at <uid>.ics, so one calendar-multiget on those URLs will
+    usually find all the objects in one request.  The remaining uids
+    are searched for one by one.
+    """
+    import caldav
+    from urllib.parse import quote
+    found = {}
+    uids = [str(x) for x in uids]
+    if not uids:
+        return found
+    hrefs = [calendar.url.join(quote(uid.replace('/', '%2F')) + '.ics') for uid in uids]
+    try:
+        if known_capability(calendar, 'multiget') is not False:
+            for obj in _multiget(calendar, hrefs):
+                comp = obj.icalendar_component
+                uid = str(comp.get('UID'))
+                if uid in uids and (not comp_filter or comp.name == comp_filter):
+                    found[uid] = obj
+    except caldav.error.DAVError:
+        logging.info(f"calendar-multiget failed on {calendar.url}, searching for the uids one by one", exc_info=True)
+    for uid in uids:
+        if uid in found:
+            continue
+        try:
+            found[uid] = calendar.object_by_uid(uid, comp_filter=comp_filter)
+        except caldav.error.NotFoundError:
+            pass
+    _register_uids(found.values())
+    _remember_objects(found.values())
+    return found
+
+def _multiget(calendar, hrefs):
+    """
+    Like calendar.multiget, but asks for the etags as well, so the
+    objects may be revalidated later (see _reload)
+    """
+    import caldav
+    from lxml import etree
+    from caldav.elements import dav, cdav
+    root = cdav.CalendarMultiGet() + [dav.Prop() + [dav.GetEtag(), cdav.CalendarData()]] + [dav.Href(value=x.path) for x in hrefs]
+    body = etree.tostring(root.xmlelement(), encoding="utf-8", xml_declaration=True)
+    response = calendar.client.report(str(calendar.url), body, 1)
+    if response.status >= 400:
+        raise caldav.error.ReportError(f"{response.status} {response.reason}")
+    ret = []
+    for href, props in response.find_objects_and_props().items():
+        data = props.get(cdav.CalendarData.tag)
+        if data is None or not data.text:
+            continue
+        obj = calendar._calendar_comp_class_by_data(data.text)(calendar.client, url=calendar.url.join(href), data=data.text, parent=calendar)
+        etag = props.get(dav.GetEtag.tag)
+        if etag is not None and etag.text:
+            obj.props[dav.GetEtag.tag] = etag.text
+        ret.append(obj)
+    return ret
+
+def _remember_objects(objs):
+    """
+    Records the data of objects with a known etag in the
+    _known_objects map, as it was fetched
+    """
+    from caldav.elements import dav
+    for obj in objs:
+        etag = obj.props.get(dav.GetEtag.tag)
+        if etag:
+            known = (str(obj.url), etag, obj.data, obj.parent)
+            with _uid_maps_lock:
+                _known_objects[str(_icalendar_component(obj)['UID'])] = known
+
+def _reload(obj):
+    """
+    Reloads obj from the server, discarding local modifications.  If
+    the etag is known, a conditional GET (If-None-Match) is sent, and
+    if the object is unchanged on the server the data as it was
+    fetched is taken from the _known_objects map.
+    """
+    from caldav.elements import dav
+    from caldav.lib import vcal
+    import caldav
+    with _uid_maps_lock:
+        reload_stats['reloads'] += 1
+    etag = obj.props.get(dav.GetEtag.tag)
+    known = None
+    if etag:
+        uid = scan_object(obj, ['UID'])[1].get('UID')
+        known = _known_objects.get(uid)
+    if not known or known[:2] != (str(obj.url), etag):
+        obj.load()
+        _remember_objects([obj])
+        return obj
+    response = obj.client.request(str(obj.url), 'GET', '', {'If-None-Match': etag})
+    if response.status == 304:
+        with _uid_maps_lock:
+            reload_stats['not_modified'] += 1
+        obj.data = known[2]
+        return obj
+    if response.status == 404:
+        raise caldav.error.NotFoundError(f"{obj.url} not found")
+    if response.status >= 400:
+        ## The server may not like the header, try a plain GET
+        obj.props.pop(dav.GetEtag.tag)
+        obj.load()
+    else:
+        obj.data = vcal.fix(response.raw)
+        if 'Etag' in response.headers:
+            obj.props[dav.GetEtag.tag] = response.headers['Etag']
+        else:
+            obj.props.pop(dav.GetEtag.tag)
+    _remember_objects([obj])
+    return obj
+
+def _object_by_uid(uid, calendar):
+    """
+    Fetches the object with the given uid from the calendar(s) known
+    to hold it, or else from the given calendar.  Raises NotFoundError
+    if it's not found.
+    """
+    import caldav
+    from caldav.elements import dav
+    uid = str(uid)
+    if uid in _known_objects:
+        ## A new object is made from the data as it was fetched, and
+        ## revalidated
+        url, etag, data, parent = _known_objects[uid]
+        obj = parent._calendar_comp_class_by_data(data)(parent.client, url=url, data=data, parent=parent)
+        obj.props[dav.GetEtag.tag] = etag
+        try:
+            return _reload(obj)
+        except caldav.error.NotFoundError:
+            _known_objects.pop(uid, None)
+    ## (the uid map may be stale, so the given calendar is asked too)
+    calendars = list(_uid_calendars.get(uid, {}).values())
+    if not str(calendar.url) in _uid_calendars.get(uid, {}):
+        calendars.append(calendar)
+    for cal in calendars:
+        found = _objects_by_uids(cal, [uid])
+        if uid in found:
+            return found[uid]
+    raise caldav.error.NotFoundError(f"uid {uid} not found")
+
+def _refetch_objects(objs, jobs=DEFAULT_JOBS):
+    """
+    Fetches fresh copies of the objects, one bulk lookup per
+    calendar.  Returns a dict from uid to object.
+    """
+    _register_uids(objs)
+    calendars = {}
+    uids = defaultdict(list)
+    for obj in objs:
+        calendar = obj.parent
+        calendars[str(calendar.url)] = calendar
+        uids[str(calendar.url)].append(str(_icalendar_component(obj)['UID']))
+    results, errors = _fan_out(calendars.values(), lambda c: _objects_by_uids(c, uids[str(c.url)]), jobs)
+    ret = {}
+    for found in results:
+        if found:
+            for uid in found:
+                ret.setdefault(uid, found[uid])
+    return ret
+
+def _url_key(url):
+    """
+    Normalized string representation of an URL, for comparing URLs
+    that may differ in quoting, port number or trailing slash
+    """
+    from caldav.lib.url import URL
+    return str(URL.objectify(url).canonical().strip_trailing_slash())
+
+def _calendar_home_listing(principal):
+    """
+    Does one Depth:1 PROPFIND on the calendar home of the principal,
+    returns a dict from normalized calendar URL to a dict with the
+    display name and the supported component types of the calendar.
+    """
+    from caldav.elements import dav, cdav
+    home = principal.calendar_home_set
+    props = [dav.DisplayName(), dav.ResourceType(), cdav.SupportedCalendarComponentSet()]
+    response = home.get_properties(props, depth=1, parse_response_xml=False)
+    ret = {}
+    for path, found in response.find_objects_and_props().items():
+        resource_type = found.get(dav.ResourceType.tag)
+        if resource_type is None or resource_type.find(cdav.Calendar.tag) is None:
+            continue
+        name = found.get(dav.DisplayName.tag)
+        components = found.get(cdav.SupportedCalendarComponentSet.tag)
+        ret[_url_key(home.url.join(path))] = {
+            'name': name.text if name is not None else None,
+            'components': [x.get('name') for x in components] if components is not None else None
+        }
+    return ret
+
+def _calendar_cache_entries(principal, calendars, home_calendars):
+    """
+    Serializable representation of discovered calendars, for the
+    discovery cache.  The supported components are taken from the
+    calendar home listing, which is fetched if it wasn't already.
+    """
+    if not home_calendars:
+        try:
+            home_calendars = _calendar_home_listing(principal)
+        except Exception:
+            logging.info("Could not list the calendar home - not caching supported components", exc_info=True)
+    ret = []
+    for cal in calendars:
+        listed = home_calendars.get(_url_key(cal.url), {})
+        ret.append({
+            'url': str(cal.url),
+            'name': cal.name or listed.get('name'),
+            'components': listed.get('components')
+        })
+    return ret
+
+def _cached_calendar(client, entry):
+    """
+    Creates a calendar object from a discovery cache entry, without
+    talking to the server
+    """
+    import caldav
+    calendar = caldav.Calendar(client=client, url=entry['url'], name=entry['name'])
+    if entry.get('components') is not None:
+        ## Answer get_supported_components from the cache rather
+        ## than doing a PROPFIND
+        components = list(entry['components'])
+        calendar.get_supported_components = lambda: components
+    return calendar
+
 def _icalendar_component(obj):
     try:
         return obj.icalendar_component
@@ -327,7 +943,7 @@ def _remove_reverse_relations(obj, removed_rels):
     """
     for reltype in removed_rels:
         for uid in removed_rels[reltype]:
-            rev_obj = obj.parent.object_by_uid(uid)
+            rev_obj = _object_by_uid(uid, obj.parent)
             rels = rev_obj.get_relatives(fetch_objects=False)
             backreltypes = rels.keys()
             ## TODO: should only consider the reverse relationship - check reltype attribute
@@ -362,36 +978,122 @@ def _adjust_relations(parent, children):
         parent.save()
         _remove_reverse_relations(parent, pmutated['removed'])
 
-## TODO: As for now, this one will throw the user into the python debugger if inconsistencies are found.
-## It for sure cannot be like that when releasing plann 1.0!
-def _relships_by_type(obj, reltype_wanted=None):
-    backreltypes = {'CHILD': 'PARENT', 'PARENT': 'CHILD', 'undefined': 'CHILD', 'SIBLING': 'SIBLING'}
-    rels_by_type = obj.get_relatives(reltype_wanted)
-    ret = defaultdict(list)
-    for reltype in rels_by_type:
-        for other in rels_by_type[reltype]:
-            ret[reltype].append(other)
-            
-            ## Consistency check ... TODO ... look more into breakages
-            ## TODO: make functionality for scanning through all relationships in the calendar
-            other_rels = other.get_relatives(fetch_objects=False)
-            back_rel_types = set()
-            for back_rel_type in other_rels:
-                if str(obj.icalendar_component['UID']) in other_rels[back_rel_type]:
-                    back_rel_types.add(back_rel_type)
-
-            if len(back_rel_types) > 1:
-                logging.error(f"Inconsistency issue in relationships - has to be manually resolved (UID={obj.icalendar_component_UID}, backrels: {back_rel_types})")
-                ## Inconsistency has to be manually fixed: more than one related-to property pointing from other to obj
-            if len(back_rel_types) == 0:
-                logging.error(f"Inconsistency issue in relationships - will be automatically fixed: no related-to property pointing from other to obj")
-                ## adding the missing back rel
-                other.icalendar_component.add('RELATED-TO', str(obj.icalendar_component['UID']), parameters={'RELTYPE': backreltypes[reltype]})
-                other.save()
-            else:
-                if back_rel_types != { backreltypes[reltype] }:
+class RelationIndex:
+    """
+    The relations between the objects in a selection, parsed from the
+    RELATED-TO properties of all the objects in one pass and kept as a
+    graph of uids.  Related objects not in the selection can be
+    fetched in bulk through fetch() and fetch_family().
+    """
+    def __init__(self, objs=()):
+        self.objs_by_uid = {}
+        self.relations = {}
+        self.add(objs)
+
+    def add(self, objs):
+        for obj in objs:
+            comp = _icalendar_component(obj)
+            uid = str(comp['UID'])
+            self.objs_by_uid.setdefault(uid, obj)
+            if uid in self.relations:
+                continue
+            ## (dicts rather than sets, to keep the order of the
+            ## RELATED-TO properties)
+            rels = defaultdict(dict)
+            for rel in _as_list(comp.get('RELATED-TO')):
+                rels[rel.params.get('RELTYPE', 'PARENT')][str(rel)] = None
+            self.relations[uid] = rels
+
+    def related(self, obj, reltypes):
+        """
+        The uids related to obj through any of the reltypes
+        """
+        rels = self.relations.get(str(_icalendar_component(obj)['UID']), {})
+        return set().union(*(rels[x] for x in rels if x in reltypes))
+
+    def related_objects(self, obj, reltype):
+        """
+        The objects related to obj through reltype, in the order of
+        the RELATED-TO properties.  Objects that are not in the index
+        (see fetch_family) are left out.
+        """
+        rels = self.relations.get(str(_icalendar_component(obj)['UID']), {})
+        return [self.objs_by_uid[x] for x in rels.get(reltype, ()) if x in self.objs_by_uid]
+
+    def has(self, obj, reltypes):
+        rels = self.relations.get(str(_icalendar_component(obj)['UID']), {})
+        return any(rels[x] for x in rels if x in reltypes)
+
+    def fetch(self, objs, reltypes, jobs=DEFAULT_JOBS):
+        """
+        Returns a dict from uid to object for everything related to the
+        objs through the reltypes.  Objects not in the selection are
+        fetched through one bulk lookup per calendar.
+        """
+        ret = {}
+        calendars = {}
+        missing = defaultdict(set)
+        for obj in objs:
+            for uid in self.related(obj, reltypes):
+                if uid in self.objs_by_uid:
+                    ret[uid] = self.objs_by_uid[uid]
+                    continue
+                for calendar in list(_uid_calendars.get(uid, {}).values()) or [obj.parent]:
+                    calendars[str(calendar.url)] = calendar
+                    missing[str(calendar.url)].add(uid)
+        results, errors = _fan_out(calendars.values(), lambda c: _objects_by_uids(c, missing[str(c.url)]), jobs)
+        for found in results:
+            for uid in found or {}:
+                ret.setdefault(uid, found[uid])
+        return ret
+
+    def fetch_family(self, reltypes=('PARENT', 'CHILD', 'SIBLING'), jobs=DEFAULT_JOBS):
+        """
+        Adds all (grand)*relatives of the objects in the index through
+        the reltypes, one generation at a time.  Each generation is
+        fetched through one bulk lookup per calendar.
+        """
+        generation = list(self.objs_by_uid.values())
+        tried = set(self.objs_by_uid)
+        while generation:
+            wanted = set().union(*(self.related(x, reltypes) for x in generation)) - tried
+            tried |= wanted
+            if not wanted:
+                break
+            ## Only the objects with relations not yet in the index
+            found = self.fetch([x for x in generation if self.related(x, reltypes) & wanted], reltypes, jobs)
+            generation = [found[x] for x in found if x in wanted and not x in self.objs_by_uid]
+            self.add(generation)
+        _register_uids(self.objs_by_uid.values())
+
+_backreltypes = {'CHILD': 'PARENT', 'PARENT': 'CHILD', 'SIBLING': 'SIBLING'}
+
+def _check_relations(relations, repair=False):
+    """
+    Checks that every relation in the RelationIndex has a reverse
+    relation.  The problems found are logged.  With repair, missing
+    reverse relations are added (and the objects are saved).
+    """
+    for uid in list(relations.relations):
+        obj = relations.objs_by_uid[uid]
+        for reltype in relations.relations[uid]:
+            for other in relations.related_objects(obj, reltype):
+                other_rels = relations.relations[str(_icalendar_component(other)['UID'])]
+                back_rel_types = {x for x in other_rels if uid in other_rels[x]}
+                if len(back_rel_types) > 1:
+                    logging.error(f"Inconsistency issue in relationships - has to be manually resolved (UID={uid}, backrels: {back_rel_types})")
+                    ## Inconsistency has to be manually fixed: more than one related-to property pointing from other to obj
+                elif not back_rel_types:
+                    if not repair or not reltype in _backreltypes:
+                        logging.error(f"Inconsistency issue in relationships - run with repair to fix: no related-to property pointing from other to obj (UID={uid})")
+                        continue
+                    logging.error(f"Inconsistency issue in relationships - will be automatically fixed: no related-to property pointing from other to obj (UID={uid})")
+                    ## adding the missing back rel
+                    other.icalendar_component.add('RELATED-TO', uid, parameters={'RELTYPE': _backreltypes[reltype]})
+                    other.save()
+                    other_rels[_backreltypes[reltype]][uid] = None
+                elif back_rel_types != { _backreltypes.get(reltype) }:
                     logging.error(f"Inconsistency issue in relationships - has to be manually resolved. Object and other points to each other, but reltype does not match")
-    return ret
 
 def _relationship_text(obj, reltype_wanted=None):
     rels = obj.get_relatives(reltypes=reltype_wanted)
@@ -452,37 +1154,257 @@ def _set_something(obj, arg, value):
         comp.add(arg, value)
 
 
+class _Reversed:
+    """
+    Wraps a sort key value, reversing the order
+    """
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+def _typed_value(value):
+    """
+    Dates and timestamps from the icalendar library can't be compared
+    directly, the underlying value is used instead
+    """
+    if hasattr(value, 'dt'):
+        value = value.dt
+        if isinstance(value, datetime.date):
+            return _ensure_ts(value)
+    return value
+
+def _sort_key(sort_keys):
+    """
+    Compiles a list of sort keys (as given through --sort-key) into
+    one key function returning a tuple, so a list can be sorted in
+    one single pass.  Each key is compiled once.  Keys starting with -
+    are reversed.  Keys containing {} are templates.  Templates are
+    still formatted into strings, so the ordering is the same as
+    sorting once per key.
+    """
+    funcs = []
+    for skey in sort_keys:
+        reverse = skey[0] == '-'
+        if reverse:
+            skey = skey[1:]
+        if '{' in skey:
+            template = Template(skey)
+            func = lambda obj, template=template: template.render(obj.icalendar_component)
+        elif skey == 'get_duration()':
+            func = lambda obj: obj.get_duration()
+        else:
+            func = lambda obj, skey=skey: _typed_value(obj.icalendar_component.get(skey))
+        if reverse:
+            func = lambda obj, func=func: _Reversed(func(obj))
+        funcs.append(func)
+    return lambda obj: tuple(func(obj) for func in funcs)
+
 ## TODO: should be rewritten a bit, we should have a create_list method that does not call on click.echo directly
 ## let the caller decide if click is to be used or not.
-## Use the yield method to avoid having to generate the full list prior to printing to screen
-def _list(objs, ics=False, template="{DTSTART:?{DUE:?(date missing)?}?%F %H:%M:%S %Z}: {SUMMARY:?{DESCRIPTION:?(no summary given)?}?}", top_down=False, bottom_up=False, indent=0, echo=True, uids=None, filter=lambda obj: obj.icalendar_component.get('STATUS', '') not in ('CANCELLED', 'COMPLETED')):
+def _list(objs, ics=False, template="{DTSTART:?{DUE:?(date missing)?}?%F %H:%M:%S %Z}: {SUMMARY:?{DESCRIPTION:?(no summary given)?}?}", top_down=False, bottom_up=False, indent=0, echo=True, uids=None, filter=compile_filter(not_status=('CANCELLED', 'COMPLETED')), repair_relations=False):
     """
-    Actual implementation of list
+    Actual implementation of list.  filter is a predicate, typically
+    made by plann.filters.compile_filter
+
+    For the top-down and bottom-up views, the relation graph of the
+    selection is fetched up front (see RelationIndex.fetch_family).
+    The relations are checked for consistency; missing reverse
+    relations are only fixed with repair_relations.
 
     TODO: will crash if there are loops in the relationships
     TODO: if there are parent/child-relationships that aren't bidrectionally linked, we may get problems
     """
-    if indent>32:
-        raise NotImplemented("too deep hierarchies, or circular links")
+    ## Compact items only hold the most used properties (see
+    ## plann.item), the full objects are fetched if more is needed
+    if _list_needs_objects(template, ics, repair_relations):
+        objs = _full_objects(objs)
     if ics:
-        if not objs:
-            return
-        icalendar = objs.pop(0).icalendar_instance
-        for obj in objs:
-            if not filter(obj):
-                continue
-            icalendar.subcomponents.extend(obj.icalendar_instance.subcomponents)
-        click.echo(icalendar.to_ical())
+        ## Written one component at a time, so the full selection is
+        ## never held as one calendar (nor as one string)
+        for chunk in _ics_chunks(objs, filter):
+            click.echo(chunk, nl=chunk.endswith(b'END:VCALENDAR\r\n'))
+        return
+    relations = None
+    if top_down or bottom_up:
+        objs = list(objs)
+        relations = RelationIndex(x for x in objs if not isinstance(x, str))
+        relations.fetch_family()
+        _check_relations(relations, repair=repair_relations)
+    lines = _list_lines(objs, template=template, top_down=top_down, bottom_up=bottom_up, indent=indent, uids=uids, filter=filter, relations=relations)
+    if echo:
+        ## The lines are given to the pager as they are made, so the
+        ## first lines may be shown before all objects are fetched
+        click.echo_via_pager(_joined_lines(lines))
         return
+    return list(lines)
+
+def _list_needs_objects(template, ics=False, repair_relations=False):
+    """
+    True if _list needs more than the compact items hold
+    """
+    return ics or repair_relations or not Template(template).fields() <= ITEM_FIELDS | {'calendar_name', 'calendar_url'}
+
+def _full_objects(objs, chunk_size=1000):
+    """
+    Generator replacing compact items (see plann.item) with the full
+    caldav objects, fetched in bulk (chunk_size items at a time).
+    Anything else is passed on as it is.
+    """
+    chunk = []
+    def flush():
+        items = [x for x in chunk if isinstance(x, PlannItem)]
+        found = {}
+        for obj in (_refetch_objects(items).values() if items else ()):
+            found[_instance_key(obj.icalendar_component)] = obj
+        for obj in chunk:
+            if isinstance(obj, PlannItem):
+                obj = found.get(_instance_key(obj), obj)
+            yield obj
+    for obj in objs:
+        chunk.append(obj)
+        if len(chunk) >= chunk_size:
+            yield from flush()
+            chunk.clear()
+    yield from flush()
+
+def _loaded_objects(objs, chunk_size=1000):
+    """
+    Generator giving the objs with the data loaded.  Objects without
+    data (like the ones from calendar.objects()) are fetched in bulk,
+    chunk_size objects at a time, through one calendar-multiget per
+    calendar rather than one GET for each object.
+    """
+    import caldav
+    chunk = []
+    def flush():
+        unloaded = defaultdict(list)
+        for obj in chunk:
+            if _unloaded(obj):
+                unloaded[str(obj.parent.url)].append(obj)
+        for objs_ in unloaded.values():
+            calendar = objs_[0].parent
+            found = {}
+            try:
+                if known_capability(calendar, 'multiget') is not False:
+                    found = {_url_key(x.url): x for x in _multiget(calendar, [x.url for x in objs_])}
+            except caldav.error.DAVError:
+                logging.info(f"calendar-multiget failed on {calendar.url}, loading the objects one by one", exc_info=True)
+            for obj in objs_:
+                fetched = found.get(_url_key(obj.url))
+                if fetched is None:
+                    obj.load()
+                else:
+                    obj.data = fetched.data
+                    obj.props.update(fetched.props)
+        yield from chunk
+    for obj in objs:
+        chunk.append(obj)
+        if len(chunk) >= chunk_size:
+            yield from flush()
+            chunk.clear()
+    yield from flush()
+
+def _instance_key(comp):
+    """
+    The uid and recurrence-id (if any) of a component.  The instances
+    of a recurring object have the same uid.
+    """
+    recurrence_id = comp.get('RECURRENCE-ID')
+    return (str(comp['UID']), recurrence_id and recurrence_id.dt)
+
+def _ics_chunks(objs, filter=None):
+    """
+    Generator for an ICS feed holding the objs, as bytes: the VCALENDAR
+    header taken from the first object, then the components of each
+    object as it comes.  A VTIMEZONE is included only the first time
+    its TZID is seen.  Nothing is yielded if there are no objs.  The
+    objects are not modified.
+    """
+    import icalendar
+    tzids = set()
+    header = False
+    for obj in objs:
+        if filter and not filter(obj):
+            continue
+        calendar = obj.icalendar_instance
+        if not header:
+            vcalendar = icalendar.Calendar()
+            for key in calendar:
+                vcalendar[key] = calendar[key]
+            ## The header is everything but the END line
+            yield vcalendar.to_ical()[:-len(b'END:VCALENDAR\r\n')]
+            header = True
+        for comp in calendar.subcomponents:
+            if comp.name == 'VTIMEZONE':
+                tzid = str(comp.get('TZID'))
+                if tzid in tzids:
+                    continue
+                tzids.add(tzid)
+            yield comp.to_ical()
+    if header:
+        yield b'END:VCALENDAR\r\n'
+
+def _joined_lines(lines):
+    """
+    Like "\\n".join(lines), but as a generator
+    """
+    first = True
+    for line in lines:
+        yield line if first else "\n" + line
+        first = False
+
+def _calendar_name(calendar):
+    url = str(calendar.url)
+    if not url in _calendar_names:
+        _calendar_names[url] = calendar.name or calendar.get_display_name()
+    return _calendar_names[url]
+
+class _ObjectFields:
+    """
+    The fields available in list templates: the properties of the
+    icalendar component, calendar_name and calendar_url.  Looked up
+    only when the template uses them.
+    """
+    __slots__ = ('obj', 'component')
+
+    def __init__(self, obj):
+        self.obj = obj
+        self.component = obj.icalendar_component
+
+    def __getitem__(self, key):
+        if key == 'calendar_name':
+            return _calendar_name(self.obj.parent)
+        if key == 'calendar_url':
+            return self.obj.parent.url
+        return self.component[key]
+
+def _list_lines(objs, template, top_down=False, bottom_up=False, indent=0, uids=None, filter=None, relations=None):
+    """
+    Generator for the lines listed by _list.  objs may be any iterable.
+    For the top-down and bottom-up views, relations is a RelationIndex
+    holding all the relatives of the objs.
+    """
+    if indent>32:
+        raise NotImplemented("too deep hierarchies, or circular links")
     if isinstance(template, str):
         template=Template(template)
-    output = []
     if uids is None:
         uids = set()
+    if (top_down or bottom_up) and relations is None:
+        objs = list(objs)
+        relations = RelationIndex(x for x in objs if not isinstance(x, str))
+        relations.fetch_family()
 
     for obj in objs:
         if isinstance(obj, str):
-            output.append(obj)
+            yield obj
             continue
 
         if not filter(obj):
@@ -497,9 +1419,8 @@ def _list(objs, ics=False, template="{DTSTART:?{DUE:?(date missing)?}?%F %H:%M:%
         above = []
         below = []
         if top_down or bottom_up:
-            relations = _relships_by_type(obj)
-            parents = relations['PARENT']
-            children = relations['CHILD']
+            parents = relations.related_objects(obj, 'PARENT')
+            children = relations.related_objects(obj, 'CHILD')
             ## in a top-down view, the (grand)*parent should be shown as a top-level item rather than the object.
             ## in a bottom-up view, the (grand)*child should be shown as a top-level item rather than the object.
             if top_down:
@@ -512,23 +1433,16 @@ def _list(objs, ics=False, template="{DTSTART:?{DUE:?(date missing)?}?%F %H:%M:%
                 above = []
         if not above:
             ## This should be a top-level thing
-            more_info = {}
-            if 'calendar_name' in template.template:
-                more_info['calendar_name'] = obj.parent.name or obj.parent.get_display_name()
-            more_info['calendar_url'] = obj.parent.url
-            output.append(" "*indent + template.format(**obj.icalendar_component, **more_info))
+            yield " "*indent + template.render(_ObjectFields(obj))
             ## Recursively add children in an indented way
-            output.extend(_list(below, template=template, top_down=top_down, bottom_up=bottom_up, indent=indent+2, echo=False, filter=filter))
+            yield from _list_lines(below, template=template, top_down=top_down, bottom_up=bottom_up, indent=indent+2, filter=filter, relations=relations)
             if indent and top_down:
                 ## Include all siblings as same-level nodes
                 ## Use the top-level uids to avoid infinite recursion
                 ## TODO: siblings are probably not being handled correctly here.  Should write test code and investigate.
-                output.extend(_list(relations['SIBLING'], template=template, top_down=top_down, bottom_up=bottom_up, indent=indent, echo=False, uids=uids, filter=filter))
+                yield from _list_lines(relations.related_objects(obj, 'SIBLING'), template=template, top_down=top_down, bottom_up=bottom_up, indent=indent, uids=uids, filter=filter, relations=relations)
         for p in above:
             ## The item should be part of a sublist.  Find and add the top-level item, and the full indented list under there - recursively.
             puid = p.icalendar_component['UID']
             if not puid in uids:
-                output.extend(_list([p], template=template, top_down=top_down, bottom_up=bottom_up, indent=indent, echo=False, uids=uids, filter=filter))
-    if echo:
-        click.echo_via_pager("\n".join(output))
-    return output
+                yield from _list_lines([p], template=template, top_down=top_down, bottom_up=bottom_up, indent=indent, uids=uids, filter=filter, relations=relations)
@@ -0,0 +1,535 @@
+"""Opt-in local mirror of the calendars.
+
+The mirror is a sqlite database (by default mirror.sqlite in the plann
+cache directory) holding the href, etag and icalendar data of every
+object in the mirrored calendars.  Once per run, before a calendar is
+used, the mirror is brought up to date through a sync-collection
+report (RFC 6578), and only the objects that have been changed are
+fetched (through calendar-multiget).  If the server does not support
+sync-collection, the ctag of the calendar and the etags of the
+objects are compared instead.
+
+Searches are then done locally through Mirror.search, which takes the
+same parameters as caldav.Calendar.search.  The component type, uid,
+DTSTART, DUE, PRIORITY, STATUS, categories and relations of every
+object are stored in indexed columns and tables, so that most of the
+filtering is done in sqlite.  The objects found are then checked
+again in python, to give exactly the same results as a search on the
+server.
+
+The mirror also holds a full text index (sqlite FTS5) over SUMMARY,
+DESCRIPTION, LOCATION and COMMENT, used by Mirror.text_search.  It's
+kept up to date together with the rest of the mirror, so only objects
+with a changed etag are indexed again.
+"""
+
+import os
+import re
+import sqlite3
+import logging
+import datetime
+import threading
+from urllib.parse import unquote
+from plann.cache import cache_dir
+from plann.timespec import _ensure_ts
+from plann.lib import parentlike, childlike
+from plann.probe import known_capability
+from plann.filters import _pending, _match_attr, _prop_text, _as_list, _in_range
+from plann.scan import scan
+
+## Number of objects fetched per calendar-multiget request
+MULTIGET_BATCH = 100
+
+## Bumped whenever the schema changes.  A mirror with another
+## version is dropped and fetched again from scratch.
+SCHEMA_VERSION = 3
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS calendars (
+    url TEXT PRIMARY KEY,
+    sync_token TEXT,
+    ctag TEXT
+);
+CREATE TABLE IF NOT EXISTS objects (
+    calendar TEXT NOT NULL,
+    href TEXT NOT NULL,
+    etag TEXT,
+    uid TEXT,
+    comp TEXT,
+    dtstart REAL,
+    due REAL,
+    priority INTEGER,
+    status TEXT,
+    completed INTEGER,
+    recurring INTEGER,
+    span_start REAL,
+    span_end REAL,
+    props TEXT,
+    data TEXT NOT NULL,
+    PRIMARY KEY (calendar, href)
+);
+CREATE INDEX IF NOT EXISTS objects_uid ON objects (uid);
+CREATE INDEX IF NOT EXISTS objects_dtstart ON objects (calendar, dtstart);
+CREATE INDEX IF NOT EXISTS objects_due ON objects (calendar, due);
+CREATE INDEX IF NOT EXISTS objects_priority ON objects (calendar, priority);
+CREATE INDEX IF NOT EXISTS objects_status ON objects (calendar, comp, status);
+CREATE TABLE IF NOT EXISTS categories (
+    calendar TEXT NOT NULL,
+    href TEXT NOT NULL,
+    category TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS categories_category ON categories (category);
+CREATE INDEX IF NOT EXISTS categories_object ON categories (calendar, href);
+CREATE TABLE IF NOT EXISTS relations (
+    calendar TEXT NOT NULL,
+    href TEXT NOT NULL,
+    reltype TEXT NOT NULL,
+    uid TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS relations_uid ON relations (uid);
+CREATE INDEX IF NOT EXISTS relations_object ON relations (calendar, href);
+"""
+
+## Full text index, token -> objects.  Diacritics are folded, so that
+## "cafe" also finds "café".
+_FULLTEXT_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS fulltext USING fts5 (
+    summary, description, location, comment,
+    calendar UNINDEXED, href UNINDEXED,
+    tokenize='unicode61 remove_diacritics 2'
+);
+"""
+
+## The properties in the full text index, and their weight when
+## ranking the results
+_FULLTEXT_PROPS = ('SUMMARY', 'DESCRIPTION', 'LOCATION', 'COMMENT')
+_FULLTEXT_WEIGHTS = (10.0, 1.0, 3.0, 1.0)
+
+## Only pending tasks, like caldav.Calendar.search(todo=True)
+_PENDING_SQL = "(status IS NULL OR (status NOT IN ('COMPLETED', 'CANCELLED') AND (status='NEEDS-ACTION' OR NOT COALESCE(completed, 0))))"
+
+## The time range prefilter in sqlite is widened by this many seconds
+## in both directions, as floating timestamps and dates are stored as
+## seen in the timezone at the time of indexing.
+_SLACK = 26*3600
+
+def _href(url):
+    """
+    The href of an object, as it's given in multistatus responses
+    """
+    from caldav.lib.url import URL
+    return unquote(URL.objectify(url).path)
+
+class Mirror:
+    """
+    Local mirror of calendars, see the module documentation
+    """
+    def __init__(self, path=None):
+        self.path = path or os.path.join(cache_dir(), 'mirror.sqlite')
+        os.makedirs(os.path.dirname(self.path), mode=0o700, exist_ok=True)
+        ## The calendars may be searched concurrently, all database
+        ## access is serialized through the lock
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._lock = threading.RLock()
+        self._synced = set()
+        self.stats = {'fetched': 0, 'deleted': 0}
+        with self._lock, self._db:
+            if self._db.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+                self._db.executescript("DROP TABLE IF EXISTS calendars; DROP TABLE IF EXISTS objects; DROP TABLE IF EXISTS categories; DROP TABLE IF EXISTS relations; DROP TABLE IF EXISTS fulltext;")
+                self._db.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+            self._db.executescript(_SCHEMA)
+            ## sqlite may be built without FTS5.  text_search then
+            ## falls back to scanning the data
+            try:
+                self._db.executescript(_FULLTEXT_SCHEMA)
+                self.fulltext = True
+            except sqlite3.OperationalError:
+                logging.info("sqlite has no FTS5 support, text search will be slow")
+                self.fulltext = False
+
+    def sync(self, calendar, force=False):
+        """
+        Brings the mirror of the calendar up to date, unless it has
+        already been done in this run
+        """
+        import caldav
+        url = str(calendar.url)
+        if url in self._synced and not force:
+            return
+        with self._lock:
+            row = self._db.execute("SELECT sync_token, ctag FROM calendars WHERE url=?", (url,)).fetchone()
+            etags = dict(self._db.execute("SELECT href, etag FROM objects WHERE calendar=?", (url,)))
+        sync_token, ctag = row or (None, None)
+        try:
+            if known_capability(calendar, 'sync-collection') is False:
+                raise caldav.error.ReportError("sync-collection is not supported")
+            try:
+                changed, deleted, new_token = self._sync_collection(calendar, sync_token)
+            except caldav.error.DAVError:
+                if not sync_token:
+                    raise
+                ## The sync token may have expired - start from scratch
+                sync_token = None
+                changed, deleted, new_token = self._sync_collection(calendar, None)
+            if not sync_token:
+                ## Without a sync token, all the objects are listed
+                deleted = set(etags) - set(changed)
+            sync_token = new_token
+        except caldav.error.DAVError:
+            logging.info(f"sync-collection failed on {url}, comparing etags instead", exc_info=True)
+            sync_token = None
+            new_ctag = self._ctag(calendar)
+            if ctag and new_ctag == ctag:
+                changed, deleted = {}, []
+            else:
+                ctag = new_ctag
+                changed = self._etags(calendar)
+                deleted = set(etags) - set(changed)
+        to_fetch = [href for href in changed if not changed[href] or changed[href] != etags.get(href)]
+        fetched = self._fetch(calendar, to_fetch)
+        with self._lock, self._db:
+            for href in deleted:
+                self._delete(url, href)
+            for href in fetched:
+                self._put(url, href, *fetched[href])
+            self._db.execute("INSERT OR REPLACE INTO calendars (url, sync_token, ctag) VALUES (?, ?, ?)", (url, sync_token, ctag))
+            self.stats['fetched'] += len(fetched)
+            self.stats['deleted'] += len(deleted)
+            self._synced.add(url)
+
+    def _report(self, calendar, root, depth=1):
+        import caldav
+        from lxml import etree
+        body = etree.tostring(root.xmlelement(), encoding="utf-8", xml_declaration=True)
+        response = calendar.client.report(str(calendar.url), body, depth)
+        if response.status >= 400:
+            raise caldav.error.ReportError(f"{response.status} {response.reason}")
+        return response
+
+    def _sync_collection(self, calendar, sync_token):
+        """
+        Does a sync-collection report.  Returns a dict from href to
+        etag for new and changed objects, a list of deleted hrefs and
+        the new sync token.
+        """
+        from caldav.elements import dav
+        root = dav.SyncCollection() + [dav.SyncToken(value=sync_token), dav.SyncLevel(value="1"), dav.Prop() + dav.GetEtag()]
+        response = self._report(calendar, root)
+        changed = {}
+        deleted = []
+        for href, props in response.find_objects_and_props().items():
+            if '404' in (response.statuses.get(href) or ''):
+                deleted.append(href)
+                continue
+            etag = props.get(dav.GetEtag.tag)
+            changed[href] = etag.text if etag is not None else None
+        return changed, deleted, response.sync_token
+
+    def _ctag(self, calendar):
+        from caldav.elements.base import ValuedBaseElement
+        class GetCTag(ValuedBaseElement):
+            tag = '{http://calendarserver.org/ns/}getctag'
+        try:
+            return calendar.get_properties([GetCTag()]).get(GetCTag.tag)
+        except Exception:
+            return None
+
+    def _etags(self, calendar):
+        """
+        Lists the etags of all the objects in the calendar through a
+        Depth:1 PROPFIND
+        """
+        from caldav.elements import dav
+        response = calendar.get_properties([dav.GetEtag()], depth=1, parse_response_xml=False)
+        cal_href = _href(calendar.url).rstrip('/')
+        ret = {}
+        for href, props in response.find_objects_and_props().items():
+            if href.rstrip('/') == cal_href or not dav.GetEtag.tag in props:
+                continue
+            ret[href] = props[dav.GetEtag.tag].text
+        return ret
+
+    def _fetch(self, calendar, hrefs):
+        """
+        Fetches objects through calendar-multiget, returns a dict from
+        href to (etag, data)
+        """
+        from caldav.elements import dav, cdav
+        ret = {}
+        for i in range(0, len(hrefs), MULTIGET_BATCH):
+            batch = [calendar.url.join(x) for x in hrefs[i:i+MULTIGET_BATCH]]
+            root = cdav.CalendarMultiGet() + [dav.Prop() + [dav.GetEtag(), cdav.CalendarData()]] + [dav.Href(value=x.path) for x in batch]
+            response = self._report(calendar, root)
+            for href, props in response.find_objects_and_props().items():
+                data = props.get(cdav.CalendarData.tag)
+                if data is None or not data.text:
+                    continue
+                etag = props.get(dav.GetEtag.tag)
+                ret[href] = (etag.text if etag is not None else None, data.text)
+        return ret
+
+    def _put(self, url, href, etag, data):
+        comp, props = scan(data, ['UID'])
+        uid = props.get('UID')
+        index = _index(data)
+        self._delete(url, href)
+        self._db.execute("INSERT INTO objects (calendar, href, etag, uid, comp, dtstart, due, priority, status, completed, recurring, span_start, span_end, props, data) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", (url, href, etag, uid, comp, *index['columns'], data))
+        self._db.executemany("INSERT INTO categories (calendar, href, category) VALUES (?, ?, ?)", [(url, href, x) for x in index['categories']])
+        self._db.executemany("INSERT INTO relations (calendar, href, reltype, uid) VALUES (?, ?, ?, ?)", [(url, href, *x) for x in index['relations']])
+        if self.fulltext and index['text']:
+            self._db.execute("INSERT INTO fulltext (summary, description, location, comment, calendar, href) VALUES (?, ?, ?, ?, ?, ?)", (*index['text'], url, href))
+
+    def _delete(self, url, href):
+        for table in ('objects', 'categories', 'relations') + (('fulltext',) if self.fulltext else ()):
+            self._db.execute(f"DELETE FROM {table} WHERE calendar=? AND href=?", (url, href))
+
+    def store(self, obj):
+        """
+        Updates the mirror after obj has been saved to the server.
+        The etag is not known, so the object will be fetched again on
+        the next sync.
+        """
+        with self._lock, self._db:
+            self._put(str(obj.parent.url), _href(obj.url), None, obj.data)
+
+    def remove(self, obj):
+        """
+        Updates the mirror after obj has been deleted from the server
+        """
+        with self._lock, self._db:
+            self._delete(str(obj.parent.url), _href(obj.url))
+
+    def _rows(self, calendar, where="", params=()):
+        self.sync(calendar)
+        with self._lock:
+            return self._db.execute(f"SELECT href, etag, comp, data FROM objects WHERE calendar=? {where} ORDER BY href", (str(calendar.url),) + tuple(params)).fetchall()
+
+    def _objects(self, calendar, rows):
+        import caldav
+        from caldav.elements import dav
+        classes = {'VEVENT': caldav.Event, 'VTODO': caldav.Todo, 'VJOURNAL': caldav.Journal}
+        ret = []
+        for href, etag, comp, data in rows:
+            obj = classes.get(comp, caldav.CalendarObjectResource)(client=calendar.client, url=calendar.url.join(href), data=data, parent=calendar)
+            if etag:
+                obj.props[dav.GetEtag.tag] = etag
+            ret.append(obj)
+        return ret
+
+    def objects(self, calendar):
+        """
+        All objects in the calendar
+        """
+        return self._objects(calendar, self._rows(calendar))
+
+    def objects_by_uids(self, calendar, uids, comp_filter=None):
+        """
+        Returns a dict from uid to object for the uids found in the
+        calendar
+        """
+        uids = [str(x) for x in uids]
+        if not uids:
+            return {}
+        where = f"AND uid IN ({','.join('?'*len(uids))})"
+        params = uids
+        if comp_filter:
+            where += " AND comp=?"
+            params = uids + [comp_filter]
+        objs = self._objects(calendar, self._rows(calendar, where, params))
+        return {str(x.icalendar_component['UID']): x for x in objs}
+
+    def search(self, calendar, todo=None, event=None, journal=None, include_completed=False, start=None, end=None, expand=False, skip_parents=None, skip_children=None, limit=None, **kwargs):
+        """
+        Local equivalent of caldav.Calendar.search.  With skip_parents
+        or skip_children, objects having children or parents are left
+        out already in the database query.  With a limit, the search
+        stops when that many objects are found.
+        """
+        where = ""
+        params = []
+        for flag, comp in ((todo, 'VTODO'), (event, 'VEVENT'), (journal, 'VJOURNAL')):
+            if flag:
+                where += " AND comp=?"
+                params.append(comp)
+            elif flag is False:
+                where += " AND comp IS NOT ?"
+                params.append(comp)
+        if todo and not include_completed:
+            where += f" AND {_PENDING_SQL}"
+        ## The time range is only a rough prefilter, the exact check is
+        ## done by _in_range below
+        if end:
+            where += " AND (recurring IS NOT 0 OR span_start IS NULL OR span_start <= ?)"
+            params.append(_ensure_ts(end).timestamp() + _SLACK)
+        if start:
+            where += " AND (recurring IS NOT 0 OR span_end IS NULL OR span_end >= ?)"
+            params.append(_ensure_ts(start).timestamp() - _SLACK)
+        for reltypes, skip in ((childlike, skip_parents), (parentlike, skip_children)):
+            if skip:
+                where += f" AND NOT EXISTS (SELECT 1 FROM relations r WHERE r.calendar=objects.calendar AND r.href=objects.href AND r.reltype IN ({','.join('?'*len(reltypes))}))"
+                params.extend(sorted(reltypes))
+        for attr in kwargs:
+            cond, cond_params = _attr_condition(attr, kwargs[attr])
+            if cond:
+                where += f" AND {cond}"
+                params.extend(cond_params)
+        ret = []
+        for obj in self._objects(calendar, self._rows(calendar, where, params)):
+            if limit is not None and len(ret) >= limit:
+                break
+            comp = obj.icalendar_component
+            if todo and not include_completed and not _pending(comp):
+                continue
+            if not all(_match_attr(comp, attr, kwargs[attr]) for attr in kwargs):
+                continue
+            recurring = any(x in comp for x in ('RRULE', 'RDATE', 'EXRULE', 'EXDATE'))
+            if (start or end) and not _in_range(obj, comp, start, end, recurring):
+                continue
+            if expand and recurring:
+                obj.expand_rrule(start, end, include_completed=include_completed)
+                ret.extend(obj.split_expanded())
+            else:
+                ret.append(obj)
+        return ret
+
+    def text_search(self, calendars, terms, todo=None, event=None, include_completed=True, limit=None):
+        """
+        Full text search over all the calendars in one query.  Every
+        word in terms has to be found (as a prefix of a word) in the
+        SUMMARY, DESCRIPTION, LOCATION or COMMENT.  Returns the objects
+        found, the best matches first.
+        """
+        words = re.findall(r'\w+', terms)
+        calendars = {str(x.url): x for x in calendars}
+        if not words or not calendars:
+            return []
+        for calendar in calendars.values():
+            self.sync(calendar)
+        where = f"objects.calendar IN ({','.join('?'*len(calendars))})"
+        params = list(calendars)
+        for flag, comp in ((todo, 'VTODO'), (event, 'VEVENT')):
+            if flag:
+                where += " AND comp=?"
+                params.append(comp)
+            elif flag is False:
+                where += " AND comp IS NOT ?"
+                params.append(comp)
+        if not include_completed:
+            where += f" AND (comp IS NOT 'VTODO' OR {_PENDING_SQL})"
+        if self.fulltext:
+            query = " ".join(f'"{x}"*' for x in words)
+            weights = ", ".join(str(x) for x in _FULLTEXT_WEIGHTS)
+            sql = f"SELECT objects.calendar, objects.href, etag, comp, data FROM fulltext JOIN objects ON objects.calendar=fulltext.calendar AND objects.href=fulltext.href WHERE fulltext MATCH ? AND {where} ORDER BY bm25(fulltext, {weights})"
+            params = [query] + params
+        else:
+            sql = f"SELECT calendar, href, etag, comp, data FROM objects WHERE {where}" + " AND lower(data) LIKE ? ESCAPE '\\'"*len(words)
+            params += [_like(x) for x in words]
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(limit)
+        with self._lock:
+            rows = self._db.execute(sql, params).fetchall()
+        ret = []
+        for row in rows:
+            ret.extend(self._objects(calendars[row[0]], [row[1:]]))
+        if not include_completed:
+            ret = [x for x in ret if x.icalendar_component.name != 'VTODO' or _pending(x.icalendar_component)]
+        return ret
+
+def _like(value):
+    """
+    LIKE pattern for a case insensitive substring match
+    """
+    value = value.lower().replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return f"%{value}%"
+
+def _attr_condition(attr, value):
+    """
+    Prefilter in sql for a text attribute or a no_<attr>, see
+    _match_attr.  Objects that could not be indexed (props is NULL)
+    are always included.  Returns a condition and the parameters, or
+    (None, []) if the attribute is not indexed.
+    """
+    if attr.startswith('no_'):
+        name = attr[3:].rstrip('_').upper()
+        if name == 'CATEGORY':
+            name = 'CATEGORIES'
+        negate = "NOT " if value else ""
+        if name in ('PARENT', 'CHILD'):
+            return (f"(props IS NULL OR {negate}EXISTS (SELECT 1 FROM relations r WHERE r.calendar=objects.calendar AND r.href=objects.href AND r.reltype=?))", [name])
+        return (f"(props IS NULL OR props {negate}LIKE ?)", [f"%,{name},%"])
+    if not isinstance(value, str) or ',' in value:
+        return (None, [])
+    if attr == 'category':
+        return ("(props IS NULL OR EXISTS (SELECT 1 FROM categories c WHERE c.calendar=objects.calendar AND c.href=objects.href AND c.category LIKE ? ESCAPE '\\'))", [_like(value)])
+    if attr in ('parent', 'child'):
+        return ("(props IS NULL OR EXISTS (SELECT 1 FROM relations r WHERE r.calendar=objects.calendar AND r.href=objects.href AND r.reltype=? AND lower(r.uid) LIKE ? ESCAPE '\\'))", [attr.upper(), _like(value)])
+    return (None, [])
+
+def _index(data):
+    """
+    Parses the icalendar data and returns the values for the indexed
+    columns of the objects table, and the categories and relations of
+    the object.  If the data can't be parsed, all columns are None,
+    so the object is always checked in python.
+    """
+    import icalendar
+    ret = {'columns': (None,)*9, 'categories': [], 'relations': [], 'text': None}
+    try:
+        comp = next((x for x in icalendar.Calendar.from_ical(data).subcomponents if x.name in ('VEVENT', 'VTODO', 'VJOURNAL')), None)
+        if comp is None:
+            return ret
+        def ts(prop):
+            return _ensure_ts(comp[prop]).timestamp() if prop in comp else None
+        dtstart = ts('DTSTART')
+        due = ts('DUE')
+        priority = int(comp['PRIORITY']) if 'PRIORITY' in comp else None
+        status = str(comp['STATUS']) if 'STATUS' in comp else None
+        recurring = any(x in comp for x in ('RRULE', 'RDATE', 'EXRULE', 'EXDATE'))
+        span_start, span_end = _span(comp, ts)
+        categories = _prop_text(comp, 'category')
+        relations = [(x.params.get('RELTYPE', 'PARENT'), str(x)) for x in _as_list(comp.get('RELATED-TO'))]
+        ret = {
+            'columns': (dtstart, due, priority, status, 'COMPLETED' in comp, recurring, span_start, span_end, f",{','.join(comp.keys())},"),
+            'categories': [x.lower() for x in categories.split(',')] if categories else [],
+            'relations': relations,
+            'text': tuple(" ".join(str(x) for x in _as_list(comp.get(prop))) for prop in _FULLTEXT_PROPS)
+        }
+    except Exception:
+        logging.info("Could not index an object in the mirror", exc_info=True)
+    return ret
+
+def _span(comp, ts):
+    """
+    Earliest and latest timestamp where a non-recurring object may
+    match a time range search according to _in_range.  None means
+    unbounded.
+    """
+    dtstart = ts('DTSTART')
+    if comp.name == 'VEVENT':
+        if dtstart is None:
+            return (None, None)
+        if 'DTEND' in comp:
+            return (dtstart, ts('DTEND'))
+        if 'DURATION' in comp:
+            return (dtstart, dtstart + comp['DURATION'].dt.total_seconds())
+        if not isinstance(comp['DTSTART'].dt, datetime.datetime):
+            return (dtstart, dtstart + 24*3600)
+        return (dtstart, dtstart)
+    if comp.name == 'VTODO':
+        times = [x for x in (dtstart, ts('DUE'), ts('COMPLETED')) if x is not None]
+        if dtstart is not None and 'DURATION' in comp:
+            times.append(dtstart + comp['DURATION'].dt.total_seconds())
+        created = ts('CREATED')
+        if not times:
+            return (created, None)
+        if created is not None:
+            times.append(created)
+        return (min(times), max(times))
+    if comp.name == 'VJOURNAL':
+        if dtstart is None:
+            return (None, None)
+        if not isinstance(comp['DTSTART'].dt, datetime.datetime):
+            return (dtstart, dtstart + 24*3600)
+        return (dtstart, dtstart)
+    return (None, None)
@@ -6,7 +6,6 @@ Allows adding events and tasks using natural language
 """
 
 import json
-import requests
 from datetime import datetime, timedelta
 from typing import Dict, Any, Optional, List
 import re
@@ -27,6 +26,7 @@ class OllamaClient:
 
     def is_available(self) -> bool:
         """Check if Ollama is running and available"""
+        import requests
         try:
             response = requests.get(f"{self.base_url}/api/tags", timeout=2)
             return response.status_code == 200
@@ -35,6 +35,7 @@ class OllamaClient:
 
     def list_models(self) -> List[str]:
         """List available models"""
+        import requests
         try:
             response = requests.get(f"{self.api_url}/tags", timeout=5)
             if response.status_code == 200:
@@ -56,6 +57,7 @@ class OllamaClient:
         Returns:
             Dictionary containing the response
         """
+        import requests
         payload = {
             "model": model,
             "prompt": prompt,
@@ -2,6 +2,7 @@ from dataclasses import dataclass
 from datetime import datetime, timedelta
 from sortedcontainers import SortedKeyList
 from plann.lib import _ensure_ts, _now
+from plann.scan import scan_object
 
 class TimeLine(SortedKeyList):
     """
@@ -101,29 +102,31 @@ class TimeLine(SortedKeyList):
 def timeline_suggestion(ctx, hours_per_day=4, timeline_end=None):
     timeline = TimeLine()
     objs = ctx.obj['objs']
-    events = [x for x in objs if 'BEGIN:VEVENT' in x.data]
+    now = _now()
+    ## The component types and the presence of the time properties are
+    ## found without parsing the objects (see plann.scan)
+    scans = [(x,) + scan_object(x, ('DTSTART', 'DUE', 'DURATION')) for x in objs]
+    events = [x for x, name, props in scans if name == 'VEVENT']
     event_parents = []
     for event in events:
         comp = event.icalendar_component
         if comp.get('STATUS', '') == 'CANCELLED':
             continue
-        if 'RELATED-TO' in comp and event.get_dtend()>_now():
+        if 'RELATED-TO' in comp and event.get_dtend()>now:
             rels = event.get_relatives(fetch_objects=False)
             for rel in rels['PARENT']:
                 event_parents.append(str(rel))
-    tasks = [x for x in objs if 'BEGIN:VTODO' in x.data]
+    tasks = [x for x, name, props in scans if name == 'VTODO']
     assert len(events) + len(tasks) == len(objs)
-    tasks = [x for x in tasks if ('\nDUE' in x.data or '\nDURATION' in x.data) and '\nDTSTART' in x.data]
+    tasks = [x for x, name, props in scans if name == 'VTODO' and ('DUE' in props or 'DURATION' in props) and 'DTSTART' in props]
     
     for event in events:
-        if not 'BEGIN:VEVENT' in event.data:
-            continue
         ## TODO ... we should handle overlapping events a bit better than just ignoring AssertionErrors
         try:
             timeline.add_event(event)
         except AssertionError:
             pass
-    tasks.sort(key=lambda x: (x.icalendar_component.get('PRIORITY',0), _now()-_ensure_ts(x.get_due())))
+    tasks.sort(key=lambda x: (x.icalendar_component.get('PRIORITY',0), now-_ensure_ts(x.get_due())))
     slackbalance = timedelta(0)
     for task in tasks:
         if str(task.icalendar_component['UID']) in event_parents:
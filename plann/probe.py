@@ -0,0 +1,164 @@
+"""Probing calendar servers for supported CalDAV features.
+
+Not all servers honor all parts of the calendar-query in RFC 4791.  A
+capability profile records what a server is known to support, so that
+plann can send the filters the server supports and do the rest client
+side (see plann.lib._search).
+
+A read-only probe (sync-collection and calendar-multiget) is done the
+first time a server is searched if --auto-probe is given (it lists the
+objects of a calendar, so it's not for free).  `plann probe-server`
+additionally stores a few test objects in a calendar to
+check time-range searches for tasks, text-match, is-not-defined and
+expand, and deletes them afterwards.  The profiles are cached in
+~/.cache/plann/capabilities.json.  A capability missing in the profile
+is unknown, and plann will then do as it did before: send the filter
+to the server and trust the result.
+"""
+
+import uuid
+import logging
+import datetime
+import threading
+
+CAPABILITIES = ('time-range-todo', 'text-match', 'is-not-defined', 'expand', 'sync-collection', 'multiget')
+
+## Capability profiles known in this process, by server URL
+_profiles = {}
+_profiles_lock = threading.Lock()
+## One lock per server URL, held while the server is probed, so that
+## different servers may be probed concurrently
+_server_locks = {}
+
+def _server_key(calendar):
+    return str(calendar.client.url)
+
+def known_capability(calendar, capability):
+    """
+    True or False if it's known whether the server of the calendar
+    supports the capability, otherwise None.  Does not contact the
+    server.
+    """
+    profile = _profiles.get(_server_key(calendar))
+    return profile.get(capability) if profile else None
+
+def server_profile(calendar, cache=None, probe=True):
+    """
+    The capability profile for the server of the calendar.  It's taken
+    from the cache if possible, otherwise (if probe is set) a read-only
+    probe is done and the result is stored in the cache.
+    """
+    key = _server_key(calendar)
+    with _profiles_lock:
+        if key in _profiles:
+            return _profiles[key]
+        server_lock = _server_locks.setdefault(key, threading.Lock())
+    with server_lock:
+        if key in _profiles:
+            return _profiles[key]
+        profile = cache.get(key) if cache else None
+        if profile is None and probe:
+            try:
+                profile = probe_calendar(calendar)
+            except Exception:
+                logging.info(f"Could not probe {key}", exc_info=True)
+            else:
+                if cache:
+                    cache.put(key, profile)
+                    cache.save()
+        if profile is None:
+            return {}
+        with _profiles_lock:
+            _profiles[key] = profile
+        return profile
+
+def set_profile(calendar, profile, cache=None):
+    """
+    Records a profile found by probe_calendar
+    """
+    key = _server_key(calendar)
+    with _profiles_lock:
+        _profiles[key] = profile
+    if cache:
+        cache.put(key, profile)
+        cache.save()
+
+def probe_calendar(calendar, write=False):
+    """
+    Checks what the server of the calendar supports, returns a dict
+    from capability name to True or False.  Capabilities that could
+    not be decided are left out.  With write, test objects are stored
+    in the calendar (and deleted afterwards).
+    """
+    profile = {}
+    profile['sync-collection'], urls = _probe_sync_collection(calendar)
+    profile['multiget'] = _probe_multiget(calendar, urls)
+    if write:
+        profile.update(_probe_with_test_objects(calendar))
+    return {x: profile[x] for x in CAPABILITIES if profile.get(x) is not None}
+
+def _probe_sync_collection(calendar):
+    """
+    Returns support for sync-collection and the urls of the objects
+    in the calendar
+    """
+    import caldav
+    try:
+        objs = calendar.objects_by_sync_token(load_objects=False)
+    except caldav.error.DAVError:
+        return (False, [])
+    return (bool(objs.sync_token), [x.url for x in objs])
+
+def _probe_multiget(calendar, urls):
+    import caldav
+    from plann.lib import _multiget
+    if not urls:
+        return None
+    try:
+        return len(_multiget(calendar, urls[:1])) == 1
+    except caldav.error.DAVError:
+        return False
+
+def _probe_with_test_objects(calendar):
+    """
+    Stores two tasks and a recurring event in the calendar, and checks
+    how searches for them works out
+    """
+    import caldav
+    utc = datetime.timezone.utc
+    token = uuid.uuid4().hex
+    uid_a = f"plann-probe-{token}-a"
+    uid_b = f"plann-probe-{token}-b"
+    uid_e = f"plann-probe-{token}-e"
+    jan = lambda day: datetime.datetime(2000, 1, day, 10, tzinfo=utc)
+    objs = []
+    ret = {}
+
+    def uids(found, uid=None):
+        found = [str(x.icalendar_component.get('UID')) for x in found]
+        return found.count(uid) if uid else set(found)
+
+    def check(capability, func):
+        try:
+            ret[capability] = bool(func())
+        except caldav.error.DAVError:
+            ret[capability] = False
+        except Exception:
+            logging.info(f"probe for {capability} failed on {calendar.url}", exc_info=True)
+
+    try:
+        objs.append(calendar.save_todo(uid=uid_a, summary=f"plann probe {token} alpha", dtstart=jan(10), due=jan(11)))
+        objs.append(calendar.save_todo(uid=uid_b, summary=f"plann probe {token} beta"))
+        objs.append(calendar.save_event(uid=uid_e, summary=f"plann probe {token}", dtstart=jan(10), dtend=jan(10)+datetime.timedelta(hours=1), rrule={'FREQ': 'DAILY', 'COUNT': 3}))
+
+        check('time-range-todo', lambda: uid_a in uids(calendar.search(todo=True, include_completed=True, start=jan(9), end=jan(12))) and not uid_a in uids(calendar.search(todo=True, include_completed=True, start=jan(20), end=jan(21))))
+        check('text-match', lambda: uids(calendar.search(todo=True, include_completed=True, summary=f"{token} beta")) & {uid_a, uid_b} == {uid_b})
+        check('is-not-defined', lambda: uids(calendar.search(todo=True, include_completed=True, no_dtstart=True)) & {uid_a, uid_b} == {uid_b})
+        check('expand', lambda: uids(calendar.search(event=True, start=jan(9), end=jan(20), expand='server'), uid_e) == 3)
+    finally:
+        for obj in objs:
+            try:
+                obj.delete()
+            except Exception:
+                logging.error(f"Could not delete the probe object {obj.url}", exc_info=True)
+    return ret
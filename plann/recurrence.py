@@ -0,0 +1,216 @@
+"""Client side expansion of recurring events and tasks.
+
+With expand=True, the server returns every recurrence instance of the
+objects found in a time range as a separate VEVENT/VTODO, which may be
+a lot of data for long time ranges (think one year of daily standup
+meetings).  The alternative is to fetch the master objects only and
+expand them here.
+
+occurrences() is a lazy iterator over the recurrence instances of an
+object within a time window, taking RRULE, RDATE, EXDATE and
+overridden instances (RECURRENCE-ID) into account.  Each instance is
+an Occurrence, a lightweight object referring to the master.  The
+icalendar component of an occurrence is only made when needed.
+"""
+
+import datetime
+import heapq
+import itertools
+from plann.timespec import _ensure_ts
+from plann.filters import _as_list, _far_past, _far_future
+
+_RECURRENCE_PROPS = ('RRULE', 'RDATE', 'EXDATE', 'EXRULE')
+
+## Methods of the caldav object that would modify (or reload) the
+## master rather than the occurrence
+_MUTATING = frozenset(('save', 'delete', 'load', 'complete', 'uncomplete', 'set_due', 'set_dtend', 'set_duration', 'set_relation', 'add_organizer', 'add_attendee', 'expand_rrule', 'split_expanded', 'data', 'vobject_instance'))
+
+def _master(obj):
+    """
+    The master component of a recurring object (the one without a
+    RECURRENCE-ID)
+    """
+    comp = obj.icalendar_component
+    if not 'RECURRENCE-ID' in comp:
+        return comp
+    for other in obj.icalendar_instance.subcomponents:
+        if other.name == comp.name and not 'RECURRENCE-ID' in other:
+            return other
+    return comp
+
+def is_recurring(obj):
+    comp = _master(obj)
+    return any(x in comp for x in _RECURRENCE_PROPS)
+
+class Occurrence:
+    """
+    One recurrence instance of a caldav object.  It can be used like
+    the caldav object itself for listing, sorting and in the panic
+    planning timeline, other read-only attributes are looked up on the
+    master.  An occurrence can't be modified or saved.
+    """
+    __slots__ = ('master', 'start', 'end', 'override', '_component')
+
+    def __init__(self, master, start, end, override=None):
+        self.master = master
+        self.start = start
+        self.end = end
+        self.override = override
+        self._component = override
+
+    def __getattr__(self, attr):
+        if attr in _MUTATING:
+            raise AttributeError(f"{attr}: occurrences expanded client side are read-only")
+        return getattr(self.master, attr)
+
+    def __repr__(self):
+        return f"Occurrence({self.master!r}, {self.start})"
+
+    @property
+    def icalendar_component(self):
+        if self._component is None:
+            master = _master(self.master)
+            comp = type(master)()
+            for key in master:
+                if key not in _RECURRENCE_PROPS and key not in ('DTSTART', 'DTEND', 'DUE', 'DURATION'):
+                    comp[key] = master[key]
+            comp.add('DTSTART', self.start)
+            comp.add('DTEND' if comp.name == 'VEVENT' else 'DUE', self.end)
+            comp.add('RECURRENCE-ID', self.start)
+            self._component = comp
+        return self._component
+
+    @property
+    def icalendar_instance(self):
+        import icalendar
+        master = self.master.icalendar_instance
+        cal = icalendar.Calendar()
+        for key in master:
+            cal[key] = master[key]
+        for timezone in master.walk('VTIMEZONE'):
+            cal.add_component(timezone)
+        cal.add_component(self.icalendar_component)
+        return cal
+
+    def get_dtend(self):
+        return self.end
+
+    get_due = get_dtend
+
+    def get_duration(self):
+        return self.end - self.start
+
+def _duration(comp):
+    start = comp['DTSTART'].dt
+    end = comp.get('DTEND') or comp.get('DUE')
+    if end is not None:
+        return end.dt - start
+    if 'DURATION' in comp:
+        return comp['DURATION'].dt
+    if isinstance(start, datetime.datetime):
+        return datetime.timedelta(0)
+    return datetime.timedelta(days=1)
+
+def _wall(dt, tzinfo):
+    """
+    The recurrence rules are expanded in wall clock time of the master
+    (so that a daily meeting stays at 09:00 also after a DST change).
+    Converts dt to a naive datetime in the timezone tzinfo.
+    """
+    if not isinstance(dt, datetime.datetime):
+        return datetime.datetime(dt.year, dt.month, dt.day)
+    if dt.tzinfo and tzinfo:
+        dt = dt.astimezone(tzinfo)
+    return dt.replace(tzinfo=None)
+
+def _localize(dt, tzinfo):
+    if not tzinfo:
+        return dt
+    if hasattr(tzinfo, 'localize'):
+        ## pytz
+        return tzinfo.localize(dt)
+    return dt.replace(tzinfo=tzinfo)
+
+def _rule_set(comp, dtstart, tzinfo):
+    from dateutil.rrule import rruleset, rrulestr
+    rules = rruleset()
+    for rrule in _as_list(comp.get('RRULE')):
+        rules.rrule(rrulestr(rrule.to_ical().decode(), dtstart=dtstart, ignoretz=True))
+    for exrule in _as_list(comp.get('EXRULE')):
+        rules.exrule(rrulestr(exrule.to_ical().decode(), dtstart=dtstart, ignoretz=True))
+    for rdate in _as_list(comp.get('RDATE')):
+        for dt in rdate.dts:
+            ## RDATE may also be a PERIOD, only the start of it is used
+            rules.rdate(_wall(dt.dt[0] if isinstance(dt.dt, tuple) else dt.dt, tzinfo))
+    for exdate in _as_list(comp.get('EXDATE')):
+        for dt in exdate.dts:
+            rules.exdate(_wall(dt.dt, tzinfo))
+    if not 'RRULE' in comp:
+        ## With RDATE only, DTSTART is the first instance
+        rules.rdate(dtstart)
+    return rules
+
+def occurrences(obj, start=None, end=None):
+    """
+    Lazy iterator over the recurrence instances of obj overlapping the
+    time window, sorted by start time.  Objects that are not recurring
+    are yielded as they are (the search is supposed to have checked
+    the time range already).
+    """
+    start = _ensure_ts(start) if start else _far_past
+    end = _ensure_ts(end) if end else _far_future
+    instance = obj.icalendar_instance
+    comp = _master(obj)
+    if not 'DTSTART' in comp or not is_recurring(obj):
+        yield obj
+        return
+    master_start = comp['DTSTART'].dt
+    is_date = not isinstance(master_start, datetime.datetime)
+    tzinfo = None if is_date else master_start.tzinfo
+    dtstart = _wall(master_start, tzinfo)
+    duration = _duration(comp)
+
+    def as_value(dt):
+        return dt.date() if is_date else _localize(dt, tzinfo)
+
+    def overlaps(begin, finish):
+        begin, finish = _ensure_ts(begin), _ensure_ts(finish)
+        return begin < end and (finish > start or begin == finish == start)
+
+    ## Overridden instances are kept in the same resource as the master
+    overrides = {}
+    for other in instance.subcomponents:
+        if other is not comp and other.name == comp.name and 'RECURRENCE-ID' in other:
+            overrides[_wall(other['RECURRENCE-ID'].dt, tzinfo)] = other
+
+    def from_rules():
+        ## The instances starting before start-duration can't overlap
+        ## the window, and the iteration stops at the end of it.  The
+        ## window is given in local time, hence a day of slack
+        first = _wall(start - duration - datetime.timedelta(days=1), tzinfo or start.tzinfo)
+        for dt in _rule_set(comp, dtstart, tzinfo).xafter(max(first, dtstart), inc=True):
+            value = as_value(dt)
+            if _ensure_ts(value) >= end:
+                return
+            if dt in overrides:
+                continue
+            if overlaps(value, value + duration):
+                yield (_ensure_ts(value), Occurrence(obj, value, value + duration))
+
+    moved = []
+    for recurrence_id, other in overrides.items():
+        begin = other['DTSTART'].dt if 'DTSTART' in other else as_value(recurrence_id)
+        finish = begin + _duration(other) if 'DTSTART' in other else begin + duration
+        if overlaps(begin, finish):
+            moved.append((_ensure_ts(begin), Occurrence(obj, begin, finish, override=other)))
+    moved.sort(key=lambda x: x[0])
+
+    for ts, occurrence in heapq.merge(from_rules(), moved, key=lambda x: x[0]):
+        yield occurrence
+
+def expand(objs, start=None, end=None):
+    """
+    Lazy iterator over objs, with recurring objects replaced by their
+    instances within the time window
+    """
+    return itertools.chain.from_iterable(occurrences(x, start, end) for x in objs)
@@ -0,0 +1,108 @@
+"""Line oriented scanning of icalendar data.
+
+Parsing icalendar data into the icalendar object tree is slow, and
+serializing a parsed object again (through caldav's .data) is not
+much faster.  Often only the component type and a few properties
+are needed (is this an event or a task, does it have a DUE?).  scan()
+finds those through one pass over the (unfolded) lines, without
+parsing anything else.
+"""
+
+from plann.item import PlannItem
+from plann.recurrence import Occurrence
+
+def _unfolded(data):
+    """
+    Generator for the logical lines of icalendar data (RFC 5545
+    section 3.1: a line starting with a space or a tab continues the
+    previous line)
+    """
+    line = None
+    for physical in data.splitlines():
+        if physical[:1] in (' ', '\t') and line is not None:
+            line += physical[1:]
+            continue
+        if line is not None:
+            yield line
+        line = physical
+    if line is not None:
+        yield line
+
+def _split(line):
+    """
+    Splits a content line into the property name and the value.  The
+    value starts after the first colon that isn't inside a quoted
+    parameter value.
+    """
+    quoted = False
+    for pos, char in enumerate(line):
+        if char == '"':
+            quoted = not quoted
+        elif char == ':' and not quoted:
+            name = line[:pos].split(';', 1)[0]
+            return name.upper(), line[pos+1:]
+    return line.upper(), None
+
+def scan(data, props=()):
+    """
+    Returns the name of the first calendar component in the data
+    (VEVENT, VTODO, VJOURNAL, ... - VTIMEZONEs are skipped) and a dict
+    with the raw values of the props found in that component.  Only
+    the first value of a property is given, and properties of
+    subcomponents (like VALARM) are not considered.  The scan stops at
+    the end of the component.
+    """
+    props = {x.upper() for x in props}
+    found = {}
+    name = None
+    depth = 0
+    for line in _unfolded(data):
+        prop, value = _split(line)
+        if prop == 'BEGIN':
+            depth += 1
+            if depth == 2 and value.strip().upper() != 'VTIMEZONE':
+                name = value.strip().upper()
+        elif prop == 'END':
+            depth -= 1
+            if depth == 1 and name:
+                break
+        elif name and depth == 2 and prop in props and not prop in found:
+            found[prop] = value
+    return name, found
+
+def _parsed_component(obj):
+    """
+    The icalendar component of obj, if it's available without parsing
+    the data
+    """
+    if isinstance(obj, (PlannItem, Occurrence)):
+        return obj.icalendar_component
+    if not hasattr(obj, 'data'):
+        ## assume obj is an icalendar component
+        return obj
+    if getattr(obj, '_icalendar_instance', None) is not None:
+        return obj.icalendar_component
+    return None
+
+def scan_object(obj, props=()):
+    """
+    Like scan, for a caldav object.  If the data of the object is
+    parsed already, the parsed component is used instead.
+    """
+    comp = _parsed_component(obj)
+    if comp is None:
+        return scan(obj.data, props)
+    found = {}
+    for prop in props:
+        value = comp.get(prop)
+        if isinstance(value, list):
+            value = value[0]
+        if value is not None:
+            found[prop.upper()] = value.to_ical().decode() if hasattr(value, 'to_ical') else str(value)
+    return comp.name, found
+
+def component_name(obj):
+    """
+    VEVENT, VTODO, VJOURNAL, ... for a caldav object
+    """
+    return scan_object(obj)[0]
@@ -6,8 +6,10 @@ googling a bit, and didn't find anything like this out there ... but
 I'm sure there must exist something like this?"""
 
 import datetime
+import functools
 import string
 import re
+import _string
 from plann.timespec import tz
 
 class NoValue():
@@ -25,16 +27,134 @@ class NoValue():
 
 no_value = NoValue()
 
+## Compiled templates, by template string.  A compiled template is a
+## tuple of literal strings and fields; a field is a tuple
+## (key, lookups, conversion, default, format_spec), where lookups are
+## the attribute/item lookups following the key.  default and
+## format_spec are strings, or compiled templates if they contain
+## fields themselves.  The default is only rendered if the value is
+## missing.
+_compiled = {}
+
+_formatter = string.Formatter()
+
+@functools.lru_cache(maxsize=256)
+def _split_spec(format_spec):
+    """
+    Splits "?default?spec" into (default, spec).  default is None if
+    no default value is given.
+    """
+    rx = re.match(r'\?([^\?]*)\?(.*)', format_spec)
+    if rx:
+        return rx.group(1), rx.group(2)
+    return None, format_spec
+
+def _default_end(format_spec):
+    """
+    For a format_spec starting with "?default?", the position of the
+    "?" ending the default value, skipping any fields in the default.
+    """
+    depth = 0
+    for pos in range(1, len(format_spec)):
+        char = format_spec[pos]
+        if char == '{':
+            depth += 1
+        elif char == '}':
+            depth -= 1
+        elif char == '?' and not depth:
+            return pos
+    return None
+
+def _compile(template):
+    try:
+        return _compiled[template]
+    except KeyError:
+        pass
+    compiled = []
+    auto_index = 0
+    for literal, field_name, format_spec, conversion in _formatter.parse(template):
+        if literal:
+            compiled.append(literal)
+        if field_name is None:
+            continue
+        key, lookups = _string.formatter_field_name_split(field_name)
+        if key == '':
+            key = auto_index
+            auto_index += 1
+        default = None
+        if format_spec.startswith('?') and _default_end(format_spec):
+            end = _default_end(format_spec)
+            default, format_spec = format_spec[1:end], format_spec[end+1:]
+            if '{' in default:
+                default = _compile(default)
+        if '{' in format_spec:
+            format_spec = _compile(format_spec)
+        elif default is None:
+            default, format_spec = _split_spec(format_spec)
+        compiled.append((key, tuple(lookups), conversion, default, format_spec))
+    compiled = _compiled[template] = tuple(compiled)
+    return compiled
+
+def _fields(compiled):
+    ret = set()
+    for part in compiled:
+        if isinstance(part, str):
+            continue
+        key, lookups, conversion, default, format_spec = part
+        ret.add(key)
+        for sub in (default, format_spec):
+            if sub is not None and not isinstance(sub, str):
+                ret |= _fields(sub)
+    return ret
+
 class Template(string.Formatter):
+    """
+    The template string is parsed once (and cached), so the same
+    Template can be used for formatting lots of rows.  format() takes
+    the fields as keyword arguments, render() takes any mapping - like
+    an icalendar component - and only looks up the fields used by the
+    template.
+    """
     def __init__(self, template):
         self.template = template
+        self._compiled = _compile(template)
 
     def format(self, *pargs, **kwargs):
-        return super().format(self.template, *pargs, **kwargs)
-    
+        return self._render(self._compiled, pargs, kwargs)
+
+    def render(self, fields):
+        return self._render(self._compiled, (), fields)
+
+    def fields(self):
+        """
+        The keys of the fields used by the template (also in defaults)
+        """
+        return _fields(self._compiled)
+
+    def _render(self, compiled, args, fields):
+        parts = []
+        for part in compiled:
+            if isinstance(part, str):
+                parts.append(part)
+                continue
+            key, lookups, conversion, default, format_spec = part
+            value = self.get_value(key, args, fields)
+            for is_attr, name in lookups:
+                value = getattr(value, name) if is_attr else value[name]
+            if conversion:
+                value = self.convert_field(value, conversion)
+            if not isinstance(format_spec, str):
+                format_spec = self._render(format_spec, args, fields)
+                if default is None:
+                    default, format_spec = _split_spec(format_spec)
+            if default is not None and value is no_value:
+                value = default if isinstance(default, str) else self._render(default, args, fields)
+            parts.append(self._format_field(value, format_spec))
+        return "".join(parts)
+
     def get_value(self, key, args, kwds):
         try:
-            ret = string.Formatter.get_value(self, key, args, kwds)
+            ret = args[key] if isinstance(key, int) else kwds[key]
         except:
             return no_value
         if hasattr(ret, 'dt'):
@@ -44,12 +164,13 @@ class Template(string.Formatter):
         return ret
 
     def format_field(self, value, format_spec):
-        rx = re.match(r'\?([^\?]*)\?(.*)', format_spec)
-        if rx:
-            format_spec = rx.group(2)
-            if value is no_value:
-                value = rx.group(1)
+        default, format_spec = _split_spec(format_spec)
+        if default is not None and value is no_value:
+            value = default
+        return self._format_field(value, format_spec)
+
+    def _format_field(self, value, format_spec):
         try:
-            return string.Formatter.format_field(self, value, format_spec)
+            return format(value, format_spec)
         except:
-            return string.Formatter.format_field(self, value, "")
+            return format(value, "")
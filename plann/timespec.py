@@ -1,8 +1,8 @@
+from contextlib import contextmanager
 from dataclasses import dataclass
+from functools import lru_cache
 import zoneinfo
 import datetime
-import dateutil
-import dateutil.parser
 import re
 
 """
@@ -54,9 +54,30 @@ class Tz():
 
 tz=Tz()
 
+## Set by frozen_now
+_frozen_now = None
+
 def _now():
+    if _frozen_now is not None:
+        return _frozen_now
     return datetime.datetime.now().astimezone(tz.implicit_timezone).replace(microsecond=0)
 
+@contextmanager
+def frozen_now(now=None):
+    """
+    Within the context, _now() keeps returning the same timestamp
+    (default: the time the context was entered), so that i.e. "+2h"
+    means the same thing through a whole command, and sort keys
+    comparing against "now" don't see the clock moving.
+    """
+    global _frozen_now
+    previous = _frozen_now
+    _frozen_now = now or _now()
+    try:
+        yield _frozen_now
+    finally:
+        _frozen_now = previous
+
 def _ensure_ts(dt):
     """
     TODO: do we need this?  it's a bit overlapping with parse_dt
@@ -110,7 +131,7 @@ def _parse_dt(input, return_type=None):
     elif input.startswith('+'):
         ret = parse_add_dur(_now(), input[1:])
     else:
-        ret = dateutil.parser.parse(input)
+        ret = _parse_str(input)
     if return_type is datetime.datetime:
         return _ensure_ts(ret)
     elif return_type is datetime.date:
@@ -120,6 +141,56 @@ def _parse_dt(input, return_type=None):
     else:
         return _ensure_ts(ret)
 
+## Strings starting with a date on the form 2020-02-20 or 20200220
+_iso_re = re.compile(r'\d{4}-?\d{2}-?\d{2}')
+
+@lru_cache(maxsize=1024)
+def _parse_iso(input):
+    return datetime.datetime.fromisoformat(input)
+
+def _parse_str(input):
+    """
+    ISO 8601 timestamps are parsed by datetime.fromisoformat (and the
+    results are memoized), anything else by dateutil.parser.
+    dateutil fills in missing parts from the current date, so those
+    results are not memoized.
+    """
+    if _iso_re.match(input):
+        try:
+            return _parse_iso(input)
+        except ValueError:
+            pass
+    import dateutil.parser
+    return dateutil.parser.parse(input)
+
+_time_units = {
+    's': 1, 'm': 60, 'h': 3600,
+    'd': 86400, 'w': 604800,
+    'y': 1314000
+}
+_dur_re = re.compile(r'([+-]?\d+(?:\.\d+)?)([smhdwy])')
+_iso_dur_re = re.compile(r'([+-]?)P(?:(\d+(?:[.,]\d+)?)Y)?(?:(\d+(?:[.,]\d+)?)W)?(?:(\d+(?:[.,]\d+)?)D)?(?:T(?:(\d+(?:[.,]\d+)?)H)?(?:(\d+(?:[.,]\d+)?)M)?(?:(\d+(?:[.,]\d+)?)S)?)?$', re.I)
+
+@lru_cache(maxsize=1024)
+def _dur_parts(dur):
+    """
+    Splits a duration string into a tuple of (number, unit) pairs.
+    Returns None if it's not a duration.
+    """
+    rx = _iso_dur_re.match(dur)
+    if rx and any(rx.groups()[1:]) and not dur.upper().endswith('T'):
+        sign = -1 if rx.group(1) == '-' else 1
+        return tuple((sign*float(value.replace(',', '.')), unit)
+                     for value, unit in zip(rx.groups()[1:], 'ywdhms') if value)
+    parts = []
+    pos = 0
+    while pos < len(dur):
+        rx = _dur_re.match(dur, pos)
+        if not rx:
+            return None
+        parts.append((float(rx.group(1)), rx.group(2)))
+        pos = rx.end()
+    return tuple(parts)
 
 def parse_add_dur(dt, dur, for_storage=False, ts_allowed=False):
     """
@@ -129,7 +200,8 @@ def parse_add_dur(dt, dur, for_storage=False, ts_allowed=False):
       * 3.5h
       * 1y1w
     
-    It may also be a ISO8601 duration
+    It may also be a ISO8601 duration, like P1DT2H (months not
+    supported)
 
     Returns the dt plus duration.
 
@@ -137,35 +209,29 @@ def parse_add_dur(dt, dur, for_storage=False, ts_allowed=False):
 
     TODO: months not supported yet
     TODO: return of delta in years not supported yet
-    TODO: ISO8601 duration not supported yet
     """
     if dt and not (isinstance(dt, datetime.date)):
         dt = parse_dt(dt)
-    time_units = {
-        's': 1, 'm': 60, 'h': 3600,
-        'd': 86400, 'w': 604800,
-        'y': 1314000
-    }
-    while dur:
-        rx = re.match(r'([+-]?\d+(?:\.\d+)?)([smhdwy])(.*)', dur)
-        if not rx:
-            if ts_allowed:
-                return parse_dt(dur)
-            else:
-                raise ValueError(f"A duration (like 3h for three hours) expected, but got: {dur}")
-        i = float(rx.group(1))
-        u = rx.group(2)
-        dur = rx.group(3)
+    parts = _dur_parts(dur)
+    if parts is None:
+        if ts_allowed:
+            return parse_dt(dur)
+        else:
+            raise ValueError(f"A duration (like 3h for three hours) expected, but got: {dur}")
+    total = datetime.timedelta(0)
+    for i, u in parts:
         if u=='y' and dt:
             dt = datetime.datetime.combine(datetime.date(dt.year+int(i), dt.month, dt.day), dt.time(), tzinfo=dt.tzinfo)
         else:
-            diff = datetime.timedelta(0, i*time_units[u])
+            diff = datetime.timedelta(0, i*_time_units[u])
             if dt:
                 dt = dt + diff
+            else:
+                total += diff
     if dt:
         return dt.astimezone(tz.store_timezone) if for_storage else dt
     else:
-        return diff
+        return total
    
 
 def parse_timespec(timespec, for_storage=False):
@@ -189,6 +255,8 @@ def parse_timespec(timespec, for_storage=False):
         ret = (x and x.astimezone(tz.store_timezone) for x in ret)
     return ret
 
+_timespec_dur_re = re.compile(r'(.*)\+((?:\d+(?:\.\d+)?[smhdwy])+)$')
+
 def _parse_timespec(timespec):
     if isinstance(timespec, datetime.date):
         return (timespec,timespec)
@@ -202,11 +270,12 @@ def _parse_timespec(timespec):
     
     ## calendar-cli format, 1998-10-03 15:00+2h
     if '+' in timespec:
-        rx = re.match(r'(.*)\+((?:\d+(?:\.\d+)?[smhdwy])+)$', timespec)
+        rx = _timespec_dur_re.match(timespec)
         if rx:
             start = parse_dt(rx.group(1))
             end = parse_add_dur(start, rx.group(2))
             return (start, end)
+    import dateutil.parser
     try:
         ## parse("2015-05-05 2015-05-05") does not throw the ParserError
         if timespec.count('-')>3:
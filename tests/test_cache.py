@@ -0,0 +1,47 @@
+import time
+from caldav import DAVClient
+from plann.cache import DiscoveryCache, CapabilityCache, discovery_key
+from plann.lib import _cached_calendar
+
+cals = [{'url': 'http://example.com/dav/cal1/', 'name': 'Calendar 1', 'components': ['VTODO']}]
+
+def test_discovery_key():
+    args = {'caldav_url': 'http://example.com/dav/', 'caldav_user': 'foo', 'calendar_url': ['cal1']}
+    key = discovery_key('http://example.com/dav/', args)
+    assert key.startswith('http://example.com/dav/#')
+    ## The password does not affect the key, the calendar url does
+    assert key == discovery_key('http://example.com/dav/', dict(args, caldav_pass='secret'))
+    assert key == discovery_key('http://example.com/dav/', dict(args, calendar_url='cal1'))
+    assert key != discovery_key('http://example.com/dav/', dict(args, calendar_url=['cal2']))
+
+def test_discovery_cache(tmp_path):
+    path = tmp_path / 'plann' / 'discovery.json'
+    cache = DiscoveryCache(path=str(path))
+    assert cache.get('foo') is None
+    cache.put('foo', cals)
+    cache.save()
+    assert DiscoveryCache(path=str(path)).get('foo') == cals
+    assert DiscoveryCache(path=str(path), refresh=True).get('foo') is None
+    assert DiscoveryCache(path=str(path), ttl=0).get('foo') is None
+    cache = DiscoveryCache(path=str(path), ttl=60)
+    cache._entries['foo']['timestamp'] = time.time() - 61
+    assert cache.get('foo') is None
+
+def test_discovery_cache_unreadable(tmp_path):
+    path = tmp_path / 'discovery.json'
+    path.write_text('{garbage')
+    assert DiscoveryCache(path=str(path)).get('foo') is None
+
+def test_capability_cache(tmp_path):
+    path = tmp_path / 'capabilities.json'
+    cache = CapabilityCache(path=str(path))
+    cache.put('http://example.com/dav/', {'text-match': False})
+    cache.save()
+    assert CapabilityCache(path=str(path)).get('http://example.com/dav/') == {'text-match': False}
+    assert CapabilityCache(path=str(path)).get('http://example.org/dav/') is None
+
+def test_cached_calendar():
+    cal = _cached_calendar(DAVClient(url='http://example.com/dav/'), cals[0])
+    assert str(cal.url) == cals[0]['url']
+    assert cal.name == 'Calendar 1'
+    assert cal.get_supported_components() == ['VTODO']
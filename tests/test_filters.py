@@ -0,0 +1,47 @@
+from datetime import datetime, timezone
+from caldav import Todo
+from plann.filters import compile_filter, _match_attr
+
+utc = timezone.utc
+
+def _todo(extra, uid="filtertest"):
+    t = Todo()
+    t.data = f"""BEGIN:VCALENDAR
+VERSION:2.0
+PRODID:-//Example Corp.//CalDAV Client//EN
+BEGIN:VTODO
+UID:{uid}
+DTSTAMP:19970901T130000Z
+SUMMARY:Fix a party
+{extra}
+END:VTODO
+END:VCALENDAR"""
+    return t
+
+def test_compile_filter():
+    t1 = _todo("CATEGORIES:party,Food\nSTATUS:NEEDS-ACTION\nDTSTART:19970415T133000Z\nDUE:19970416T045959Z", uid="t1")
+    t2 = _todo("CATEGORIES:work\nSTATUS:COMPLETED\nCOMPLETED:19970416T045959Z", uid="t2")
+    t3 = _todo("PRIORITY:2", uid="t3")
+    todos = [t1, t2, t3]
+    uids = lambda pred: [str(x.icalendar_component['UID']) for x in todos if pred(x)]
+
+    assert uids(compile_filter()) == ['t1', 't2', 't3']
+    assert uids(compile_filter(todo=True, include_completed=False)) == ['t1', 't3']
+    assert uids(compile_filter(event=True)) == []
+
+    ## several values means any of them
+    assert uids(compile_filter(category=('food', 'work'))) == ['t1', 't2']
+    assert uids(compile_filter(category=('foo',))) == ['t1']
+    assert uids(compile_filter(category='PARTY')) == ['t1']
+    assert uids(compile_filter(not_category=('work',))) == ['t1', 't3']
+    assert uids(compile_filter(no_category=True)) == ['t3']
+    assert uids(compile_filter(no_category=False, no_due=True)) == ['t2']
+    assert uids(compile_filter(summary='a PARTY', not_status=('COMPLETED', 'CANCELLED'))) == ['t1', 't3']
+
+    ## time range
+    assert uids(compile_filter(start=datetime(1997, 4, 15, tzinfo=utc), end=datetime(1997, 4, 17, tzinfo=utc))) == ['t1', 't2', 't3']
+    assert uids(compile_filter(start=datetime(1998, 4, 15, tzinfo=utc), end=datetime(1998, 4, 17, tzinfo=utc))) == ['t3']
+
+    ## single values gives the same as a calendar-query text-match
+    for attr, value in (('category', 'foo'), ('summary', 'party'), ('status', 'needs'), ('no_category', True)):
+        assert uids(compile_filter(**{attr: value})) == [str(x.icalendar_component['UID']) for x in todos if _match_attr(x.icalendar_component, attr, value)]
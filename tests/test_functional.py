@@ -6,10 +6,20 @@
 
 from xandikos.web import XandikosBackend, XandikosApp
 import plann.lib
-from plann.lib import find_calendars, _adjust_relations, _adjust_ical_relations
+import plann.probe
+import plann.recurrence
+import plann.item
+from plann.lib import find_calendars, find_all_calendars, _adjust_relations, _adjust_ical_relations
+from plann.cache import DiscoveryCache, CapabilityCache
+from plann.probe import probe_calendar, set_profile
+from plann.mirror import Mirror
+from plann.commands import _update_mirror, _text_search, _edit
 from plann.cli import _add_todo, _select, _list, _check_for_panic
 from plann.interactive import _interactive_relation_edit, _interactive_edit, _mass_interactive_edit, command_edit, _mass_reprioritize
 from plann.panic_planning import timeline_suggestion
+import caldav
+import click
+import pytest
 from caldav import Todo
 import aiohttp
 import aiohttp.web
@@ -17,6 +27,7 @@ import threading
 import requests
 from unittest.mock import MagicMock, patch
 import asyncio
+import heapq
 import os
 import signal
 import tempfile
@@ -158,6 +169,31 @@ def test_plann():
         ctx.obj = dict()
         ctx.obj['calendars'] = find_calendars(conn_details, raise_errors=True)
 
+        ## Several calendar urls are validated through one listing of the
+        ## calendar home, and several sections may be discovered concurrently
+        cal = ctx.obj['calendars'][0]
+        cal_urls = dict(conn_details, calendar_url=[str(cal.url), str(cal.url)])
+        found = find_all_calendars([cal_urls, conn_details], raise_errors=True)
+        assert [str(x.url) for x in found] == [str(cal.url)]*3
+        assert found[0].name == cal.name
+
+        ## Sections on the same server with the same credentials share
+        ## one client and one principal
+        stats = plann.lib.connection_stats()
+        assert stats['clients'] == stats['principals'] == 1
+        assert stats['connections'] >= 1
+        assert plann.lib._get_client(dict(url=conn_details['caldav_url'])) is plann.lib._get_client(dict(url=conn_details['caldav_url']))
+
+        ## With a discovery cache, the second discovery should not
+        ## touch the server
+        with tempfile.TemporaryDirectory() as cachedir:
+            cache = DiscoveryCache(path=os.path.join(cachedir, 'discovery.json'))
+            found = find_all_calendars([conn_details], raise_errors=True, cache=cache)
+            with patch('caldav.DAVClient.request', side_effect=AssertionError):
+                cached = find_all_calendars([conn_details], raise_errors=True, cache=DiscoveryCache(path=cache.path))
+            assert [(str(x.url), x.name) for x in cached] == [(str(x.url), x.name) for x in found]
+            assert 'VTODO' in cached[0].get_supported_components()
+
         def dag(obj, reltype, observed=None):
             if not hasattr(obj, 'get_relatives'):
                 obj = ctx.obj['calendars'][0].object_by_uid(obj)
@@ -193,6 +229,211 @@ def test_plann():
         assert len(ctx.obj['objs'])==1
         _select(ctx, event=True)
         assert len(ctx.obj['objs'])==0
+        _select(ctx, category=('nonexistent', 'keyboard'), todo=True)
+        assert len(ctx.obj['objs'])==2
+        _select(ctx, category=('nonexistent', 'neither'), todo=True)
+        assert len(ctx.obj['objs'])==0
+
+        ## Several uids should be found through one calendar-multiget
+        with patch('caldav.Calendar.object_by_uid', side_effect=AssertionError):
+            _select(ctx, uid=[uid2, uid1], todo=True)
+        assert [str(x.icalendar_component['uid']) for x in ctx.obj['objs']] == [uid2, uid1]
+        _select(ctx, uid=[uid1, 'nonexistent'], todo=True)
+        assert len(ctx.obj['objs'])==1
+
+        ## Reloading an unchanged object should be a 304, a changed
+        ## object should be fetched again
+        obj = ctx.obj['objs'][0]
+        stats = dict(plann.lib.reload_stats)
+        assert plann.lib._reload(obj) is obj
+        assert plann.lib.reload_stats['not_modified'] == stats['not_modified']+1
+        ## (a copy is given, not the object held by the caller)
+        copy = plann.lib._object_by_uid(uid1, obj.parent)
+        assert copy is not obj and copy.data == obj.data
+        assert plann.lib.reload_stats['not_modified'] == stats['not_modified']+2
+        ## Local modifications are dropped also when it's unchanged on
+        ## the server
+        summary = str(obj.icalendar_component['SUMMARY'])
+        obj.icalendar_component['SUMMARY'] = 'not saved'
+        plann.lib._reload(obj)
+        assert plann.lib.reload_stats['not_modified'] == stats['not_modified']+3
+        assert str(obj.icalendar_component['SUMMARY']) == summary
+        stats['not_modified'] += 1
+        other = obj.parent.object_by_uid(uid1)
+        other.icalendar_component['DESCRIPTION'] = 'changed elsewhere'
+        other.save()
+        plann.lib._reload(obj)
+        assert plann.lib.reload_stats['not_modified'] == stats['not_modified']+2
+        assert obj.icalendar_component['DESCRIPTION'] == 'changed elsewhere'
+        plann.lib._reload(obj)
+        assert plann.lib.reload_stats['not_modified'] == stats['not_modified']+3
+
+        ## A stale uid map should not hide the object
+        stale = caldav.Calendar(client=obj.client, url=obj.parent.url.join('../stale/'))
+        plann.lib._reset_uid_maps()
+        plann.lib._uid_calendars[uid1] = {str(stale.url): stale}
+        assert str(plann.lib._object_by_uid(uid1, obj.parent).icalendar_component['UID']) == uid1
+        plann.lib._uid_calendars[uid1] = {str(stale.url): stale}
+        _select(ctx, uid=[uid1], todo=True)
+        assert len(ctx.obj['objs'])==1
+
+        ## Probing the server.  xandikos does an exact match rather than
+        ## a substring match on text
+        profile = probe_calendar(cal, write=True)
+        assert profile['time-range-todo'] and profile['is-not-defined'] and profile['expand']
+        assert profile['sync-collection'] and profile['multiget']
+        assert profile['text-match'] is False
+        assert not [x for x in cal.objects() if 'plann-probe' in str(x.url)]
+        with tempfile.TemporaryDirectory() as cachedir:
+            ## the first search does a read-only probe, if asked for
+            ctx.obj['capabilities'] = CapabilityCache(path=os.path.join(cachedir, 'capabilities.json'))
+            with patch('plann.probe.probe_calendar', side_effect=AssertionError):
+                _select(ctx, todo=True)
+            ctx.obj['auto_probe'] = True
+            _select(ctx, todo=True)
+            ctx.obj['auto_probe'] = False
+            assert CapabilityCache(path=os.path.join(cachedir, 'capabilities.json')).get(str(cal.client.url))['sync-collection']
+            _select(ctx, summary='make plann', todo=True)
+            assert len(ctx.obj['objs'])==0
+            ## unsupported filters are done client side
+            plann.probe._profiles.clear()
+            set_profile(cal, profile, ctx.obj['capabilities'])
+            _select(ctx, summary='make plann', todo=True)
+            assert len(ctx.obj['objs'])==1
+            _select(ctx, summary='make plann good', todo=True)
+            assert len(ctx.obj['objs'])==1
+            ctx.obj['capabilities'] = None
+            plann.probe._profiles.clear()
+
+        ## The same selections should work through a local mirror
+        with tempfile.TemporaryDirectory() as mirrordir:
+            mirror_path = os.path.join(mirrordir, 'mirror.sqlite')
+            ctx.obj['mirror'] = Mirror(path=mirror_path)
+            _select(ctx, todo=True)
+            assert len(ctx.obj['objs'])==2
+            assert ctx.obj['mirror'].stats['fetched'] == 2
+            _select(ctx, todo=True, skip_children=True)
+            assert len(ctx.obj['objs'])==1
+            _select(ctx, summary='make plann good', todo=True)
+            assert len(ctx.obj['objs'])==1
+            _select(ctx, category=('keyboard',), todo=True)
+            assert len(ctx.obj['objs'])==2
+            _select(ctx, event=True)
+            assert len(ctx.obj['objs'])==0
+            _select(ctx, todo=True, start='2012-12-21 00:00', end='2012-12-22 00:00')
+            assert [str(x.icalendar_component['uid']) for x in ctx.obj['objs']] == [uid2]
+            _select(ctx, uid=[uid2, uid1], todo=True)
+            assert [str(x.icalendar_component['uid']) for x in ctx.obj['objs']] == [uid2, uid1]
+            _select(ctx, todo=True, skip_parents=True)
+            assert [str(x.icalendar_component['uid']) for x in ctx.obj['objs']] == [uid2]
+            _select(ctx, todo=True, no_category=True)
+            assert len(ctx.obj['objs'])==0
+            _select(ctx, todo=True, no_dtstart=False, no_due=True)
+            assert len(ctx.obj['objs'])==0
+
+            ## The filters should be done by the indexes
+            with patch('plann.mirror._match_attr', return_value=True):
+                _select(ctx, todo=True, category=('nonexistent',))
+                assert len(ctx.obj['objs'])==0
+            with patch('plann.mirror._in_range', return_value=True):
+                _select(ctx, todo=True, start='2013-01-21 00:00', end='2013-01-22 00:00')
+                assert len(ctx.obj['objs'])==0
+
+            ## limits are pushed down to the mirror when there is no sorting
+            with patch('plann.mirror._match_attr', side_effect=[True]) as match_attr:
+                _select(ctx, todo=True, limit=1, summary='make', sort_key=[])
+                assert len(ctx.obj['objs'])==1
+            ## ... but not when filtering client side after the search
+            with patch.object(Mirror, 'search', autospec=True, side_effect=Mirror.search) as search:
+                _select(ctx, todo=True, limit=1, category=('a', 'b'), sort_key=[])
+                assert search.call_args.kwargs['limit'] is None
+            with patch('plann.commands.heapq.nsmallest', wraps=heapq.nsmallest) as nsmallest:
+                _select(ctx, todo=True, limit=1, offset=1, sort_key=['-{SUMMARY}'])
+                nsmallest.assert_called_once()
+                ## (fed from the search results, not from a list of all of them)
+                assert not isinstance(nsmallest.call_args.args[1], list)
+            picked = [str(x.icalendar_component['uid']) for x in ctx.obj['objs']]
+            _select(ctx, todo=True, sort_key=['-{SUMMARY}'])
+            assert picked == [str(x.icalendar_component['uid']) for x in ctx.obj['objs']][1:2]
+
+            ## --live skips the mirror
+            with patch.object(Mirror, 'search', side_effect=AssertionError):
+                _select(ctx, todo=True, live=True)
+                assert len(ctx.obj['objs'])==2
+
+            ## writes updates the mirror in place
+            todo3 = _add_todo(ctx, summary=['mirror me'], set_uid='todo3')
+            _select(ctx, todo=True)
+            assert len(ctx.obj['objs'])==3
+
+            ## Full text search, the best matches first.  Words match as
+            ## prefixes, case insensitively
+            uids = lambda: [str(x.icalendar_component['uid']) for x in ctx.obj['objs']]
+            _text_search(ctx, 'plann')
+            assert uids() == [uid1, uid2]
+            _text_search(ctx, 'bugs PLANN')
+            assert uids() == [uid2]
+            _text_search(ctx, 'mirr')
+            assert uids() == ['todo3']
+            _text_search(ctx, 'plann', event=True)
+            assert uids() == []
+            ctx.obj['mirror'].fulltext = False
+            _text_search(ctx, 'bugs PLANN')
+            assert uids() == [uid2]
+            ctx.obj['mirror'].fulltext = True
+
+            ## A new run should only fetch what has changed
+            ctx.obj['mirror'] = Mirror(path=mirror_path)
+            _select(ctx, todo=True)
+            assert len(ctx.obj['objs'])==3
+            assert ctx.obj['mirror'].stats['fetched'] <= 1
+            todo3.delete()
+            _update_mirror(ctx, todo3, deleted=True)
+            _select(ctx, todo=True)
+            assert len(ctx.obj['objs'])==2
+
+            ## Without sync-collection support, etags are compared
+            ctx.obj['mirror'] = Mirror(path=os.path.join(mirrordir, 'mirror2.sqlite'))
+            with patch.object(Mirror, '_sync_collection', side_effect=caldav.error.ReportError):
+                _select(ctx, todo=True)
+                assert len(ctx.obj['objs'])==2
+            ctx.obj['mirror'] = None
+
+        ## An event with a pending task as parent pins the task.  The
+        ## parents are fetched in one bulk lookup.
+        pinning = cal.save_event(uid='pinning', summary='work on plann', dtstart=datetime_(year=2012, month=12, day=21, hour=10), dtend=datetime_(year=2012, month=12, day=21, hour=11), parent=[uid1])
+        other = cal.save_event(uid='unpinned', summary='lunch', dtstart=datetime_(year=2012, month=12, day=21, hour=12), dtend=datetime_(year=2012, month=12, day=21, hour=13))
+        with patch('caldav.Calendar.object_by_uid', side_effect=AssertionError):
+            _select(ctx, pinned_tasks=True)
+            assert [str(x.icalendar_component['uid']) for x in ctx.obj['objs']] == ['pinning']
+            _select(ctx, pinned_tasks=False)
+            uids = [str(x.icalendar_component['uid']) for x in ctx.obj['objs']]
+            assert 'unpinned' in uids
+            assert not 'pinning' in uids
+            _select(ctx, pinned_tasks=True, todo=True)
+            assert [str(x.icalendar_component['uid']) for x in ctx.obj['objs']] == [uid1]
+        pinning.delete()
+        other.delete()
+        ## caldav adds the reverse relation to todo1 when saving
+        parent = cal.object_by_uid(uid1)
+        related = [x for x in parent.icalendar_component.pop('RELATED-TO') if str(x) != 'pinning']
+        parent.icalendar_component.add('RELATED-TO', related[0] if len(related) == 1 else related)
+        parent.save()
+
+        ## Recurring events may be expanded client side.  (The expanded
+        ## instances given by xandikos have naive timestamps and the
+        ## DTEND of the master, so they are not compared here)
+        standup = cal.save_event(uid='standup', summary='standup', dtstart=datetime_(year=2012, month=12, day=24, hour=9), dtend=datetime_(year=2012, month=12, day=24, hour=9, minute=15), rrule={'FREQ': 'DAILY', 'COUNT': 10})
+        ctx.obj['client_expand'] = True
+        _select(ctx, event=True, start='2012-12-24', end='2012-12-27')
+        assert all(isinstance(x, plann.recurrence.Occurrence) for x in ctx.obj['objs'])
+        assert [x.icalendar_component['DTSTART'].dt for x in ctx.obj['objs']] == [datetime_(year=2012, month=12, day=x, hour=9) for x in (24, 25, 26)]
+        assert [x.get_dtend() for x in ctx.obj['objs']] == [datetime_(year=2012, month=12, day=x, hour=9, minute=15) for x in (24, 25, 26)]
+        ## ... but they can't be edited
+        with pytest.raises(click.Abort):
+            _edit(ctx, complete=True)
+        ctx.obj['client_expand'] = False
+        standup.delete()
 
         ## assert that relations are as expected
         todo1.load()
@@ -215,11 +456,79 @@ def test_plann():
         assert(list_bu[1][0] == ' ')
         assert('good' in list_bu[1])
 
+        ## The relatives are all in the selection, so the hierarchical
+        ## listing should neither look up nor save anything
+        with patch.object(Todo, 'get_relatives') as get_relatives, patch.object(Todo, 'save') as save:
+            assert _list(ctx.obj['objs'], top_down=True, echo=False) == list_td
+            assert not get_relatives.called
+            assert not save.called
+
+        ## A missing reverse relation is only fixed with repair_relations
+        parent = [x for x in ctx.obj['objs'] if str(x.icalendar_component['UID']) == uid1][0]
+        del parent.icalendar_component['RELATED-TO']
+        with patch.object(Todo, 'save') as save:
+            _list(ctx.obj['objs'], top_down=True, echo=False)
+            assert not save.called
+            _list(ctx.obj['objs'], top_down=True, echo=False, repair_relations=True)
+            assert save.call_count == 1
+        assert str(parent.icalendar_component['RELATED-TO']) == uid2
+        assert parent.icalendar_component['RELATED-TO'].params['RELTYPE'] == 'CHILD'
+
         ## Test that the calendar_name template attribute works
         list_cal = _list(ctx.obj['objs'], template="{calendar_name}", echo=False)
         assert list_cal[0] == todo1.parent.name
         assert list_cal[1] == todo2.parent.name
 
+        ## With stream, the objects are fetched as the selection is
+        ## consumed, but the listing should be the same
+        _select(ctx, todo=True, sort_key=[''], stream=True)
+        assert not isinstance(ctx.obj['objs'], list)
+        assert sorted(_list(ctx.obj['objs'], echo=False)) == sorted(_list(todo1.parent.search(todo=True), echo=False))
+        _select(ctx, all=True, stream=True)
+        assert len([x for x in ctx.obj['objs']]) == 2
+        ## select --all doesn't load the objects
+        with patch.object(caldav.DAVClient, 'request', autospec=True, side_effect=caldav.DAVClient.request) as request:
+            _select(ctx, all=True)
+            assert [x.args[2] for x in request.call_args_list] == ['REPORT']
+            assert len(ctx.obj['objs']) == 2
+            _select(ctx, all=True, stream=True)
+            assert len(list(ctx.obj['objs'])) == 2
+            assert [x.args[2] for x in request.call_args_list] == ['REPORT', 'REPORT']
+        ## ... the objects from --all are loaded in bulk for print-ical
+        _select(ctx, all=True, stream=True, raw=True)
+        with patch.object(caldav.CalendarObjectResource, 'load', side_effect=AssertionError):
+            loaded = list(plann.lib._loaded_objects(ctx.obj['objs']))
+        assert len(loaded) == 2
+        assert all('BEGIN:VTODO' in x.data for x in loaded)
+        ## For print-ical, the data is passed on without parsing it ...
+        with patch('plann.commands._fixup') as _fixup, patch('plann.commands._register_uids') as _register_uids:
+            _select(ctx, todo=True, sort_key=[''], stream=True, raw=True)
+            raw = [x.data for x in ctx.obj['objs']]
+            assert len(raw) == 2
+            assert not _fixup.called
+            assert not _register_uids.called
+        ## ... and add ical --raw saves it the same way
+        copy = [x for x in raw if uid1 in x][0].replace(uid1, 'raw-copy')
+        plann.lib._save_raw(todo1.parent, copy)
+        copied = todo1.parent.object_by_uid('raw-copy')
+        assert copied.icalendar_component['SUMMARY'] == todo1.icalendar_component['SUMMARY']
+        copied.delete()
+        ## For list, compact items will do ...
+        _select(ctx, todo=True, sort_key=['{SUMMARY}'], compact=True)
+        assert all(isinstance(x, plann.item.PlannItem) for x in ctx.obj['objs'])
+        items = ctx.obj['objs']
+        _select(ctx, todo=True, sort_key=['{SUMMARY}'])
+        assert _list(items, echo=False) == _list(ctx.obj['objs'], echo=False)
+        ## ... the full objects are fetched when the template needs more
+        assert _list(items, template="{DTSTAMP:%F}", echo=False) == _list(ctx.obj['objs'], template="{DTSTAMP:%F}", echo=False)
+        assert all(x._object is None for x in items)
+        ## ... or when sorting on other properties
+        _select(ctx, todo=True, sort_key=['{DTSTAMP}'], compact=True)
+        assert not any(isinstance(x, plann.item.PlannItem) for x in ctx.obj['objs'])
+        ## ... but not when the selection has to be sorted
+        _select(ctx, todo=True, sort_key=['{SUMMARY}'], stream=True)
+        assert isinstance(ctx.obj['objs'], list)
+
         ## panic planning, timeline_suggestion.
         ## We have two tasks in the calendar, each with one hour duration
         timeline = timeline_suggestion(ctx, hours_per_day=24)
@@ -0,0 +1,83 @@
+import pytest
+from datetime import timedelta
+from unittest.mock import MagicMock, patch
+from caldav import Todo, Event
+from plann.item import PlannItem
+from plann.lib import _sort_key, _list, _full_objects
+from plann.filters import compile_filter
+from tests.test_lib import todo
+
+event = """BEGIN:VCALENDAR
+VERSION:2.0
+PRODID:-//Example Corp.//CalDAV Client//EN
+BEGIN:VEVENT
+UID:event
+DTSTAMP:20240101T000000Z
+DTSTART;VALUE=DATE:20240101
+LOCATION:Oslo
+SUMMARY:new year
+CATEGORIES:holiday,party
+RELATED-TO;RELTYPE=PARENT:party
+END:VEVENT
+END:VCALENDAR"""
+
+def _objects():
+    parent = MagicMock()
+    parent.url = "http://calendar.example.com/calendar/"
+    parent.name = "calendar"
+    ret = []
+    for objclass, data in ((Todo, todo), (Event, event)):
+        obj = objclass(data=data, parent=parent)
+        obj.url = parent.url + "obj.ics"
+        ret.append(obj)
+    return ret
+
+def test_plann_item():
+    for obj in _objects():
+        item = PlannItem.from_object(obj)
+        comp = obj.icalendar_component
+        assert item.icalendar_component is item
+        assert item.name == comp.name
+        assert item['UID'] == comp['UID']
+        assert item.get('summary') == comp.get('summary')
+        assert item.get('PRIORITY', 0) == comp.get('PRIORITY', 0)
+        assert ('DUE' in item) == ('DUE' in comp)
+        assert set(item.keys()) <= set(comp.keys())
+        assert item.get_due() == obj.get_due()
+        assert item.get_duration() == obj.get_duration()
+        assert _sort_key(['{DTSTART:%F}', 'PRIORITY', 'get_duration()'])(item) == _sort_key(['{DTSTART:%F}', 'PRIORITY', 'get_duration()'])(obj)
+        assert item.parent is obj.parent
+        assert item._object is None
+
+    objs = _objects()
+    items = [PlannItem.from_object(x) for x in objs]
+    assert _list(items, echo=False) == _list(objs, echo=False)
+    assert compile_filter(category='party')(items[1])
+    assert list(items[1]['CATEGORIES'].cats) == ['holiday', 'party']
+
+    ## Anything else is only found on the full object, and it's not
+    ## loaded behind the scenes
+    item = items[1]
+    with pytest.raises(AttributeError):
+        item.data
+    with pytest.raises(KeyError):
+        item.get('LOCATION')
+    item._object = objs[1]
+    assert item.get('LOCATION') == 'Oslo'
+    assert item.data == objs[1].data
+
+def test_full_objects_recurrences():
+    ## Instances of a recurring event (as expanded by the server) have
+    ## the same uid, the full objects are matched on the recurrence-id
+    parent = MagicMock()
+    parent.url = "http://calendar.example.com/calendar/"
+    instances = []
+    for day in (1, 2, 3):
+        data = event.replace('DTSTART;VALUE=DATE:20240101', f'DTSTART;VALUE=DATE:2024010{day}\nRECURRENCE-ID;VALUE=DATE:2024010{day}')
+        instances.append(Event(data=data, parent=parent, url=parent.url + "event.ics"))
+    master = Event(data=event.replace('LOCATION:Oslo', 'RRULE:FREQ=DAILY'), parent=parent, url=parent.url + "event.ics")
+    items = [PlannItem.from_object(x) for x in instances]
+    with patch('plann.lib._refetch_objects', return_value={'event': master}):
+        assert list(_full_objects(items)) == items
+        assert list(_full_objects([PlannItem.from_object(master)])) == [master]
+    assert len(_list(items, template="{DTSTART:%F} {SUMMARY}", echo=False)) == 3
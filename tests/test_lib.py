@@ -1,7 +1,9 @@
 import pytest
+import time
 from unittest.mock import patch
 from caldav import Todo, Calendar
-from plann.lib import _summary,  _procrastinate, _adjust_ical_relations, _add_category, _set_something, add_time_tracking_timew, add_time_tracking, _split_vcal
+from plann.template import Template
+from plann.lib import CalendarList, RelationIndex, _fan_out, _fan_out_iter, _sort_key, _summary,  _procrastinate, _adjust_ical_relations, _add_category, _set_something, add_time_tracking_timew, add_time_tracking, _split_vcal, _split_vcals, _ics_chunks, _add_ical_lines
 from datetime import datetime, timedelta
 from datetime import timezone
 
@@ -180,3 +182,123 @@ END:VCALENDAR
 """
     output = _split_vcal(input)
     assert(len(output) == 2)
+
+@patch("plann.lib.find_calendars")
+def test_calendar_list(find_calendars):
+    find_calendars.side_effect = lambda args, raise_errors, cache: args['cals']
+    cals = CalendarList([{'cals': []}, {'cals': ['a']}, {'cals': ['b', 'c']}], raise_errors=True)
+    find_calendars.assert_not_called()
+    assert cals
+    assert cals[0] == 'a'
+    assert find_calendars.call_count == 2
+    assert list(cals) == ['a', 'b', 'c']
+    assert len(cals) == 3
+    assert cals[-1] == 'c'
+    assert find_calendars.call_count == 3
+
+def test_fan_out():
+    class Cal:
+        def __init__(self, name):
+            self.name = name
+            self.url = f"http://example.com/{name}/"
+    def search(cal):
+        if cal.name == 'broken':
+            raise ValueError("broken calendar")
+        time.sleep(0.01*(3-len(cal.name)%3))
+        return [cal.name]
+    cals = [Cal(x) for x in ('a', 'bb', 'broken', 'ccc')]
+    for jobs in (1, 4):
+        results, errors = _fan_out(cals, search, jobs)
+        assert results == [['a'], ['bb'], None, ['ccc']]
+        assert [x[0].name for x in errors] == ['broken']
+        assert isinstance(errors[0][1], ValueError)
+
+        ## The generator version gives the results one at a time, and
+        ## skips the failing calendars
+        errors = []
+        results = _fan_out_iter(cals, search, jobs, errors)
+        assert next(results) == ['a']
+        assert list(results) == [['bb'], ['ccc']]
+        assert [x[0].name for x in errors] == ['broken']
+
+def test_sort_key():
+    todos = []
+    for (uid, extra) in (
+            ('a', "DTSTART:19970415T133000Z\nPRIORITY:2"),
+            ('b', "DUE:19970416T045959Z\nPRIORITY:1"),
+            ('c', "DTSTART:19970415T133000Z\nPRIORITY:1"),
+            ('d', "PRIORITY:2"),
+            ('e', "DTSTART;VALUE=DATE:19970415\nPRIORITY:9"),
+            ('f', "DTSTART:19970415T133000Z\nPRIORITY:2")):
+        t = Todo()
+        t.data = todo.replace("UID:19970901T130000Z-123404@host.com", f"UID:{uid}").replace("DTSTART:19970415T133000Z\nDUE:19970416T045959Z\n", "").replace("PRIORITY:2", extra)
+        todos.append(t)
+
+    def old_sort(objs, sort_keys):
+        ## sorting once per key, the way it was done earlier
+        objs = list(objs)
+        for skey in reversed(sort_keys):
+            reverse = skey[0] == '-'
+            skey = skey.lstrip('-')
+            if '{' in skey:
+                fkey = lambda obj: Template(skey).format(**obj.icalendar_component)
+            else:
+                fkey = lambda obj: obj.icalendar_component.get(skey)
+            objs.sort(key=fkey, reverse=reverse)
+        return [str(x.icalendar_component['UID']) for x in objs]
+
+    for sort_keys in (
+            ['{DTSTART:?{DUE:?(0000)?}?%F %H:%M:%S}{PRIORITY:?0?}'],
+            ['{DTSTART:?{DUE:?(0000)?}?%F %H:%M:%S}', '{PRIORITY:?0?}'],
+            ['-{DTSTART:?{DUE:?(0000)?}?%F %H:%M:%S}', 'PRIORITY'],
+            ['PRIORITY', '-{DTSTART:?{DUE:?(0000)?}?%F}'],
+            ['-PRIORITY']):
+        assert [str(x.icalendar_component['UID']) for x in sorted(todos, key=_sort_key(sort_keys))] == old_sort(todos, sort_keys)
+
+    ## timestamps can be sorted on directly
+    assert [str(x.icalendar_component['UID']) for x in sorted([todos[2], todos[0], todos[5]], key=_sort_key(['DTSTART', '-PRIORITY']))] == ['a', 'f', 'c']
+
+def test_relation_index():
+    objs = []
+    for uid, rels in (('a', 'RELATED-TO;RELTYPE=CHILD:b\n'), ('b', 'RELATED-TO:a\nRELATED-TO;RELTYPE=SIBLING:c\n'), ('c', '')):
+        t = Todo()
+        t.data = todo.replace('UID:19970901T130000Z-123404@host.com\n', f'UID:{uid}\n{rels}')
+        objs.append(t)
+    a, b, c = objs
+    relations = RelationIndex(objs)
+    assert relations.related(a, {'CHILD'}) == {'b'}
+    assert relations.related(b, {'PARENT', 'SIBLING'}) == {'a', 'c'}
+    assert relations.has(b, {'PARENT'})
+    assert not relations.has(c, {'PARENT', 'CHILD'})
+    ## everything related is in the selection, so nothing is fetched
+    assert relations.fetch([b], {'PARENT'}) == {'a': a}
+
+def test_ics_chunks():
+    vtimezone = "BEGIN:VTIMEZONE\nTZID:Europe/Oslo\nBEGIN:STANDARD\nDTSTART:19701025T030000\nTZOFFSETFROM:+0200\nTZOFFSETTO:+0100\nEND:STANDARD\nEND:VTIMEZONE\n"
+    objs = []
+    for i in range(3):
+        t = Todo()
+        t.data = todo.replace("BEGIN:VTODO", vtimezone + "BEGIN:VTODO").replace("UID:", f"UID:{i}-")
+        objs.append(t)
+    ics = b"".join(_ics_chunks(iter(objs)))
+    assert ics.startswith(b"BEGIN:VCALENDAR\r\nVERSION:2.0\r\n")
+    assert ics.endswith(b"END:VCALENDAR\r\n")
+    assert ics.count(b"BEGIN:VTIMEZONE") == 1
+    assert ics.count(b"BEGIN:VTODO") == 3
+    assert ics.count(b"BEGIN:VCALENDAR") == 1
+    ## The objects should not be touched
+    assert all(len(t.icalendar_instance.subcomponents) == 2 for t in objs)
+    assert b"".join(_ics_chunks(objs, filter=lambda obj: 'UID:1-' in obj.data)).count(b"BEGIN:VTODO") == 1
+    assert not list(_ics_chunks([]))
+
+def test_raw_ical():
+    vcals = todo.replace("\n", "\r\n") + "\r\n" + todo.replace("UID:", "UID:2-") + "\n"
+    icals = _split_vcals(vcals)
+    assert len(icals) == 2
+    assert [x.split("UID:")[1].split()[0] for x in icals] == ["19970901T130000Z-123404@host.com", "2-19970901T130000Z-123404@host.com"]
+    ## Lines are added to the component only, with the same line endings
+    alarm = "BEGIN:VALARM\r\nACTION:DISPLAY\r\nTRIGGER:-PT5M\r\nEND:VALARM\r\nEND:VTODO"
+    ical = _add_ical_lines(icals[0].replace("END:VTODO", alarm), "CLASS:PRIVATE\nX-FOO:bar")
+    assert ical.count("CLASS:PRIVATE\r\nX-FOO:bar\r\nEND:VTODO\r\n") == 1
+    assert ical.count("CLASS:PRIVATE") == 1
+    assert not "\r\r" in ical and ical.count("\n") == ical.count("\r\n")
@@ -1,5 +1,15 @@
 from click.testing import CliRunner
+from unittest.mock import patch
+from plann.cli import cli
 ## Check https://click.palletsprojects.com/en/8.1.x/testing/
 
 ## TODO!  add some tests
 
+@patch("plann.lib.find_calendars")
+def test_help_without_discovery(find_calendars):
+    runner = CliRunner()
+    for cmd in (['--help'], ['select', '--help'], ['add', '--help']):
+        result = runner.invoke(cli, ['--skip-config', '--caldav-url', 'http://localhost:8080/'] + cmd)
+        assert result.exit_code == 0
+        assert 'Usage' in result.output
+    find_calendars.assert_not_called()
@@ -0,0 +1,24 @@
+import threading
+from unittest.mock import MagicMock, patch
+import plann.probe
+from plann.probe import server_profile
+from plann.lib import _fan_out
+
+def test_server_profile_concurrent():
+    ## Two servers are probed at the same time (the barrier is broken
+    ## if the probes are done one by one)
+    barrier = threading.Barrier(2, timeout=5)
+    def probe(calendar):
+        barrier.wait()
+        return {'multiget': True}
+    calendars = [MagicMock() for i in range(2)]
+    for i, calendar in enumerate(calendars):
+        calendar.client.url = f"http://server{i}.example.com/"
+    plann.probe._profiles.clear()
+    with patch('plann.probe.probe_calendar', side_effect=probe) as probe_calendar:
+        results, errors = _fan_out(calendars, server_profile, 2)
+        assert results == [{'multiget': True}]*2
+        ## ... and only once
+        assert server_profile(calendars[0]) == {'multiget': True}
+        assert probe_calendar.call_count == 2
+    plann.probe._profiles.clear()
@@ -0,0 +1,75 @@
+import pytest
+import itertools
+from datetime import datetime, date, timezone
+from caldav import Event
+from plann.recurrence import occurrences, expand, Occurrence, is_recurring
+from plann.lib import _sort_key
+
+utc = timezone.utc
+
+standup = """BEGIN:VCALENDAR
+VERSION:2.0
+PRODID:-//Example Corp.//CalDAV Client//EN
+BEGIN:VEVENT
+UID:standup
+DTSTAMP:20240101T000000Z
+DTSTART;TZID=Europe/Oslo:20240101T090000
+DTEND;TZID=Europe/Oslo:20240101T091500
+RRULE:FREQ=DAILY
+EXDATE:20240103T080000Z
+RDATE;TZID=Europe/Oslo:20240105T150000
+SUMMARY:standup
+END:VEVENT
+BEGIN:VEVENT
+UID:standup
+DTSTAMP:20240101T000000Z
+RECURRENCE-ID;TZID=Europe/Oslo:20240102T090000
+DTSTART;TZID=Europe/Oslo:20240102T130000
+DTEND;TZID=Europe/Oslo:20240102T131500
+SUMMARY:moved standup
+END:VEVENT
+END:VCALENDAR"""
+
+def _event(data):
+    e = Event()
+    e.data = data
+    return e
+
+def test_occurrences():
+    e = _event(standup)
+    assert is_recurring(e)
+    found = list(occurrences(e, datetime(2024, 1, 1, tzinfo=utc), datetime(2024, 1, 6, tzinfo=utc)))
+    assert all(isinstance(x, Occurrence) for x in found)
+    assert [(x.start.day, x.start.hour) for x in found] == [(1, 9), (2, 13), (4, 9), (5, 9), (5, 15)]
+    assert [str(x.icalendar_component['SUMMARY']) for x in found][:2] == ['standup', 'moved standup']
+    assert found[0].icalendar_component['RECURRENCE-ID'].dt == found[0].start
+    assert not 'RRULE' in found[0].icalendar_component
+    assert found[0].get_duration().seconds == 15*60
+    assert found[0].parent is e.parent
+
+    ## The wall clock time is kept over a DST change
+    found = list(occurrences(e, datetime(2024, 3, 30, tzinfo=utc), datetime(2024, 4, 2, tzinfo=utc)))
+    assert [x.start.hour for x in found] == [9, 9, 9]
+    assert [x.start.utcoffset().seconds//3600 for x in found] == [1, 2, 2]
+
+    ## The expansion is lazy, also without any end
+    assert len(list(itertools.islice(occurrences(e), 1000))) == 1000
+
+    ## Occurrences can be sorted like ordinary objects
+    assert sorted(found, key=_sort_key(['-DTSTART']))[0] is found[-1]
+
+    ## ... but not modified (that would be done on the master)
+    assert found[0].parent is e.parent
+    for method in ('save', 'complete', 'delete', 'load'):
+        with pytest.raises(AttributeError):
+            getattr(found[0], method)
+
+def test_expand():
+    e = _event(standup)
+    allday = _event(standup.replace("UID:standup", "UID:allday").replace("DTSTART;TZID=Europe/Oslo:20240101T090000\nDTEND;TZID=Europe/Oslo:20240101T091500", "DTSTART;VALUE=DATE:20240101").replace("RRULE:FREQ=DAILY", "RRULE:FREQ=WEEKLY;COUNT=3"))
+    single = _event(standup.replace("RRULE:FREQ=DAILY\nEXDATE:20240103T080000Z\nRDATE;TZID=Europe/Oslo:20240105T150000\n", ""))
+    found = list(expand([allday, single], datetime(2024, 1, 7, tzinfo=utc), datetime(2024, 2, 1, tzinfo=utc)))
+    assert [x.start for x in found[:2]] == [date(2024, 1, 8), date(2024, 1, 15)]
+    assert found[0].get_dtend() == date(2024, 1, 9)
+    ## objects that are not recurring are passed through
+    assert found[2:] == [single]
@@ -0,0 +1,54 @@
+from caldav import Todo
+from plann.scan import scan, scan_object, component_name
+from plann.item import PlannItem
+from tests.test_lib import todo
+
+event = """BEGIN:VCALENDAR\r
+VERSION:2.0\r
+PRODID:-//Example Corp.//CalDAV Client//EN\r
+BEGIN:VTIMEZONE\r
+TZID:Europe/Oslo\r
+BEGIN:STANDARD\r
+DTSTART:19701025T030000\r
+TZOFFSETFROM:+0200\r
+TZOFFSETTO:+0100\r
+END:STANDARD\r
+END:VTIMEZONE\r
+BEGIN:VEVENT\r
+UID:some-very-long-uid-that-has-been-fo\r
+ lded\r
+DTSTART;TZID=Europe/Oslo:20240101T090000\r
+ATTENDEE;CN="Doe: John":mailto:john@example.com\r
+BEGIN:VALARM\r
+ACTION:DISPLAY\r
+DURATION:PT15M\r
+TRIGGER:-PT15M\r
+END:VALARM\r
+SUMMARY:meeting\r
+END:VEVENT\r
+END:VCALENDAR\r
+"""
+
+def test_scan():
+    assert scan(event) == ('VEVENT', {})
+    name, props = scan(event, ['uid', 'DTSTART', 'DURATION', 'ATTENDEE', 'SUMMARY', 'TZID'])
+    assert name == 'VEVENT'
+    assert props == {
+        ## folded lines are unfolded
+        'UID': 'some-very-long-uid-that-has-been-folded',
+        ## parameters are skipped, also with quoted colons
+        'DTSTART': '20240101T090000',
+        'ATTENDEE': 'mailto:john@example.com',
+        'SUMMARY': 'meeting',
+    }
+    ## (the DURATION of the VALARM and the TZID of the VTIMEZONE are not included)
+    assert scan("BEGIN:VCALENDAR\nEND:VCALENDAR") == (None, {})
+
+def test_scan_object():
+    obj = Todo(data=todo)
+    assert scan_object(obj, ['DUE', 'DURATION']) == ('VTODO', {'DUE': '19970416T045959Z'})
+    ## Parsed data is not serialized again
+    obj.icalendar_component['SUMMARY'] = 'changed'
+    assert scan_object(obj, ['SUMMARY', 'DUE']) == ('VTODO', {'SUMMARY': 'changed', 'DUE': '19970416T045959Z'})
+    assert component_name(PlannItem.from_object(obj)) == 'VTODO'
+    assert component_name(obj.icalendar_component) == 'VTODO'
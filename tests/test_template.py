@@ -59,3 +59,22 @@ class TestTemplate:
 
 
         
+
+    def test_render_looks_up_used_fields_only(self):
+        class Fields(dict):
+            looked_up = []
+            def __getitem__(self, key):
+                self.looked_up.append(key)
+                return dict.__getitem__(self, key)
+        fields = Fields(date=self.date, foo='bar', unused='x')
+        template = Template("{foo} {date:?{foo}?%F} {missing:?NA?}")
+        assert template.render(fields) == "bar 1990-10-10 NA"
+        assert 'unused' not in fields.looked_up
+        ## The default is only rendered when the value is missing
+        assert fields.looked_up.count('foo') == 1
+        assert template.render({}) == "  NA"
+
+    def test_compiled_once(self):
+        template = Template("{date:%F} {1}")
+        assert Template("{date:%F} {1}")._compiled is template._compiled
+        assert template.format('a', 'b', date=self.date) == "1990-10-10 b"
@@ -170,3 +170,45 @@ def test_ensure_ts():
     assert(_ensure_ts(now) == implicitnow)
     assert(_ensure_ts(utcnow) == utcnow)
     assert(_ensure_ts(implicitnow) == implicitnow)
+
+@pytest.mark.parametrize("input", ["2012-12-12", "20121212", "2011-11-11 11:11:11", "2011-11-11T11:11:11Z", "2011-11-11T11:11:11+02:00", "20111111T111111", "2011-11-11 2011-11-12"])
+def test_iso_fast_path(input):
+    import dateutil.parser
+    from plann.timespec import _parse_str
+    try:
+        expected = dateutil.parser.parse(input)
+    except ValueError:
+        with pytest.raises(ValueError):
+            _parse_str(input)
+        return
+    assert _parse_str(input) == expected
+    assert _parse_str(input).tzinfo is None or _parse_str(input).utcoffset() == expected.utcoffset()
+
+@pytest.mark.parametrize("dur,expected", [
+    ('P1D', timedelta(days=1)),
+    ('PT1H30M', timedelta(hours=1, minutes=30)),
+    ('P1W2DT3S', timedelta(days=9, seconds=3)),
+    ('-PT15M', timedelta(minutes=-15)),
+    ('PT0.5H', timedelta(minutes=30)),
+    ('1w1s', timedelta(days=7, seconds=1)),
+])
+def test_parse_dur(dur, expected):
+    assert parse_add_dur(None, dur) == expected
+    assert parse_add_dur(datetime(2020,2,20,tzinfo=utc), dur) == datetime(2020,2,20,tzinfo=utc) + expected
+
+@pytest.mark.parametrize("dur", ['P', 'PT', 'P1M', 'P1DT', '1x', '2020-02-20'])
+def test_parse_dur_invalid(dur):
+    with pytest.raises(ValueError):
+        parse_add_dur(None, dur)
+
+def test_frozen_now():
+    from plann.timespec import _now, frozen_now
+    then = datetime(2010,10,10,10,10,10,tzinfo=utc)
+    with frozen_now(then) as now:
+        assert now == then
+        assert _now() == then
+        assert parse_dt('now') == then
+        assert parse_dt('+2h') == then + timedelta(hours=2)
+    assert _now() != then
+    with frozen_now() as now:
+        assert _now() is now